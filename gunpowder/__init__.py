@@ -8,6 +8,7 @@ from .array_spec import ArraySpec
 from .batch import Batch
 from .batch_request import BatchRequest
 from .build import build
+from .chunk_cache import ChunkCache, SharedChunkCache
 from .coordinate import Coordinate
 from .graph import Graph, Node, Edge, GraphKey, GraphKeys
 from .graph_spec import GraphSpec
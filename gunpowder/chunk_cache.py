@@ -0,0 +1,229 @@
+import collections
+import hashlib
+import logging
+import multiprocessing
+import os
+import threading
+import time
+import weakref
+from multiprocessing import shared_memory
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class ChunkCache(object):
+    '''A cache for decompressed chunks of datasets, bounded by the number of
+    bytes it holds. If full, the least recently used chunks are dropped.
+
+    The cache lives in the memory of the process that uses it. Worker
+    processes forked after the cache has been created start with a copy of
+    it, but do not share chunks added later. Use :class:`SharedChunkCache` to
+    share chunks between processes.
+
+    A cache can be passed to several sources, see :class:`ZarrSource` and
+    :class:`Hdf5Source`.
+
+    Args:
+
+        max_bytes (``int``):
+
+            How many bytes of chunk data to hold at most.
+    '''
+
+    def __init__(self, max_bytes):
+
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        self.chunks = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, shape, dtype):
+        '''Get the chunk for ``key``, or ``None`` if it is not in the cache.
+        The returned array must not be modified.'''
+
+        with self.lock:
+            chunk = self.chunks.get(key)
+            if chunk is None:
+                return None
+            self.chunks.move_to_end(key)
+
+        return chunk
+
+    def put(self, key, chunk):
+        '''Add a chunk to the cache.'''
+
+        if chunk.nbytes > self.max_bytes:
+            return
+
+        with self.lock:
+
+            if key in self.chunks:
+                self.num_bytes -= self.chunks.pop(key).nbytes
+
+            self.chunks[key] = chunk
+            self.num_bytes += chunk.nbytes
+
+            while self.num_bytes > self.max_bytes:
+                _, dropped = self.chunks.popitem(last=False)
+                self.num_bytes -= dropped.nbytes
+
+
+class SharedChunkCache(object):
+    '''A cache for decompressed chunks of datasets in shared memory, to share
+    chunks between worker processes (e.g., of :class:`PreCache`).
+
+    The cache consists of fixed size slots, grouped into sets of ``ways``
+    slots. A chunk can only be stored in one set (determined by a hash of its
+    key), in which the least recently used slot is replaced. Chunks larger
+    than ``max_chunk_bytes`` are not cached.
+
+    The cache has to be created before the worker processes are started, such
+    that they inherit it. The shared memory is released when the cache is
+    garbage collected in the process that created it, or with :func:`close`.
+
+    Args:
+
+        max_bytes (``int``):
+
+            How many bytes of chunk data to hold at most.
+
+        max_chunk_bytes (``int``, optional):
+
+            The size of a slot, i.e., the largest chunk that can be cached.
+
+        ways (``int``, optional):
+
+            How many slots a chunk can be placed in.
+    '''
+
+    # how many locks to spread the sets over
+    num_locks = 64
+
+    def __init__(self, max_bytes, max_chunk_bytes=2**22, ways=4):
+
+        self.max_chunk_bytes = max_chunk_bytes
+        self.ways = ways
+        self.num_sets = max(1, max_bytes//(max_chunk_bytes*ways))
+        self.num_slots = self.num_sets*ways
+
+        # per slot: hash of key, number of bytes, time of last use
+        self.__header_memory = shared_memory.SharedMemory(
+            create=True,
+            size=self.num_slots*3*8)
+        self.__data_memory = shared_memory.SharedMemory(
+            create=True,
+            size=self.num_slots*max_chunk_bytes)
+        self.__header = np.ndarray(
+            (self.num_slots, 3),
+            dtype=np.uint64,
+            buffer=self.__header_memory.buf)
+        self.__header[:] = 0
+
+        self.locks = [
+            multiprocessing.Lock()
+            for _ in range(min(self.num_sets, self.num_locks))
+        ]
+
+        self.__finalizer = weakref.finalize(
+            self,
+            SharedChunkCache.__release,
+            os.getpid(),
+            [self.__header_memory, self.__data_memory])
+
+    def get(self, key, shape, dtype):
+        '''Get a copy of the chunk for ``key``, or ``None`` if it is not in
+        the cache.'''
+
+        dtype = np.dtype(dtype)
+        nbytes = int(np.prod(shape, dtype=np.int64))*dtype.itemsize
+        if nbytes > self.max_chunk_bytes:
+            return None
+
+        key_hash = self.__hash(key)
+        chunk_set = key_hash % self.num_sets
+
+        with self.__lock(chunk_set):
+
+            for slot in self.__slots(chunk_set):
+
+                if (
+                        self.__header[slot, 0] == key_hash and
+                        self.__header[slot, 1] == nbytes):
+
+                    self.__header[slot, 2] = time.monotonic_ns()
+                    return self.__data(slot, nbytes).view(dtype).reshape(
+                        shape).copy()
+
+        return None
+
+    def put(self, key, chunk):
+        '''Add a chunk to the cache.'''
+
+        nbytes = chunk.nbytes
+        if nbytes > self.max_chunk_bytes:
+            return
+
+        key_hash = self.__hash(key)
+        chunk_set = key_hash % self.num_sets
+
+        with self.__lock(chunk_set):
+
+            slots = list(self.__slots(chunk_set))
+            target = None
+            for slot in slots:
+                if self.__header[slot, 0] == key_hash:
+                    target = slot
+                    break
+            if target is None:
+                target = min(slots, key=lambda slot: self.__header[slot, 2])
+
+            self.__data(target, nbytes)[:] = np.ascontiguousarray(
+                chunk).reshape(-1).view(np.uint8)
+            self.__header[target] = (key_hash, nbytes, time.monotonic_ns())
+
+    def close(self):
+        '''Release the shared memory (only in the creating process).'''
+
+        self.__header = None
+        self.__finalizer()
+
+    def __slots(self, chunk_set):
+
+        return range(chunk_set*self.ways, (chunk_set + 1)*self.ways)
+
+    def __lock(self, chunk_set):
+
+        return self.locks[chunk_set % len(self.locks)]
+
+    def __data(self, slot, nbytes):
+
+        begin = slot*self.max_chunk_bytes
+        return np.ndarray(
+            (nbytes,),
+            dtype=np.uint8,
+            buffer=self.__data_memory.buf,
+            offset=begin)
+
+    def __hash(self, key):
+
+        digest = hashlib.blake2b(
+            repr(key).encode(),
+            digest_size=8).digest()
+        # 0 marks empty slots, stay within int64 for numpy comparisons
+        return max(1, int.from_bytes(digest, 'little') >> 1)
+
+    @staticmethod
+    def __release(pid, memories):
+
+        for memory in memories:
+            try:
+                memory.close()
+            except BufferError:
+                pass
+            if os.getpid() == pid:
+                try:
+                    memory.unlink()
+                except FileNotFoundError:
+                    pass
@@ -258,6 +258,57 @@ class Graph(Freezable):
         for (u, v), attrs in self.__graph.edges.items():
             yield Edge(u, v, attrs)
 
+    def node_ids_array(self):
+        """
+        Get the ids of all nodes as an array, in the order of :attr:`nodes`.
+        """
+        return np.fromiter(
+            self.__graph.nodes.keys(), dtype=int, count=self.num_vertices()
+        )
+
+    def locations_array(self):
+        """
+        Get the locations of all nodes as an array of shape ``(n, dims)``, in
+        the order of :attr:`nodes`.
+        """
+        locations = [attrs["location"] for attrs in self.__graph.nodes.values()]
+        if len(locations) == 0:
+            dims = self.spec.roi.dims() if self.spec.roi is not None else 0
+            return np.zeros((0, dims), dtype=self.spec.dtype)
+        return np.stack(locations).astype(self.spec.dtype, copy=False)
+
+    def edges_array(self):
+        """
+        Get the ``(u, v)`` ids of all edges as an array of shape ``(m, 2)``, in
+        the order of :attr:`edges`.
+        """
+        edges = np.fromiter(
+            itertools.chain.from_iterable(self.__graph.edges.keys()),
+            dtype=int,
+            count=2 * self.num_edges(),
+        )
+        return edges.reshape(-1, 2)
+
+    def node_attrs_array(self, attr, default=None):
+        """
+        Get the values of attribute ``attr`` of all nodes as an array, in the
+        order of :attr:`nodes`. Nodes without this attribute contribute
+        ``default``.
+        """
+        return np.array(
+            [attrs.get(attr, default) for attrs in self.__graph.nodes.values()]
+        )
+
+    def edge_attrs_array(self, attr, default=None):
+        """
+        Get the values of attribute ``attr`` of all edges as an array, in the
+        order of :attr:`edges`. Edges without this attribute contribute
+        ``default``.
+        """
+        return np.array(
+            [attrs.get(attr, default) for attrs in self.__graph.edges.values()]
+        )
+
     def neighbors(self, node):
         if self.directed:
             for neighbor in self.__graph.successors(node.id):
@@ -2,7 +2,7 @@ from __future__ import absolute_import
 
 from .add_affinities import AddAffinities
 from .balance_labels import BalanceLabels
-from .batch_filter import BatchFilter
+from .batch_filter import BatchFilter, RequestContext
 from .batch_provider import BatchProvider
 from .crop import Crop
 from .csv_points_source import CsvPointsSource
@@ -12,6 +12,7 @@ from .downsample import DownSample
 from .dvid_source import DvidSource
 from .elastic_augment import ElasticAugment
 from .exclude_labels import ExcludeLabels
+from .fused_augment import FusedAugment
 from .grow_boundary import GrowBoundary
 from .hdf5_source import Hdf5Source
 from .hdf5_write import Hdf5Write
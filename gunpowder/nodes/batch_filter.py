@@ -1,5 +1,11 @@
+import asyncio
 import copy
+import functools
+import inspect
 import logging
+import numpy as np
+import random
+import threading
 
 from .batch_provider import BatchProvider
 from gunpowder.batch_request import BatchRequest
@@ -19,6 +25,54 @@ class BatchFilterError(Exception):
         return f"Error in {self.batch_filter.name()}: {self.msg}"
 
 
+class RequestContext(object):
+    """Scratch space for a single request to a :class:`BatchFilter`.
+
+    A new context is created for each request and passed to
+    :func:`BatchFilter.prepare` and :func:`BatchFilter.process`, if these
+    accept a ``context`` argument. Store anything computed in ``prepare`` for
+    later use in ``process`` as attributes of the context, rather than on the
+    node itself. This way, one node can process several requests concurrently.
+
+    Nodes that need random numbers should draw them from :attr:`random` and
+    :attr:`np_random`, which are seeded with the random seed of the request,
+    instead of from the global generators of ``random`` and ``numpy``.
+    """
+
+    def __init__(self, random_seed=None):
+        self.random_seed = random_seed
+        self._random = None
+        self._np_random = None
+
+    @property
+    def random(self):
+        """A ``random.Random`` for this request."""
+        if self._random is None:
+            self._random = random.Random(self.random_seed)
+        return self._random
+
+    @property
+    def np_random(self):
+        """A ``numpy.random.RandomState`` for this request."""
+        if self._np_random is None:
+            self._np_random = np.random.RandomState(self.random_seed)
+        return self._np_random
+
+
+# the node and context of the prepare or process call currently running in
+# this thread, see BatchFilter._get_context
+_current = threading.local()
+
+
+@functools.lru_cache(maxsize=None)
+def _accepts_context(function):
+
+    try:
+        return 'context' in inspect.signature(function).parameters
+    except (TypeError, ValueError):
+        return False
+
+
 class BatchFilter(BatchProvider):
     """Convenience wrapper for :class:`BatchProviders<BatchProvider>` with
     exactly one input provider.
@@ -43,6 +97,12 @@ class BatchFilter(BatchProvider):
 
             Prepare for a batch request. Always called before each 
             :func:`process`. Used to communicate dependencies.
+
+    If :func:`prepare` and :func:`process` are implemented with an additional
+    ``context`` argument, they will receive the same :class:`RequestContext`
+    for each request. Use it to pass state from :func:`prepare` to
+    :func:`process` instead of storing it on ``self``, to keep the node safe
+    to use from several threads at the same time.
     """
 
     @property
@@ -147,9 +207,85 @@ class BatchFilter(BatchProvider):
         timing_prepare.start()
 
         downstream_request = request.copy()
+        context = RequestContext(request.random_seed)
+
+        dependencies, upstream_request = self.__prepare_upstream(
+            request, skip, context)
+
+        timing_prepare.stop()
+
+        batch = self.get_upstream_provider().request_batch(upstream_request)
+
+        timing_process = Timing(self, "process")
+        timing_process.start()
+
+        batch = self.__process_upstream(
+            batch, dependencies, downstream_request, skip, context)
+
+        timing_process.stop()
+
+        batch.profiling_stats.add(timing_prepare)
+        batch.profiling_stats.add(timing_process)
+
+        return batch
+
+    async def provide_async(self, request):
+        """Asynchronous version of :func:`provide`.
+
+        Calls :func:`prepare` and :func:`process` in the default executor of
+        the running event loop and awaits the upstream provider in between,
+        such that the event loop is free while upstream data is read. Filters
+        that overwrite :func:`provide` are run as a whole in the executor.
+
+        Several requests can be in flight at the same time, and the global
+        generators of ``random`` and ``numpy`` are shared between them. Only
+        filters that draw random numbers from their :class:`RequestContext`
+        produce the same batches as :func:`provide`; filters using the global
+        generators are not reproducible on this path.
+        """
+
+        if type(self).provide is not BatchFilter.provide:
+            return await super().provide_async(request)
+
+        loop = asyncio.get_running_loop()
+        skip = self.__can_skip(request)
+
+        timing_prepare = Timing(self, "prepare")
+        timing_prepare.start()
+
+        downstream_request = request.copy()
+        context = RequestContext(request.random_seed)
+
+        dependencies, upstream_request = await loop.run_in_executor(
+            None, self.__prepare_upstream, request, skip, context)
+
+        timing_prepare.stop()
+
+        batch = await self.get_upstream_provider().request_batch_async(
+            upstream_request)
+
+        timing_process = Timing(self, "process")
+        timing_process.start()
+
+        batch = await loop.run_in_executor(
+            None,
+            self.__process_upstream,
+            batch, dependencies, downstream_request, skip, context)
+
+        timing_process.stop()
+
+        batch.profiling_stats.add(timing_prepare)
+        batch.profiling_stats.add(timing_process)
+
+        return batch
+
+    def __prepare_upstream(self, request, skip, context):
+
+        dependencies = None
 
         if not skip:
-            dependencies = self.prepare(request)
+            dependencies = self.__call_with_context(
+                self.prepare, context, request)
             if isinstance(dependencies, BatchRequest):
                 upstream_request = request.update_with(dependencies)
             elif dependencies is None:
@@ -165,12 +301,15 @@ class BatchFilter(BatchProvider):
             upstream_request = request.copy()
         self.remove_provided(upstream_request)
 
-        timing_prepare.stop()
-
-        batch = self.get_upstream_provider().request_batch(upstream_request)
+        return dependencies, upstream_request
 
-        timing_process = Timing(self, "process")
-        timing_process.start()
+    def __process_upstream(
+            self,
+            batch,
+            dependencies,
+            downstream_request,
+            skip,
+            context):
 
         if not skip:
             if dependencies is not None:
@@ -179,19 +318,46 @@ class BatchFilter(BatchProvider):
             else:
                 node_batch = batch
             downstream_request.remove_placeholders()
-            processed_batch = self.process(node_batch, downstream_request)
+            processed_batch = self.__call_with_context(
+                self.process, context, node_batch, downstream_request)
             if processed_batch is None:
                 processed_batch = node_batch
             batch = batch.merge(processed_batch, merge_profiling_stats=False).crop(
                 downstream_request
             )
 
-        timing_process.stop()
+        return batch
 
-        batch.profiling_stats.add(timing_prepare)
-        batch.profiling_stats.add(timing_process)
+    def __call_with_context(self, method, context, *args):
+
+        previous = getattr(_current, 'context', None)
+        _current.context = (self, context)
+        try:
+            if _accepts_context(getattr(method, '__func__', method)):
+                return method(*args, context=context)
+            return method(*args)
+        finally:
+            _current.context = previous
+
+    def _get_context(self, context, request=None):
+        """Return ``context`` or, if none was passed, the context of the
+        request this node is currently preparing or processing (e.g., when a
+        subclass calls ``super().process(batch, request)``).
+
+        If :func:`prepare` and :func:`process` are called directly, a context
+        is kept on this node instead. Pass the ``request`` from
+        :func:`prepare` to replace it with a fresh one for this request.
+        """
 
-        return batch
+        if context is not None:
+            return context
+        current = getattr(_current, 'context', None)
+        if current is not None and current[0] is self:
+            return current[1]
+        if request is not None or not hasattr(self, '_own_context'):
+            self._own_context = RequestContext(
+                request.random_seed if request is not None else None)
+        return self._own_context
 
     def __can_skip(self, request):
         """Check if this filter needs to be run for the given request."""
@@ -226,6 +392,11 @@ class BatchFilter(BatchProvider):
         Prepare for a batch request. Should return a :class:`BatchRequest` of
         needed dependencies. If None is returned, it will be assumed that all
         of request is needed.
+
+        Implementations can take an additional ``context`` argument to receive
+        the :class:`RequestContext` of this request. Give it a default of
+        ``None`` and call :func:`_get_context` to support callers that do not
+        pass one.
         """
         return None
 
@@ -248,6 +419,11 @@ class BatchFilter(BatchProvider):
 
                 The request this node received. The updated batch should meet
                 this request.
+
+            context (:class:`RequestContext`, optional):
+
+                Only passed if the implementation accepts it. The same context
+                :func:`prepare` received for this request.
         """
         raise BatchFilterError(
             self,
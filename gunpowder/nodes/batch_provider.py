@@ -1,5 +1,6 @@
 import numpy as np
 
+import asyncio
 import copy
 import logging
 import random
@@ -43,6 +44,11 @@ class BatchProvider(object):
     :class:`BatchProviders<BatchProvider>` upstream. If your node accepts
     exactly one upstream provider, consider subclassing :class:`BatchFilter`
     instead.
+
+    Batches can also be requested from within an ``asyncio`` event loop with
+    :func:`request_batch_async`. Nodes that only implement :func:`provide`
+    are then run in the event loop's default executor, nodes that can do
+    better (like sources that overlap reads) implement :func:`provide_async`.
     '''
 
     def add_upstream_provider(self, provider):
@@ -173,26 +179,37 @@ class BatchProvider(object):
 
         try:
 
-            request._update_random_seed()
+            upstream_request = self.__prepare_request(request)
+            batch = self.provide(upstream_request)
+            self.__finish_batch(batch, request)
 
-            self.set_seeds(request)
+        except Exception as e:
 
-            logger.debug("%s got request %s", self.name(), request)
+            raise BatchRequestError(self, request, batch) from e
 
-            self.check_request_consistency(request)
+        return batch
 
-            upstream_request = request.copy()
-            if self.remove_placeholders:
-                upstream_request.remove_placeholders()
-            batch = self.provide(upstream_request)
+    async def request_batch_async(self, request):
+        '''Request a batch from this provider without blocking the event
+        loop. Same as :func:`request_batch`, but calls :func:`provide_async`
+        instead of :func:`provide`.
 
-            request.remove_placeholders()
+        Args:
 
-            self.check_batch_consistency(batch, request)
+            request (:class:`BatchRequest`):
 
-            self.remove_unneeded(batch, request)
+                A request containing (possibly partial)
+                :class:`ArraySpecs<ArraySpec>` and
+                :class:`GraphSpecs<GraphSpec>`.
+        '''
 
-            logger.debug("%s provides %s", self.name(), batch)
+        batch = None
+
+        try:
+
+            upstream_request = self.__prepare_request(request)
+            batch = await self.provide_async(upstream_request)
+            self.__finish_batch(batch, request)
 
         except Exception as e:
 
@@ -200,6 +217,32 @@ class BatchProvider(object):
 
         return batch
 
+    def __prepare_request(self, request):
+
+        request._update_random_seed()
+
+        self.set_seeds(request)
+
+        logger.debug("%s got request %s", self.name(), request)
+
+        self.check_request_consistency(request)
+
+        upstream_request = request.copy()
+        if self.remove_placeholders:
+            upstream_request.remove_placeholders()
+
+        return upstream_request
+
+    def __finish_batch(self, batch, request):
+
+        request.remove_placeholders()
+
+        self.check_batch_consistency(batch, request)
+
+        self.remove_unneeded(batch, request)
+
+        logger.debug("%s provides %s", self.name(), batch)
+
     def set_seeds(self, request):
         seed = request.random_seed
         random.seed(seed)
@@ -349,6 +392,26 @@ class BatchProvider(object):
         '''
         raise NotImplementedError("Class %s does not implement 'provide'"%self.name())
 
+    async def provide_async(self, request):
+        '''Asynchronous version of :func:`provide`, called by
+        :func:`request_batch_async`.
+
+        The default implementation runs :func:`provide` in the default
+        executor of the running event loop (see
+        ``asyncio.loop.set_default_executor``). Overwrite this in subclasses
+        that can serve requests without blocking the event loop, for example
+        by awaiting upstream providers or overlapping I/O.
+
+        Args:
+
+            request(:class:`BatchRequest`):
+
+                The request to process.
+        '''
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.provide, request)
+
     def name(self):
         return type(self).__name__
 
@@ -1,5 +1,6 @@
 import numpy as np
 import logging
+import os
 from gunpowder.batch import Batch
 from gunpowder.coordinate import Coordinate
 from gunpowder.nodes.batch_provider import BatchProvider
@@ -46,10 +47,20 @@ class CsvPointsSource(BatchProvider):
 
             Each line may optionally contain an id for each point. This parameter
             specifies its location, has to come after the position values.
+
+        binary_cache (``bool``, optional):
+
+            If set, the parsed CSV file is stored next to it as a binary
+            ``<filename>.npy`` file, which is memory-mapped instead of parsing
+            the CSV file again in later runs. The cache is recreated if the CSV
+            file is newer.
     '''
 
+    # average number of points per cell of the spatial index
+    points_per_cell = 16
+
     def __init__(self, filename, points, points_spec=None, scale=None,
-                 ndims=None, id_dim=None):
+                 ndims=None, id_dim=None, binary_cache=False):
 
         self.filename = filename
         self.points = points
@@ -57,19 +68,28 @@ class CsvPointsSource(BatchProvider):
         self.scale = scale
         self.ndims = ndims
         self.id_dim = id_dim
+        self.binary_cache = binary_cache
         self.data = None
 
+        # spatial index, a regular grid of cells
+        self.grid_origin = None
+        self.cell_size = None
+        self.grid_shape = None
+        self.cell_starts = None
+        self.cell_order = None
+
     def setup(self):
 
         self._parse_csv()
+        self._build_index()
 
         if self.points_spec is not None:
 
             self.provides(self.points, self.points_spec)
             return
 
-        min_bb = Coordinate(np.floor(np.amin(self.data[:,:self.ndims], 0)))
-        max_bb = Coordinate(np.ceil(np.amax(self.data[:,:self.ndims], 0)) + 1)
+        min_bb = Coordinate(np.floor(np.amin(self.data[:, :self.ndims], 0)))
+        max_bb = Coordinate(np.ceil(np.amax(self.data[:, :self.ndims], 0)) + 1)
 
         roi = Roi(min_bb, max_bb - min_bb)
 
@@ -87,10 +107,7 @@ class CsvPointsSource(BatchProvider):
             "CSV points source got request for %s",
             request[self.points].roi)
 
-        point_filter = np.ones((self.data.shape[0],), dtype=np.bool)
-        for d in range(self.ndims):
-            point_filter = np.logical_and(point_filter, self.data[:,d] >= min_bb[d])
-            point_filter = np.logical_and(point_filter, self.data[:,d] < max_bb[d])
+        point_filter = self._query(min_bb, max_bb)
 
         points_data = self._get_points(point_filter)
         points_spec = GraphSpec(roi=request[self.points].roi.copy())
@@ -105,10 +122,10 @@ class CsvPointsSource(BatchProvider):
 
     def _get_points(self, point_filter):
 
-        filtered = self.data[point_filter][:,:self.ndims]
+        filtered = self.data[point_filter][:, :self.ndims]
 
         if self.id_dim is not None:
-            ids = self.data[point_filter][:,self.id_dim]
+            ids = self.data[point_filter][:, self.id_dim]
         else:
             ids = np.arange(len(self.data))[point_filter]
 
@@ -117,6 +134,78 @@ class CsvPointsSource(BatchProvider):
             for i, p in zip(ids, filtered)
         ]
 
+    def _query(self, min_bb, max_bb):
+        '''Get the (sorted) indices of all points in ``[min_bb, max_bb)``.'''
+
+        locations = self.data[:, :self.ndims]
+        dims = locations.shape[1]
+
+        if len(locations) == 0:
+            return np.zeros((0,), dtype=int)
+
+        # range of cells overlapping with the query
+        first = np.floor((np.array(min_bb) - self.grid_origin)/self.cell_size)
+        last = np.floor((np.array(max_bb) - self.grid_origin)/self.cell_size)
+        first = np.clip(first, 0, np.array(self.grid_shape) - 1).astype(int)
+        last = np.clip(last, 0, np.array(self.grid_shape) - 1).astype(int)
+
+        # cells along the last dimension are stored next to each other, collect
+        # one slice of points per row of cells
+        candidates = []
+        for row in np.ndindex(*(last[:-1] - first[:-1] + 1)):
+            row = tuple(np.array(row) + first[:-1])
+            begin = np.ravel_multi_index(row + (first[-1],), self.grid_shape)
+            end = np.ravel_multi_index(row + (last[-1],), self.grid_shape) + 1
+            candidates.append(
+                self.cell_order[self.cell_starts[begin]:self.cell_starts[end]])
+
+        candidates = np.sort(np.concatenate(candidates))
+        candidate_locations = locations[candidates]
+
+        inside = np.ones((len(candidates),), dtype=bool)
+        for d in range(dims):
+            inside &= candidate_locations[:, d] >= min_bb[d]
+            inside &= candidate_locations[:, d] < max_bb[d]
+
+        return candidates[inside]
+
+    def _build_index(self):
+        '''Sort the points into a regular grid of cells, such that points in
+        a ROI can be found without looking at all points.'''
+
+        locations = self.data[:, :self.ndims]
+        num_points, dims = locations.shape
+
+        if num_points == 0:
+            return
+
+        self.grid_origin = np.amin(locations, axis=0).astype(np.float64)
+        extent = np.amax(locations, axis=0) - self.grid_origin
+        extent = np.maximum(extent, 1e-6)
+
+        # cubic cells, such that there are points_per_cell points per cell on
+        # average if the points are evenly distributed
+        num_cells = max(1, num_points//self.points_per_cell)
+        self.cell_size = float(
+            (np.prod(extent)/num_cells)**(1.0/dims))
+        # flat distributions would lead to too many cells
+        while True:
+            grid_shape = np.floor(extent/self.cell_size).astype(np.int64) + 1
+            if np.prod(grid_shape.astype(np.float64)) <= 2*num_cells:
+                break
+            self.cell_size *= 2
+        self.grid_shape = tuple(int(s) for s in grid_shape)
+
+        cells = np.floor((locations - self.grid_origin)/self.cell_size)
+        cells = np.clip(cells, 0, np.array(self.grid_shape) - 1).astype(np.int64)
+        cell_ids = np.ravel_multi_index(tuple(cells.T), self.grid_shape)
+
+        index_dtype = np.int32 if num_points < 2**31 else np.int64
+        self.cell_order = np.argsort(cell_ids, kind="stable").astype(index_dtype)
+        self.cell_starts = np.searchsorted(
+            cell_ids[self.cell_order],
+            np.arange(np.prod(self.grid_shape) + 1))
+
     def _parse_csv(self):
         '''Read one point per line. If ``ndims`` is None, all values in one line
         are considered as the location of the point. If positive, only the
@@ -124,14 +213,43 @@ class CsvPointsSource(BatchProvider):
         used.
         '''
 
-        with open(self.filename, "r") as f:
-            self.data = np.array(
-                [[float(t.strip(",")) for t in line.split()] for line in f],
-                dtype=np.float32,
-            )
+        cache_filename = self.filename + ".npy"
+
+        if self.binary_cache and self.__cache_valid(cache_filename):
+            logger.debug("reading points from %s", cache_filename)
+            self.data = np.load(cache_filename, mmap_mode="r")
+        else:
+            with open(self.filename, "r") as f:
+                self.data = np.array(
+                    [[float(t.strip(",")) for t in line.split()] for line in f],
+                    dtype=np.float32,
+                )
+            if self.binary_cache:
+                self.__write_cache(cache_filename)
 
         if self.ndims is None:
             self.ndims = self.data.shape[1]
 
         if self.scale is not None:
-            self.data[:,:self.ndims] *= self.scale
+            if not self.data.flags.writeable:
+                # memory-mapped cache
+                self.data = np.array(self.data)
+            self.data[:, :self.ndims] *= self.scale
+
+    def __cache_valid(self, cache_filename):
+
+        return (
+            os.path.exists(cache_filename) and
+            os.path.getmtime(cache_filename) >= os.path.getmtime(self.filename))
+
+    def __write_cache(self, cache_filename):
+
+        # write to a temporary file first, other processes might read the cache
+        # at the same time
+        tmp_filename = "%s.%d.tmp.npy" % (self.filename, os.getpid())
+        try:
+            np.save(tmp_filename, self.data)
+            os.replace(tmp_filename, cache_filename)
+        except OSError as e:
+            logger.warning(
+                "could not write points cache %s: %s", cache_filename, e)
@@ -1,5 +1,4 @@
 import logging
-import random
 import numpy as np
 
 # imports for deformed slice
@@ -104,8 +103,8 @@ class DefectAugment(BatchFilter):
             self.artifact_source.teardown()
 
     # send roi request to data-source upstream
-    def prepare(self, request):
-        random.seed(request.random_seed)
+    def prepare(self, request, context=None):
+        context = self._get_context(context, request)
         deps = BatchRequest()
 
         # we prepare the augmentations, by determining which slices
@@ -125,35 +124,36 @@ class DefectAugment(BatchFilter):
         raw_voxel_size = self.spec[self.intensities].voxel_size
 
         # store the mapping slice to augmentation type in a dict
-        self.slice_to_augmentation = {}
+        context.slice_to_augmentation = {}
         # store the transformations for deform slice
-        self.deform_slice_transformations = {}
+        context.deform_slice_transformations = {}
         for c in range((roi / raw_voxel_size).get_shape()[self.axis]):
-            r = random.random()
+            r = context.random.random()
 
             if r < prob_missing_threshold:
                 logger.debug("Zero-out " + str(c))
-                self.slice_to_augmentation[c] = 'zero_out'
+                context.slice_to_augmentation[c] = 'zero_out'
 
             elif r < prob_low_contrast_threshold:
                 logger.debug("Lower contrast " + str(c))
-                self.slice_to_augmentation[c] = 'lower_contrast'
+                context.slice_to_augmentation[c] = 'lower_contrast'
 
             elif r < prob_artifact_threshold:
                 logger.debug("Add artifact " + str(c))
-                self.slice_to_augmentation[c] = 'artifact'
+                context.slice_to_augmentation[c] = 'artifact'
 
             elif r < prob_deform_slice:
                 logger.debug("Add deformed slice " + str(c))
-                self.slice_to_augmentation[c] = 'deformed_slice'
+                context.slice_to_augmentation[c] = 'deformed_slice'
                 # get the shape of a single slice
                 slice_shape = (roi / raw_voxel_size).get_shape()
                 slice_shape = slice_shape[:self.axis] + slice_shape[self.axis+1:]
-                self.deform_slice_transformations[c] = self.__prepare_deform_slice(slice_shape)
+                context.deform_slice_transformations[c] = self.__prepare_deform_slice(
+                    slice_shape, context)
 
         # prepare transformation and
         # request bigger upstream roi for deformed slice
-        if 'deformed_slice' in self.slice_to_augmentation.values():
+        if 'deformed_slice' in context.slice_to_augmentation.values():
 
             # create roi sufficiently large to feed deformation
             logger.debug("before growth: %s" % spec.roi)
@@ -171,14 +171,16 @@ class DefectAugment(BatchFilter):
 
         deps[self.intensities] = spec
 
-    def process(self, batch, request):
+    def process(self, batch, request, context=None):
+
+        context = self._get_context(context)
 
         assert batch.get_total_roi().dims() == 3, "defectaugment works on 3d batches only"
 
         raw = batch.arrays[self.intensities]
         raw_voxel_size = self.spec[self.intensities].voxel_size
 
-        for c, augmentation_type in self.slice_to_augmentation.items():
+        for c, augmentation_type in context.slice_to_augmentation.items():
 
             section_selector = tuple(
                 slice(None if d != self.axis else c, None if d != self.axis else c+1)
@@ -231,7 +233,7 @@ class DefectAugment(BatchFilter):
                 interpolation = 3 if self.spec[self.intensities].interpolatable else 0
 
                 # load the deformation fields that were prepared for this slice
-                flow_x, flow_y, line_mask = self.deform_slice_transformations[c]
+                flow_x, flow_y, line_mask = context.deform_slice_transformations[c]
 
                 # apply the deformation fields
                 shape = section.shape
@@ -249,7 +251,7 @@ class DefectAugment(BatchFilter):
 
         # in case we needed to change the ROI due to a deformation augment,
         # restore original ROI and crop the array data
-        if 'deformed_slice' in self.slice_to_augmentation.values():
+        if 'deformed_slice' in context.slice_to_augmentation.values():
             old_roi = request[self.intensities].roi
             logger.debug("resetting roi to %s" % old_roi)
             crop = tuple(
@@ -259,20 +261,20 @@ class DefectAugment(BatchFilter):
             raw.data = raw.data[crop]
             raw.spec.roi = old_roi
 
-    def __prepare_deform_slice(self, slice_shape):
+    def __prepare_deform_slice(self, slice_shape, context):
 
         # grow slice shape by 2 x deformation strength
         grow_by = 2 * self.deformation_strength
         shape = (slice_shape[0] + grow_by, slice_shape[1] + grow_by)
 
         # randomly choose fixed x or fixed y with p = 1/2
-        fixed_x = random.random() < .5
+        fixed_x = context.random.random() < .5
         if fixed_x:
-            x0, y0 = 0, np.random.randint(1, shape[1] - 2)
-            x1, y1 = shape[0] - 1, np.random.randint(1, shape[1] - 2)
+            x0, y0 = 0, context.np_random.randint(1, shape[1] - 2)
+            x1, y1 = shape[0] - 1, context.np_random.randint(1, shape[1] - 2)
         else:
-            x0, y0 = np.random.randint(1, shape[0] - 2), 0
-            x1, y1 = np.random.randint(1, shape[0] - 2), shape[1] - 1
+            x0, y0 = context.np_random.randint(1, shape[0] - 2), 0
+            x1, y1 = context.np_random.randint(1, shape[0] - 2), shape[1] - 1
 
         ## generate the mask of the line that should be blacked out
         line_mask = np.zeros(shape, dtype='bool')
@@ -1,3 +1,4 @@
+import asyncio
 import logging
 import numpy as np
 
@@ -90,32 +91,37 @@ class DvidSource(BatchProvider):
         batch = Batch()
 
         for (array_key, request_spec) in request.array_specs.items():
+            batch.arrays[array_key] = self.__read(array_key, request_spec)
 
-            logger.debug("Reading %s in %s...", array_key, request_spec.roi)
+        logger.debug("done")
+
+        timing.stop()
+        batch.profiling_stats.add(timing)
+
+        return batch
 
-            voxel_size = self.spec[array_key].voxel_size
+    async def provide_async(self, request):
 
-            # scale request roi to voxel units
-            dataset_roi = request_spec.roi/voxel_size
+        loop = asyncio.get_running_loop()
 
-            # shift request roi into dataset
-            dataset_roi = dataset_roi - self.spec[array_key].roi.get_offset()/voxel_size
+        timing = Timing(self)
+        timing.start()
 
-            # create array spec
-            array_spec = self.spec[array_key].copy()
-            array_spec.roi = request_spec.roi
+        batch = Batch()
 
-            # read the data
-            if array_key in self.datasets:
-                data = self.__read_array(self.datasets[array_key], dataset_roi)
-            elif array_key in self.masks:
-                data = self.__read_mask(self.masks[array_key], dataset_roi)
-            else:
-                assert False, ("Encountered a request for %s that is neither a volume "
-                               "nor a mask."%array_key)
+        # send the requests for all arrays to the server at the same time
+        array_keys = list(request.array_specs.keys())
+        arrays = await asyncio.gather(*[
+            loop.run_in_executor(
+                None,
+                self.__read,
+                array_key,
+                request.array_specs[array_key])
+            for array_key in array_keys
+        ])
 
-            # add array to batch
-            batch.arrays[array_key] = Array(data, array_spec)
+        for array_key, array in zip(array_keys, arrays):
+            batch.arrays[array_key] = array
 
         logger.debug("done")
 
@@ -124,6 +130,33 @@ class DvidSource(BatchProvider):
 
         return batch
 
+    def __read(self, array_key, request_spec):
+
+        logger.debug("Reading %s in %s...", array_key, request_spec.roi)
+
+        voxel_size = self.spec[array_key].voxel_size
+
+        # scale request roi to voxel units
+        dataset_roi = request_spec.roi/voxel_size
+
+        # shift request roi into dataset
+        dataset_roi = dataset_roi - self.spec[array_key].roi.get_offset()/voxel_size
+
+        # create array spec
+        array_spec = self.spec[array_key].copy()
+        array_spec.roi = request_spec.roi
+
+        # read the data
+        if array_key in self.datasets:
+            data = self.__read_array(self.datasets[array_key], dataset_roi)
+        elif array_key in self.masks:
+            data = self.__read_mask(self.masks[array_key], dataset_roi)
+        else:
+            assert False, ("Encountered a request for %s that is neither a volume "
+                           "nor a mask." % array_key)
+
+        return Array(data, array_spec)
+
     def __get_info(self, array_key):
 
         if array_key in self.datasets:
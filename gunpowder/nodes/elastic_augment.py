@@ -1,7 +1,11 @@
+import concurrent.futures
 import logging
 import math
 import numpy as np
+import os
 import random
+import threading
+import warnings
 from scipy import ndimage
 
 from .batch_filter import BatchFilter
@@ -14,6 +18,199 @@ from gunpowder.array import ArrayKey
 logger = logging.getLogger(__name__)
 
 
+def _create_elastic_transformation(
+    shape, control_point_spacing, jitter_sigma, subsample, random_state
+):
+    """Like ``augment.create_elastic_transformation``, but drawing the control
+    point jitter from ``random_state`` instead of the global random state of
+    ``numpy``."""
+
+    dims = len(shape)
+    subsample_shape = tuple(max(1, int(s / subsample)) for s in shape)
+    spacing = np.broadcast_to(control_point_spacing, (dims,))
+    sigmas = np.broadcast_to(jitter_sigma, (dims,))
+
+    control_points = tuple(
+        max(1, int(round(float(shape[d]) / spacing[d])))
+        for d in range(dims)
+    )
+    control_point_offsets = np.zeros(
+        (dims,) + control_points, dtype=np.float32
+    )
+    for d in range(dims):
+        if sigmas[d] > 0:
+            control_point_offsets[d] = random_state.normal(
+                scale=sigmas[d], size=control_points
+            )
+
+    return augment.upscale_transformation(
+        control_point_offsets, subsample_shape, interpolate_order=3
+    )
+
+
+class DeformationFieldPool(object):
+    """A pool of elastic deformation fields, generated ahead of time by
+    background threads. See :class:`ElasticAugment`.
+
+    Fields are kept per shape. Each field is handed out up to ``reuse`` times
+    (randomly flipped along each axis every time) before it is replaced with a
+    newly generated one.
+
+    Fields are generated from unseeded random states, and which ones are in the
+    pool at the time of a request depends on the timing of the background
+    threads. Deformations taken from the pool can therefore not be reproduced
+    from the random seed of a request.
+    """
+
+    def __init__(
+        self,
+        control_point_spacing,
+        jitter_sigma,
+        subsample,
+        size,
+        reuse=1,
+        num_workers=1,
+    ):
+
+        self.control_point_spacing = control_point_spacing
+        self.jitter_sigma = jitter_sigma
+        self.subsample = subsample
+        self.size = size
+        self.reuse = reuse
+        self.num_workers = num_workers
+
+        # shape -> list of [field, number of uses]
+        self.fields = {}
+        # shape -> number of fields being generated
+        self.pending = {}
+        self.workers = []
+        self.workers_pid = None
+        self.stopped = False
+        self.condition = threading.Condition()
+        self.start_lock = threading.Lock()
+
+    def get(self, shape, random=random, np_random=np.random):
+        """Get a field for the given shape, as an array of shape
+        ``(dims,) + shape`` of displacements in voxels.
+
+        Which field is taken from the pool and how it is flipped is drawn from
+        ``random``, a field generated on the spot if the pool is empty from
+        ``np_random``. Pass generators seeded for the request to make these
+        choices reproducible (the fields in the pool are not, see
+        :class:`DeformationFieldPool`)."""
+
+        shape = tuple(shape)
+        self.__start_workers()
+
+        with self.condition:
+
+            entries = self.fields.setdefault(shape, [])
+            self.pending.setdefault(shape, 0)
+            if entries:
+                i = random.randrange(len(entries))
+                field = entries[i][0]
+                entries[i][1] += 1
+                if entries[i][1] >= self.reuse:
+                    del entries[i]
+                    self.condition.notify()
+            else:
+                field = None
+                # let the workers know about the new shape
+                self.condition.notify_all()
+
+        if field is None:
+            field = self.__generate(shape, np_random)
+            logger.debug("deformation field pool empty, generated a field")
+
+        # cheap variation: flipping an axis mirrors the field along it and
+        # inverts the displacements along that axis
+        for d in range(field.shape[0]):
+            if random.random() < 0.5:
+                field = np.flip(field, axis=d + 1)
+                field = field * np.array(
+                    [-1 if dd == d else 1 for dd in range(field.shape[0])],
+                    dtype=field.dtype,
+                ).reshape((-1,) + (1,) * (field.ndim - 1))
+
+        return field
+
+    def stop(self):
+        """Stop the background threads."""
+
+        if self.workers_pid != os.getpid():
+            return
+
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+        self.workers_pid = None
+
+    def __start_workers(self):
+
+        if self.workers_pid == os.getpid():
+            return
+
+        with self.start_lock:
+
+            # another thread might have started the workers in the meantime
+            if self.workers_pid == os.getpid():
+                return
+
+            # first call, or in a forked process: threads and locks of the
+            # parent are not usable here
+            self.condition = threading.Condition()
+            self.pending = {shape: 0 for shape in self.fields}
+            self.stopped = False
+            self.workers = [
+                threading.Thread(target=self.__run_worker, daemon=True)
+                for _ in range(self.num_workers)
+            ]
+            self.workers_pid = os.getpid()
+            for worker in self.workers:
+                worker.start()
+
+    def __run_worker(self):
+
+        # numpy's global random state is seeded per request, don't use it here
+        random_state = np.random.RandomState()
+
+        while True:
+
+            with self.condition:
+                while not self.stopped and self.__next_shape() is None:
+                    self.condition.wait()
+                if self.stopped:
+                    return
+                shape = self.__next_shape()
+                self.pending[shape] += 1
+
+            field = self.__generate(shape, random_state)
+
+            with self.condition:
+                self.pending[shape] -= 1
+                self.fields[shape].append([field, 0])
+
+    def __next_shape(self):
+
+        for shape, entries in self.fields.items():
+            if len(entries) + self.pending[shape] < self.size:
+                return shape
+        return None
+
+    def __generate(self, shape, random_state):
+
+        return _create_elastic_transformation(
+            shape,
+            self.control_point_spacing,
+            self.jitter_sigma,
+            self.subsample,
+            random_state,
+        )
+
+
 class ElasticAugment(BatchFilter):
     """Elasticly deform a batch. Requests larger batches upstream to avoid data 
     loss due to rotation and jitter.
@@ -78,14 +275,54 @@ class ElasticAugment(BatchFilter):
             1) Rasterize nodes into numpy array
             2) Apply elastic transform to array
             3) Read out nodes via center of mass of transformed points
-            You can gain substantial speed up as opposed to calculating the
-            elastic transform for each point individually. However this may
-            lead to nodes being lost during the transform.
+            This may lead to nodes being lost during the transform. Without
+            this option, all nodes are projected at once by inverting the
+            transformation, which is usually as fast.
+
+            Deprecated: the default projection is exact and not slower, this
+            option will be removed in a future version.
 
         recompute_missing_points (``bool``):
 
             Whether or not to compute the elastic transform node wise for nodes
             that were lossed during the fast elastic transform process.
+
+        deformation_pool_size (``int``):
+
+            If larger than 0, elastic deformation fields are generated ahead of
+            time by background threads and kept in a pool of this size (per
+            requested shape), see :class:`DeformationFieldPool`. Fields taken
+            from the pool are randomly flipped, rotation and scale are still
+            sampled for each request. Note that the elastic deformation is then
+            not reproducible from the random seed of the request anymore.
+
+        deformation_pool_reuse (``int``):
+
+            How many times a field from the pool can be used before it is
+            replaced by a new one.
+
+        deformation_pool_workers (``int``):
+
+            The number of background threads generating fields for the pool.
+
+        num_threads (``int``):
+
+            The number of threads to resample arrays with. If larger than 1,
+            each channel is split into slabs along the first spatial
+            dimension, and all slabs of all arrays are resampled in parallel.
+
+        use_sparse_transform (``bool``):
+
+            Instead of creating the transformation densely for the total
+            requested ROI, evaluate the control point displacements, rotation,
+            and scale only where needed: at the voxels of requested arrays and
+            at the locations of graph nodes. The upstream ROI of graphs is
+            derived from the displacement bounds. This is much faster for
+            requests that contain only graphs (or small arrays in a large graph
+            ROI). Graph nodes are projected to sub-voxel precision. Apart from
+            ``subsample`` (which is not used), the transformation is the same
+            as the dense one. Misalignment and the deformation pool are not
+            supported in this mode.
     """
 
     def __init__(
@@ -101,6 +338,11 @@ class ElasticAugment(BatchFilter):
         spatial_dims=3,
         use_fast_points_transform=False,
         recompute_missing_points=True,
+        deformation_pool_size=0,
+        deformation_pool_reuse=1,
+        deformation_pool_workers=1,
+        num_threads=1,
+        use_sparse_transform=False,
     ):
 
         self.control_point_spacing = control_point_spacing
@@ -115,16 +357,53 @@ class ElasticAugment(BatchFilter):
         self.subsample = subsample
         self.spatial_dims = spatial_dims
         self.use_fast_points_transform = use_fast_points_transform
+        if use_fast_points_transform:
+            warnings.warn(
+                "use_fast_points_transform is deprecated, the default "
+                "projection of graph nodes is exact and not slower",
+                DeprecationWarning,
+            )
         self.recompute_missing_points = recompute_missing_points
+        self.num_threads = num_threads
+        self.use_sparse_transform = use_sparse_transform
+        self.executor = None
+        self.executor_pid = None
+
+        if deformation_pool_size > 0:
+            self.deformation_pool = DeformationFieldPool(
+                control_point_spacing,
+                jitter_sigma,
+                subsample,
+                size=deformation_pool_size,
+                reuse=deformation_pool_reuse,
+                num_workers=deformation_pool_workers,
+            )
+        else:
+            self.deformation_pool = None
+
+        if use_sparse_transform:
+            assert (
+                prob_slip + prob_shift == 0
+            ), "misalignment is not supported with use_sparse_transform"
+            assert (
+                deformation_pool_size == 0
+            ), "deformation pool is not supported with use_sparse_transform"
+
+    def teardown(self):
+
+        if self.deformation_pool is not None:
+            self.deformation_pool.stop()
 
-    def prepare(self, request):
-        seed = request.random_seed
-        random.seed(seed)
-        # augment uses numpy for its randomness
-        np.random.seed(seed)
+        if self.executor is not None:
+            if self.executor_pid == os.getpid():
+                self.executor.shutdown()
+            self.executor = None
+
+    def prepare(self, request, context=None):
+        context = self._get_context(context, request)
 
         # get the voxel size
-        self.voxel_size = self.__get_common_voxel_size(request)
+        context.voxel_size = self.__get_common_voxel_size(request)
 
         # get the total ROI of all requests
         total_roi = request.get_total_roi()
@@ -138,15 +417,15 @@ class ElasticAugment(BatchFilter):
             total_roi.get_begin()[-self.spatial_dims :],
             total_roi.get_shape()[-self.spatial_dims :],
         )
-        self.spatial_dims = master_roi.dims()
+        context.spatial_dims = master_roi.dims()
         logger.debug("master ROI is %s" % master_roi)
 
         # make sure the master ROI aligns with the voxel size
-        master_roi = master_roi.snap_to_grid(self.voxel_size, mode="grow")
+        master_roi = master_roi.snap_to_grid(context.voxel_size, mode="grow")
         logger.debug("master ROI aligned with voxel size is %s" % master_roi)
 
         # get master roi in voxels
-        master_roi_voxels = master_roi / self.voxel_size
+        master_roi_voxels = master_roi / context.voxel_size
         logger.debug("master ROI in voxels is %s" % master_roi_voxels)
 
         # Second, create a master transformation. This is a transformation that
@@ -154,18 +433,26 @@ class ElasticAugment(BatchFilter):
         # is zero-based.
 
         # create a transformation with the size of the master ROI in voxels
-        self.master_transformation = self.__create_transformation(
-            master_roi_voxels.get_shape()
-        )
+        if self.use_sparse_transform:
+            context.sparse_transformation = self.__create_sparse_transformation(
+                master_roi_voxels.get_shape(), context
+            )
+        else:
+            context.master_transformation = self._create_master_transformation(
+                master_roi_voxels.get_shape(), context.voxel_size, context
+            )
+        context.master_roi = master_roi
 
         # Third, crop out parts of the master transformation for each of the
         # smaller requested ROIs. Since these ROIs now have to align with the
         # voxel size (which for points does not have to be the case), we also
         # remember these smaller ROIs as target_rois in global world units.
 
-        # crop the parts corresponding to the requested ROIs
-        self.transformations = {}
-        self.target_rois = {}
+        # crop the parts corresponding to the requested ROIs, keys with the
+        # same target ROI share their transformation
+        context.transformations = {}
+        context.target_rois = {}
+        shared = {}
         deps = BatchRequest()
         for key, spec in request.items():
 
@@ -175,14 +462,14 @@ class ElasticAugment(BatchFilter):
                 continue
 
             target_roi = Roi(
-                spec.roi.get_begin()[-self.spatial_dims :],
-                spec.roi.get_shape()[-self.spatial_dims :],
+                spec.roi.get_begin()[-context.spatial_dims :],
+                spec.roi.get_shape()[-context.spatial_dims :],
             )
             logger.debug("downstream request spatial ROI for %s is %s", key, target_roi)
 
             # make sure the target ROI aligns with the voxel grid (which might
             # not be the case for points)
-            target_roi = target_roi.snap_to_grid(self.voxel_size, mode="grow")
+            target_roi = target_roi.snap_to_grid(context.voxel_size, mode="grow")
             logger.debug(
                 "downstream request spatial ROI aligned with voxel grid for %s "
                 "is %s",
@@ -192,51 +479,78 @@ class ElasticAugment(BatchFilter):
 
             # remember target ROI (this is where the transformation will project
             # to)
-            self.target_rois[key] = target_roi
+            context.target_rois[key] = target_roi
 
-            # get ROI in voxels
-            target_roi_voxels = target_roi / self.voxel_size
+            # in sparse mode, graphs don't need a dense transformation
+            dense = isinstance(key, ArrayKey) or not self.use_sparse_transform
 
-            # get ROI relative to master ROI
-            target_roi_in_master_roi_voxels = (
-                target_roi_voxels - master_roi_voxels.get_begin()
-            )
+            roi_key = (target_roi.get_begin(), target_roi.get_shape(), dense)
+            if roi_key not in shared:
 
-            # crop out relevant part of transformation for this request
-            transformation = np.copy(
-                self.master_transformation[
-                    (slice(None),) + target_roi_in_master_roi_voxels.get_bounding_box()
-                ]
-            )
-            self.transformations[key] = transformation
-
-            # get ROI of all voxels necessary to perfrom transformation
-            #
-            # for that we follow the same transformations to get from the
-            # request ROI to the target ROI in master ROI in voxels, just in
-            # reverse
-            source_roi_in_master_roi_voxels = self.__get_source_roi(transformation)
-            source_roi_voxels = (
-                source_roi_in_master_roi_voxels + master_roi_voxels.get_begin()
-            )
-            source_roi = source_roi_voxels * self.voxel_size
-
-            # transformation is still defined on voxels relative to master ROI
-            # in voxels (i.e., lowest source coordinate could be 5, but data
-            # array we get later starts at 0).
-            #
-            # shift transformation to be indexed relative to beginning of
-            # source_roi_voxels
-            self.__shift_transformation(
-                -source_roi_in_master_roi_voxels.get_begin(), transformation
-            )
+                # get ROI in voxels
+                target_roi_voxels = target_roi / context.voxel_size
+
+                # get ROI relative to master ROI
+                target_roi_in_master_roi_voxels = (
+                    target_roi_voxels - master_roi_voxels.get_begin()
+                )
+
+                # crop out relevant part of transformation for this request
+                if not dense:
+                    transformation = None
+                elif self.use_sparse_transform:
+                    transformation = self.__evaluate_sparse_grid(
+                        context.sparse_transformation,
+                        target_roi_in_master_roi_voxels,
+                    )
+                else:
+                    transformation = np.copy(
+                        context.master_transformation[
+                            (slice(None),) + target_roi_in_master_roi_voxels.get_bounding_box()
+                        ]
+                    )
+
+                # get ROI of all voxels necessary to perfrom transformation
+                #
+                # for that we follow the same transformations to get from the
+                # request ROI to the target ROI in master ROI in voxels, just in
+                # reverse
+                if transformation is None:
+                    source_roi_in_master_roi_voxels = self.__get_sparse_source_roi(
+                        context.sparse_transformation,
+                        target_roi_in_master_roi_voxels,
+                    )
+                else:
+                    source_roi_in_master_roi_voxels = self.__get_source_roi(
+                        transformation
+                    )
+                source_roi_voxels = (
+                    source_roi_in_master_roi_voxels + master_roi_voxels.get_begin()
+                )
+                source_roi = source_roi_voxels * context.voxel_size
+
+                # transformation is still defined on voxels relative to master ROI
+                # in voxels (i.e., lowest source coordinate could be 5, but data
+                # array we get later starts at 0).
+                #
+                # shift transformation to be indexed relative to beginning of
+                # source_roi_voxels
+                if transformation is not None:
+                    self.__shift_transformation(
+                        -source_roi_in_master_roi_voxels.get_begin(), transformation
+                    )
+
+                shared[roi_key] = (transformation, source_roi)
+
+            transformation, source_roi = shared[roi_key]
+            context.transformations[key] = transformation
 
             # update upstream request
             spec.roi = Roi(
-                spec.roi.get_begin()[: -self.spatial_dims]
-                + source_roi.get_begin()[-self.spatial_dims :],
-                spec.roi.get_shape()[: -self.spatial_dims]
-                + source_roi.get_shape()[-self.spatial_dims :],
+                spec.roi.get_begin()[: -context.spatial_dims]
+                + source_roi.get_begin()[-context.spatial_dims :],
+                spec.roi.get_shape()[: -context.spatial_dims]
+                + source_roi.get_shape()[-context.spatial_dims :],
             )
 
             deps[key] = spec
@@ -245,64 +559,78 @@ class ElasticAugment(BatchFilter):
 
         return deps
 
-    def process(self, batch, request):
+    def process(self, batch, request, context=None):
+
+        context = self._get_context(context)
 
+        resample_jobs = []
         for (array_key, array) in batch.arrays.items():
 
-            if array_key not in self.target_rois:
+            if array_key not in context.target_rois:
                 continue
 
             # for arrays, the target ROI and the requested ROI should be the
             # same in spatial coordinates
             assert (
-                self.target_rois[array_key].get_begin()
-                == request[array_key].roi.get_begin()[-self.spatial_dims :]
+                context.target_rois[array_key].get_begin()
+                == request[array_key].roi.get_begin()[-context.spatial_dims :]
             ), "Target roi offset {} does not match request roi offset {}".format(
-                self.target_rois[array_key].get_begin(),
-                request[array_key].roi.get_begin()[-self.spatial_dims :],
+                context.target_rois[array_key].get_begin(),
+                request[array_key].roi.get_begin()[-context.spatial_dims :],
             )
 
             assert (
-                self.target_rois[array_key].get_shape()
-                == request[array_key].roi.get_shape()[-self.spatial_dims :]
+                context.target_rois[array_key].get_shape()
+                == request[array_key].roi.get_shape()[-context.spatial_dims :]
             ), "Target roi offset {} does not match request roi offset {}".format(
-                self.target_rois[array_key].get_shape(),
-                request[array_key].roi.get_shape()[-self.spatial_dims :],
+                context.target_rois[array_key].get_shape(),
+                request[array_key].roi.get_shape()[-context.spatial_dims :],
             )
 
             # reshape array data into (channels,) + spatial dims
             shape = array.data.shape
-            channel_shape = shape[: -self.spatial_dims]
-            data = array.data.reshape((-1,) + shape[-self.spatial_dims :])
+            channel_shape = shape[: -context.spatial_dims]
+            data = array.data.reshape((-1,) + shape[-context.spatial_dims :])
 
-            # apply transformation on each channel
-            data = np.array(
-                [
-                    augment.apply_transformation(
-                        data[c],
-                        self.transformations[array_key],
-                        interpolate=self.spec[array_key].interpolatable,
-                    )
-                    for c in range(data.shape[0])
-                ]
+            # resample into a preallocated array, see __resample
+            transformation = context.transformations[array_key]
+            resampled = np.empty(
+                data.shape[:1] + transformation.shape[1:], dtype=data.dtype
+            )
+            resample_jobs.append(
+                (
+                    data,
+                    transformation,
+                    self.spec[array_key].interpolatable,
+                    resampled,
+                )
             )
 
-            data_roi = request[array_key].roi/self.spec[array_key].voxel_size
-            array.data = data.reshape(channel_shape + data_roi.get_shape()[-self.spatial_dims:])
+            array.data = resampled.reshape(channel_shape + transformation.shape[1:])
 
             # restore original ROIs
             array.spec.roi = request[array_key].roi
 
+        self.__resample(resample_jobs)
+
         for (graph_key, graph) in batch.graphs.items():
 
+            if self.use_sparse_transform:
+                self.__sparse_point_projection(
+                    context, graph, request[graph_key].roi
+                )
+                graph.spec.roi = request[graph_key].roi
+                continue
+
             nodes = list(graph.nodes)
 
             if self.use_fast_points_transform:
                 missed_nodes = self.__fast_point_projection(
-                    self.transformations[graph_key],
+                    context,
+                    context.transformations[graph_key],
                     nodes,
                     graph.spec.roi,
-                    target_roi=self.target_rois[graph_key],
+                    target_roi=context.target_rois[graph_key],
                 )
                 if not self.recompute_missing_points:
                     for node in set(missed_nodes):
@@ -311,43 +639,48 @@ class ElasticAugment(BatchFilter):
             else:
                 missed_nodes = nodes
 
-            for node in missed_nodes:
-                # logger.debug("projecting %s", node.location)
-
-                # get location relative to beginning of upstream ROI
-                location = node.location - graph.spec.roi.get_begin()
-                logger.debug("relative to upstream ROI: %s", location)
+            # get spatial coordinates of nodes in voxels, relative to
+            # beginning of upstream ROI
+            locations = np.array(
+                [node.location for node in missed_nodes], dtype=np.float64
+            ).reshape((len(missed_nodes), graph.spec.roi.dims()))
+            locations_voxels = (
+                locations[:, -context.spatial_dims :]
+                - graph.spec.roi.get_begin()[-context.spatial_dims :]
+            ) / context.voxel_size
+
+            # get projected locations in transformation data space, this
+            # yields voxel coordinates relative to target ROI
+            projected_voxels, inside = self.__project_all(
+                context.transformations[graph_key], locations_voxels
+            )
 
-                # get spatial coordinates of node in voxels
-                location_voxels = location[-self.spatial_dims :] / self.voxel_size
+            for node, location_voxels, projected, node_inside in zip(
+                missed_nodes, locations_voxels, projected_voxels, inside
+            ):
 
-                # get projected location in transformation data space, this
-                # yields voxel coordinates relative to target ROI
-                projected_voxels = self.__project(
-                    self.transformations[graph_key], location_voxels
-                )
+                if projected is None:
+                    # fall back to a grid search
+                    projected = self.__project(
+                        context.transformations[graph_key], location_voxels
+                    )
+                    node_inside = projected is not None
 
                 logger.debug(
-                    "projected in voxels, relative to target ROI: %s", projected_voxels
+                    "projected in voxels, relative to target ROI: %s", projected
                 )
 
-                if projected_voxels is None:
+                if not node_inside:
                     logger.debug("node outside of target, skipping")
                     graph.remove_node(node, retain_connectivity=True)
                     continue
 
-                # convert to world units (now in float again)
-                projected = projected_voxels * np.array(self.voxel_size)
-
-                logger.debug(
-                    "projected in world units, relative to target ROI: %s",
-                    projected)
-
-                # get global coordinates
-                projected += np.array(self.target_rois[graph_key].get_begin())
+                # convert to world units and get global coordinates
+                projected = projected * np.array(context.voxel_size)
+                projected += np.array(context.target_rois[graph_key].get_begin())
 
                 # update spatial coordinates of node location
-                node.location[-self.spatial_dims:] = projected
+                node.location[-context.spatial_dims:] = projected
 
                 logger.debug("final location: %s", node.location)
 
@@ -362,6 +695,60 @@ class ElasticAugment(BatchFilter):
             # restore original ROIs
             graph.spec.roi = request[graph_key].roi
 
+    def __resample(self, jobs):
+        """Apply the transformations of all jobs ``(data, transformation,
+        interpolate, out)`` to each channel of the data, writing into ``out``.
+        Arrays with the same target ROI share their transformation, such that
+        the sampling coordinates are computed only once per target ROI."""
+
+        if self.num_threads > 1:
+            num_slabs = self.num_threads
+        else:
+            num_slabs = 1
+
+        tasks = []
+        for data, transformation, interpolate, out in jobs:
+
+            # split the first spatial dimension into slabs
+            size = transformation.shape[1]
+            bounds = np.linspace(0, size, min(num_slabs, size) + 1).astype(int)
+
+            for c in range(data.shape[0]):
+                for begin, end in zip(bounds[:-1], bounds[1:]):
+                    tasks.append(
+                        (
+                            data[c],
+                            transformation[:, begin:end],
+                            interpolate,
+                            out[c, begin:end],
+                        )
+                    )
+
+        def resample(task):
+            data, transformation, interpolate, out = task
+            augment.apply_transformation(
+                data, transformation, interpolate=interpolate, output=out
+            )
+
+        if self.num_threads > 1 and len(tasks) > 1:
+            # map_coordinates releases the GIL, threads run in parallel
+            list(self.__get_executor().map(resample, tasks))
+        else:
+            for task in tasks:
+                resample(task)
+
+    def __get_executor(self):
+
+        # the pool's threads do not survive a fork, create a new pool in
+        # worker processes
+        if self.executor is None or self.executor_pid != os.getpid():
+            self.executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.num_threads
+            )
+            self.executor_pid = os.getpid()
+
+        return self.executor
+
     def __get_common_voxel_size(self, request):
 
         voxel_size = None
@@ -377,28 +764,56 @@ class ElasticAugment(BatchFilter):
                                 prev, self.spec[prev].voxel_size)
             prev = array_key
 
+        if voxel_size is None:
+            # no arrays requested, use the voxel size of the ones provided
+            for array_key, spec in self.spec.array_specs.items():
+                if spec.voxel_size is not None:
+                    voxel_size = spec.voxel_size[-self.spatial_dims:]
+                    break
+
+        if voxel_size is None and self.use_sparse_transform:
+            # graphs only, measure control point spacing in world units
+            dims = min(self.spatial_dims, request.get_total_roi().dims())
+            voxel_size = Coordinate((1,) * dims)
+
         if voxel_size is None:
             raise RuntimeError("voxel size must not be None")
 
         return voxel_size
 
-    def __create_transformation(self, target_shape):
+    def _create_master_transformation(self, target_shape, voxel_size, context):
+        """Create the transformation for the master ROI of the given shape (in
+        voxels), drawing random numbers from the generators of ``context``.
+        Subclasses can override this to compose further transformations, see
+        :class:`FusedAugment`."""
 
-        scale = self.scale_min + random.random()*(
+        return self.__create_transformation(target_shape, context)
+
+    def __create_transformation(self, target_shape, context):
+
+        scale = self.scale_min + context.random.random()*(
             self.scale_max - self.scale_min
         )
 
         transformation = augment.create_identity_transformation(
             target_shape, subsample=self.subsample, scale=scale
         )
-        if sum(self.jitter_sigma) > 0:
-            transformation += augment.create_elastic_transformation(
+        if sum(self.jitter_sigma) > 0 and self.deformation_pool is not None:
+            transformation += self.deformation_pool.get(
+                target_shape, context.random, context.np_random
+            )
+        elif sum(self.jitter_sigma) > 0:
+            transformation += _create_elastic_transformation(
                 target_shape,
                 self.control_point_spacing,
                 self.jitter_sigma,
-                subsample=self.subsample,
+                self.subsample,
+                context.np_random,
             )
-        rotation = random.random() * self.rotation_max_amount + self.rotation_start
+        rotation = (
+            context.random.random() * self.rotation_max_amount
+            + self.rotation_start
+        )
         if rotation != 0:
             transformation += augment.create_rotation_transformation(
                 target_shape, rotation, subsample=self.subsample
@@ -410,12 +825,264 @@ class ElasticAugment(BatchFilter):
             )
 
         if self.prob_slip + self.prob_shift > 0:
-            self.__misalign(transformation)
+            self.__misalign(transformation, context)
 
         return transformation
 
+    def __create_sparse_transformation(self, target_shape, context):
+        """Create the parameters of a transformation that can be evaluated at
+        arbitrary locations, see :func:`__evaluate_sparse`. Uses the random
+        numbers in the same order as :func:`__create_transformation`."""
+
+        dims = len(target_shape)
+
+        scale = self.scale_min + context.random.random()*(
+            self.scale_max - self.scale_min
+        )
+
+        # affine part: scaling around the center voxel (like
+        # augment.create_identity_transformation)
+        center = np.array([s // 2 for s in target_shape], dtype=np.float64)
+        matrix = np.identity(dims) / scale
+        offset = center - center / scale
+
+        # control point displacements, filtered for cubic spline interpolation
+        # (like augment.create_elastic_transformation)
+        if sum(self.jitter_sigma) > 0:
+            spacing = np.broadcast_to(self.control_point_spacing, (dims,))
+            sigmas = np.broadcast_to(self.jitter_sigma, (dims,))
+            control_points = tuple(
+                max(1, int(round(float(target_shape[d]) / spacing[d])))
+                for d in range(dims)
+            )
+            control_point_offsets = np.zeros(
+                (dims,) + control_points, dtype=np.float32
+            )
+            for d in range(dims):
+                if sigmas[d] > 0:
+                    control_point_offsets[d] = context.np_random.normal(
+                        scale=sigmas[d], size=control_points
+                    )
+            coefficients = np.array(
+                [
+                    ndimage.spline_filter(
+                        control_point_offsets[d].astype(np.float64),
+                        order=3,
+                        mode="constant",
+                    )
+                    for d in range(dims)
+                ]
+            )
+            # voxels to control point coordinates (like ndimage.zoom)
+            control_point_scale = np.array(
+                [
+                    (control_points[d] - 1) / (target_shape[d] - 1)
+                    if target_shape[d] > 1
+                    else 0
+                    for d in range(dims)
+                ]
+            )
+        else:
+            coefficients = None
+            control_point_scale = None
+
+        # rotation in the last two dimensions around the center of the ROI
+        # (like augment.create_rotation_transformation)
+        rotation = (
+            context.random.random() * self.rotation_max_amount
+            + self.rotation_start
+        )
+        if rotation != 0:
+            rotation_center = np.array(
+                [0.5 * (s - 1) for s in target_shape], dtype=np.float64
+            )
+            rotation_matrix = np.identity(dims)
+            rotation_matrix[-2:, -2:] = [
+                [math.cos(rotation), math.sin(rotation)],
+                [-math.sin(rotation), math.cos(rotation)],
+            ]
+            displacement = rotation_matrix - np.identity(dims)
+            matrix = matrix + displacement
+            offset = offset - np.dot(displacement, rotation_center)
+
+        return {
+            "matrix": matrix,
+            "offset": offset,
+            "coefficients": coefficients,
+            "control_point_scale": control_point_scale,
+        }
+
+    def __evaluate_sparse(self, sparse_transformation, locations):
+        """Get the source locations of the given target locations (an array
+        of shape ``(n, dims)`` in voxels relative to the master ROI)."""
+
+        matrix = sparse_transformation["matrix"]
+        coefficients = sparse_transformation["coefficients"]
+
+        sources = np.dot(locations, matrix.T) + sparse_transformation["offset"]
+
+        if coefficients is not None:
+
+            # outside of the master ROI, continue the displacements of the
+            # boundary
+            control_point_locations = np.clip(
+                locations * sparse_transformation["control_point_scale"],
+                0,
+                np.array(coefficients.shape[1:]) - 1,
+            )
+            for d in range(len(coefficients)):
+                sources[:, d] += ndimage.map_coordinates(
+                    coefficients[d],
+                    control_point_locations.T,
+                    order=3,
+                    mode="constant",
+                    prefilter=False,
+                    output=np.float64,
+                )
+
+        return sources
+
+    def __evaluate_sparse_grid(self, sparse_transformation, roi):
+        """Evaluate the sparse transformation for each voxel in ``roi``,
+        yielding a dense transformation like :func:`__create_transformation`.
+        """
+
+        grid = np.meshgrid(
+            *[
+                np.arange(b, e, dtype=np.float64)
+                for b, e in zip(roi.get_begin(), roi.get_end())
+            ],
+            indexing="ij",
+        )
+        locations = np.stack([g.ravel() for g in grid], axis=1)
+        sources = self.__evaluate_sparse(sparse_transformation, locations)
+
+        return sources.T.reshape((roi.dims(),) + roi.get_shape()).astype(np.float32)
+
+    def __get_sparse_source_roi(self, sparse_transformation, roi):
+        """Like :func:`__get_source_roi`, but evaluates the transformation only
+        on a grid of a quarter of the control point spacing."""
+
+        dims = roi.dims()
+        spacing = np.broadcast_to(self.control_point_spacing, (dims,))
+
+        # sample the ROI, including its last voxel
+        samples = []
+        for d in range(dims):
+            step = max(1, int(spacing[d] / 4))
+            begin, end = roi.get_begin()[d], roi.get_end()[d]
+            samples.append(np.unique(np.append(np.arange(begin, end, step), end - 1)))
+        grid = np.meshgrid(*samples, indexing="ij")
+        locations = np.stack([g.ravel() for g in grid], axis=1).astype(np.float64)
+        sources = self.__evaluate_sparse(sparse_transformation, locations)
+
+        # the affine part is extremal at the corners, which are sampled, the
+        # displacements might be larger between samples: add the largest
+        # difference between neighboring samples as a margin
+        displacements = sources - (
+            np.dot(locations, sparse_transformation["matrix"].T)
+            + sparse_transformation["offset"]
+        )
+        displacements = displacements.T.reshape((dims,) + grid[0].shape)
+        margin = np.zeros(dims)
+        for d in range(dims):
+            for axis in range(dims):
+                if displacements.shape[1 + axis] > 1:
+                    margin[d] = max(
+                        margin[d],
+                        np.abs(np.diff(displacements[d], axis=axis)).max(),
+                    )
+
+        bb_min = Coordinate(
+            int(math.floor(sources[:, d].min() - margin[d])) for d in range(dims)
+        )
+        bb_max = Coordinate(
+            int(math.ceil(sources[:, d].max() + margin[d])) + 1 for d in range(dims)
+        )
+
+        return Roi(bb_min, bb_max - bb_min)
+
+    def __sparse_point_projection(self, context, graph, request_roi):
+
+        nodes = list(graph.nodes)
+        if len(nodes) == 0:
+            return
+
+        voxel_size = np.array(context.voxel_size)
+        master_begin = np.array(context.master_roi.get_begin())
+        sparse_transformation = context.sparse_transformation
+
+        # source locations in voxels relative to the master ROI
+        locations = graph.locations_array()[:, -context.spatial_dims :]
+        sources = (locations - master_begin) / voxel_size
+
+        # start with the inverse of the affine part, refine with the
+        # displacements
+        initial = np.linalg.solve(
+            sparse_transformation["matrix"],
+            (sources - sparse_transformation["offset"]).T,
+        ).T
+        projected, converged = self.__invert(
+            lambda x: self.__evaluate_sparse(sparse_transformation, x),
+            sources,
+            initial,
+        )
+
+        projected = projected * voxel_size + master_begin
+
+        for node, location, valid in zip(nodes, projected, converged):
+
+            if not valid:
+                logger.debug("projection of %s did not converge, skipping", node)
+                graph.remove_node(node, retain_connectivity=True)
+                continue
+
+            node.location[-context.spatial_dims :] = location
+
+            if not request_roi.contains(node.location):
+                logger.debug("node outside of target, skipping")
+                graph.remove_node(node, retain_connectivity=True)
+
+    def __invert(
+        self, transform, sources, initial, step=1e-3, tolerance=1e-3, max_iterations=20
+    ):
+        """Find target locations that ``transform`` maps to ``sources``
+        (arrays of shape ``(n, dims)``), starting from ``initial``. Uses
+        Newton's method with Jacobians from finite differences. Returns the
+        target locations and a mask of the ones that converged."""
+
+        targets = np.array(initial, dtype=np.float64)
+        num_locations, dims = targets.shape
+        converged = np.zeros(num_locations, dtype=bool)
+        active = np.arange(num_locations)
+
+        for _ in range(max_iterations + 1):
+
+            values = transform(targets[active])
+            residuals = values - sources[active]
+            done = (np.abs(residuals) < tolerance).all(axis=1)
+            converged[active[done]] = True
+
+            active = active[~done]
+            if len(active) == 0:
+                break
+            values = values[~done]
+            residuals = residuals[~done]
+
+            jacobians = np.empty((len(active), dims, dims))
+            for d in range(dims):
+                shifted = targets[active]
+                shifted[:, d] += step
+                jacobians[:, :, d] = (transform(shifted) - values) / step
+
+            targets[active] -= np.matmul(
+                np.linalg.pinv(jacobians), residuals[:, :, np.newaxis]
+            )[:, :, 0]
+
+        return targets, converged
+
     def __fast_point_projection(
-        self, transformation, nodes, source_roi, target_roi
+        self, context, transformation, nodes, source_roi, target_roi
     ):
         if len(nodes) < 1:
             return []
@@ -425,7 +1092,7 @@ class ElasticAugment(BatchFilter):
                 (
                     node.id,
                     (np.floor(node.location).astype(int) - source_roi.get_begin())
-                    // self.voxel_size,
+                    // context.voxel_size,
                 )
                 for node in nodes
                 if source_roi.contains(node.location)
@@ -433,13 +1100,13 @@ class ElasticAugment(BatchFilter):
         )
         ids, locs = np.array(ids), tuple(zip(*locs))
         points_array = np.zeros(
-            source_roi.get_shape() / self.voxel_size, dtype=np.int64
+            source_roi.get_shape() / context.voxel_size, dtype=np.int64
         )
         points_array[locs] = ids
 
         # reshape array data into (channels,) + spatial dims
         shape = points_array.shape
-        data = points_array.reshape((-1,) + shape[-self.spatial_dims :])
+        data = points_array.reshape((-1,) + shape[-context.spatial_dims :])
 
         # apply transformation on each channel
         data = np.array(
@@ -454,7 +1121,7 @@ class ElasticAugment(BatchFilter):
         missing_points = []
         projected_locs = ndimage.measurements.center_of_mass(data > 0, data, ids)
         projected_locs = [
-            np.array(loc[-self.spatial_dims :]) * self.voxel_size
+            np.array(loc[-context.spatial_dims :]) * context.voxel_size
             + target_roi.get_begin()
             for loc in projected_locs
         ]
@@ -463,11 +1130,11 @@ class ElasticAugment(BatchFilter):
             point = node_dict.pop(point_id)
             if not any([np.isnan(x) for x in proj_loc]):
                 assert (
-                    len(proj_loc) == self.spatial_dims
+                    len(proj_loc) == context.spatial_dims
                 ), "projected location has wrong number of dimensions: {}, expected: {}".format(
-                    len(proj_loc), self.spatial_dims
+                    len(proj_loc), context.spatial_dims
                 )
-                point.location[-self.spatial_dims :] = proj_loc
+                point.location[-context.spatial_dims :] = proj_loc
             else:
                 missing_points.append(point)
         for node in node_dict.values():
@@ -480,6 +1147,76 @@ class ElasticAugment(BatchFilter):
 
         return missing_points
 
+    def __project_all(self, transformation, locations):
+        """Find the projections of all locations (an array of shape ``(n,
+        dims)``) given by transformation, by inverting the linearly
+        interpolated transformation. Returns the projections (snapped to the
+        grid) and whether they lie inside of the transformation. Projections
+        that could not be found are ``None``."""
+
+        num_locations, dims = locations.shape
+        shape = np.array(transformation.shape[1:])
+        projected = np.zeros((num_locations, dims))
+
+        # dimensions without spatial extent stay at 0
+        axes = np.flatnonzero(shape > 1)
+        if num_locations == 0 or len(axes) == 0:
+            return list(projected), np.ones(num_locations, dtype=bool)
+        field = transformation[axes][
+            (slice(None),) + tuple(slice(None) if s > 1 else 0 for s in shape)
+        ]
+        field_shape = shape[axes]
+
+        # approximate the transformation with an affine one, to get initial
+        # guesses and to continue the transformation outside of its grid
+        samples = np.meshgrid(
+            *[
+                np.unique(np.append(np.arange(0, s, max(1, s // 8)), s - 1))
+                for s in field_shape
+            ],
+            indexing="ij",
+        )
+        sample_locations = np.stack([g.ravel() for g in samples], axis=1)
+        sample_values = field[(slice(None),) + tuple(samples)].reshape(
+            (len(axes), -1)
+        ).T
+        affine, _, _, _ = np.linalg.lstsq(
+            np.concatenate(
+                [sample_locations, np.ones((len(sample_locations), 1))], axis=1
+            ),
+            sample_values,
+            rcond=None,
+        )
+        matrix, offset = affine[:-1].T, affine[-1]
+
+        def transform(targets):
+            clipped = np.clip(targets, 0, field_shape - 1)
+            values = np.array(
+                [
+                    ndimage.map_coordinates(
+                        field[d], clipped.T, order=1, output=np.float64
+                    )
+                    for d in range(len(axes))
+                ]
+            ).T
+            return values + np.dot(targets - clipped, matrix.T)
+
+        sources = locations[:, axes]
+        initial = np.dot(sources - offset, np.linalg.pinv(matrix).T)
+        targets, converged = self.__invert(transform, sources, initial)
+
+        inside = np.logical_and(
+            targets >= -0.5, targets <= field_shape - 0.5
+        ).all(axis=1)
+
+        # like __project, snap to the closest grid point
+        projected[:, axes] = np.clip(np.round(targets), 0, field_shape - 1)
+
+        return (
+            [p if c else None for p, c in zip(projected, converged)],
+            inside,
+        )
+
     def __project(self, transformation, location):
         """Find the projection of location given by transformation. Returns None
         if projection lies outside of transformation."""
@@ -583,7 +1320,7 @@ class ElasticAugment(BatchFilter):
         for d in range(transformation.shape[0]):
             transformation[d] += shift[d]
 
-    def __misalign(self, transformation):
+    def __misalign(self, transformation, context):
 
         assert (
             transformation.shape[0] == 3
@@ -594,15 +1331,15 @@ class ElasticAugment(BatchFilter):
         shifts = [Coordinate((0, 0, 0))] * num_sections
         for z in range(num_sections):
 
-            r = random.random()
+            r = context.random.random()
 
             if r <= self.prob_slip:
 
-                shifts[z] = self.__random_offset()
+                shifts[z] = self.__random_offset(context)
 
             elif r <= self.prob_slip + self.prob_shift:
 
-                offset = self.__random_offset()
+                offset = self.__random_offset(context)
                 for zp in range(z, num_sections):
                     shifts[zp] += offset
 
@@ -626,12 +1363,13 @@ class ElasticAugment(BatchFilter):
             + str(bb_max)
         )
 
-    def __random_offset(self):
+    def __random_offset(self, context):
 
         return Coordinate(
             (0,)
             + tuple(
-                self.max_misalign - random.randint(0, 2 * int(self.max_misalign))
+                self.max_misalign
+                - context.random.randint(0, 2 * int(self.max_misalign))
                 for d in range(2)
             )
         )
@@ -0,0 +1,226 @@
+import logging
+
+import numpy as np
+
+from .elastic_augment import ElasticAugment
+from .shift_augment import ShiftAugment
+from gunpowder.coordinate import Coordinate
+
+logger = logging.getLogger(__name__)
+
+
+class FusedAugment(ElasticAugment):
+    """Randomly mirror, transpose, elastically deform, and shift sections of
+    all :class:`Arrays<Array>` and :class:`Graphs<Graph>` in a batch.
+
+    This is equivalent to a chain of :class:`SimpleAugment`,
+    :class:`ElasticAugment`, and :class:`ShiftAugment`, but all
+    transformations are composed into one: only the ROI needed for the
+    composed transformation is requested upstream, and each array is resampled
+    only once.
+
+    Mirroring and transposing are performed on the voxel grid, around the
+    center of the total requested ROI. Shifts of sections are whole voxels and
+    applied after the elastic deformation, as in :class:`ShiftAugment`.
+
+    Args:
+
+        control_point_spacing (``tuple`` of ``int``):
+
+            Distance between control points for the elastic deformation, in
+            voxels per dimension.
+
+        jitter_sigma (``tuple`` of ``float``):
+
+            Standard deviation of control point jitter distribution, in voxels
+            per dimension.
+
+        rotation_interval (``tuple`` of two ``floats``):
+
+            Interval to randomly sample rotation angles from (0, 2PI).
+
+        scale_interval (``tuple`` of two ``floats``):
+
+            Interval to randomly sample scale factors from.
+
+        mirror_only (``list`` of ``int``, optional):
+
+            If set, only mirror between the given spatial axes.
+
+        transpose_only (``list`` of ``int``, optional):
+
+            If set, only transpose between the given spatial axes.
+
+        mirror_probs (``list`` of ``float``, optional):
+
+            The probability to mirror each spatial axis, default is 0.5.
+
+        prob_slip (``float``):
+
+            Probability of a section to be independently shifted.
+
+        prob_shift (``float``):
+
+            Probability of a section and all following sections to be shifted.
+
+        shift_sigma (``float`` or ``tuple`` of ``float``):
+
+            Standard deviation of the shifts, in world units. If a single value
+            is given, it is used for all axes except ``shift_axis``.
+
+        shift_axis (``int``):
+
+            The spatial axis along which sections are taken.
+
+        subsample (``int``):
+
+            See :class:`ElasticAugment`.
+
+        spatial_dims (``int``):
+
+            See :class:`ElasticAugment`.
+
+        num_threads (``int``):
+
+            See :class:`ElasticAugment`.
+    """
+
+    def __init__(
+        self,
+        control_point_spacing,
+        jitter_sigma,
+        rotation_interval,
+        scale_interval=(1.0, 1.0),
+        mirror_only=None,
+        transpose_only=None,
+        mirror_probs=None,
+        prob_slip=0,
+        prob_shift=0,
+        shift_sigma=0,
+        shift_axis=0,
+        subsample=1,
+        spatial_dims=3,
+        num_threads=1,
+    ):
+
+        super().__init__(
+            control_point_spacing,
+            jitter_sigma,
+            rotation_interval,
+            scale_interval=scale_interval,
+            subsample=subsample,
+            spatial_dims=spatial_dims,
+            num_threads=num_threads,
+        )
+
+        self.mirror_only = mirror_only
+        self.transpose_only = transpose_only
+        self.mirror_probs = mirror_probs
+        self.shift_prob_slip = prob_slip
+        self.shift_prob_shift = prob_shift
+        self.shift_sigma = shift_sigma
+        self.shift_axis = shift_axis
+
+    def _create_master_transformation(self, target_shape, voxel_size, context):
+
+        dims = len(target_shape)
+
+        # section shifts in voxels, applied last: a voxel at y reads the
+        # elastic transformation at y - shift
+        shifts = self.__create_shifts(target_shape, voxel_size, context)
+        shift_min = shifts.min(axis=0)
+        shift_max = shifts.max(axis=0)
+
+        # create the elastic transformation for all locations that are read
+        transformation = super()._create_master_transformation(
+            tuple(Coordinate(target_shape) + Coordinate(shift_max - shift_min)),
+            voxel_size,
+            context,
+        )
+        for d in range(dims):
+            transformation[d] -= shift_max[d]
+
+        composed = np.empty((dims,) + tuple(target_shape), dtype=np.float32)
+        for section, shift in enumerate(shifts):
+            begin = shift_max - shift
+            slices = tuple(
+                slice(section, section + 1)
+                if d == self.shift_axis
+                else slice(begin[d], begin[d] + target_shape[d])
+                for d in range(dims)
+            )
+            target = tuple(
+                slice(section, section + 1) if d == self.shift_axis else slice(None)
+                for d in range(dims)
+            )
+            composed[(slice(None),) + target] = transformation[
+                (slice(None),) + slices
+            ]
+
+        # mirror and transpose the source locations, applied first
+        mirror, transpose = self.__create_mirror_transpose(dims, context)
+        logger.debug("mirror = %s, transpose = %s", mirror, transpose)
+
+        center = (np.array(target_shape) - 1) / 2.0
+        mirrored = np.empty_like(composed)
+        for d in range(dims):
+            source = composed[transpose[d]] - center[transpose[d]]
+            mirrored[d] = center[d] + (-source if mirror[d] else source)
+
+        return mirrored
+
+    def __create_mirror_transpose(self, dims, context):
+
+        mirror_only = self.mirror_only
+        if mirror_only is None:
+            mirror_only = range(dims)
+        mirror_probs = self.mirror_probs
+        if mirror_probs is None:
+            mirror_probs = [0.5] * dims
+        mirror = [
+            d in mirror_only and context.random.random() < mirror_probs[d]
+            for d in range(dims)
+        ]
+
+        transpose_dims = self.transpose_only
+        if transpose_dims is None:
+            transpose_dims = list(range(dims))
+        permutation = context.random.sample(
+            transpose_dims, k=len(transpose_dims)
+        )
+        transpose = list(range(dims))
+        for o, n in zip(transpose_dims, permutation):
+            transpose[o] = n
+
+        return mirror, transpose
+
+    def __create_shifts(self, target_shape, voxel_size, context):
+
+        dims = len(target_shape)
+        num_sections = target_shape[self.shift_axis]
+
+        if self.shift_prob_slip + self.shift_prob_shift == 0:
+            return np.zeros((num_sections, dims), dtype=int)
+
+        try:
+            shift_sigmas = tuple(self.shift_sigma)
+        except TypeError:
+            shift_sigmas = [float(self.shift_sigma)] * dims
+            shift_sigmas[self.shift_axis] = 0.0
+            shift_sigmas = tuple(shift_sigmas)
+
+        assert len(shift_sigmas) == dims
+        assert shift_sigmas[self.shift_axis] == 0.0
+
+        # like ShiftAugment, in world units
+        shifts = ShiftAugment.construct_global_shift_array(
+            num_sections,
+            shift_sigmas,
+            self.shift_prob_slip,
+            self.shift_prob_shift,
+            voxel_size,
+            context.random,
+            context.np_random,
+        )
+
+        return shifts // np.array(voxel_size, dtype=int)
@@ -1,3 +1,5 @@
+import numpy as np
+
 from gunpowder.ext import h5py
 from .hdf5like_source_base import Hdf5LikeSource
 
@@ -34,6 +36,73 @@ class Hdf5Source(Hdf5LikeSource):
             to be (channels, spatial dimensions). This is recommended because of
             better performance. If channels_first is set to false, then the input
             data is read in channels_last manner and converted to channels_first.
+
+        keep_open (``bool``, optional):
+
+            Whether to keep the file and its datasets open between requests,
+            instead of opening it for every request. The file is closed on
+            teardown. Open files do not see changes made to them by other
+            processes and (for HDF5) can keep writers out, therefore this is
+            off by default.
+
+        chunk_cache (:class:`ChunkCache` or :class:`SharedChunkCache`, optional):
+
+            A cache for decompressed chunks, to be shared between sources.
+            Hits and misses are counted in the profiling stats.
+
+        mmap (``bool``, optional):
+
+            Whether to memory-map contiguous, uncompressed datasets. Arrays
+            read from those datasets are views into the mapped file, such
+            that data is only read when it is accessed and pages are shared
+            between worker processes. The views are copy-on-write, changing
+            them does not change the file. Other datasets are read as usual.
     '''
+
+    def __init__(
+            self,
+            filename,
+            datasets,
+            array_specs=None,
+            channels_first=True,
+            keep_open=False,
+            chunk_cache=None,
+            mmap=False):
+
+        super().__init__(
+            filename,
+            datasets,
+            array_specs,
+            channels_first,
+            keep_open,
+            chunk_cache)
+
+        self.mmap = mmap
+
     def _open_file(self, filename):
         return h5py.File(filename, 'r')
+
+    def _read_into(self, dataset, selection, out):
+        dataset.read_direct(out, source_sel=selection)
+
+    def _open_mmap(self, dataset):
+
+        if (
+                dataset.chunks is not None or
+                dataset.compression is not None or
+                dataset.external or
+                dataset.is_virtual or
+                dataset.dtype.hasobject):
+            return None
+
+        offset = dataset.id.get_offset()
+        if offset is None:
+            # storage not allocated yet
+            return None
+
+        return np.memmap(
+            self.filename,
+            mode='c',
+            dtype=dataset.dtype,
+            offset=offset,
+            shape=dataset.shape)
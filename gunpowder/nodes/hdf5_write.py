@@ -36,6 +36,17 @@ class Hdf5Write(Hdf5LikeWrite):
             A dictionary from array keys to datatype (eg. ``np.int8``). If
             given, arrays are stored using this type. The original arrays
             within the pipeline remain unchanged.
+
+        write_behind (``bool``, optional):
+
+            If set, arrays are collected per storage chunk and complete
+            chunks are written by background threads. Partially covered
+            chunks are written on teardown. Only supported in the process the
+            pipeline was set up in, see :class:`Hdf5LikeWrite`.
+
+        num_write_threads (``int``, optional):
+
+            The number of background threads, if ``write_behind`` is set.
         '''
 
     def _open_file(self, filename):
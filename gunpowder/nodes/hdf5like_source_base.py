@@ -1,5 +1,12 @@
+import asyncio
+import collections
+import concurrent.futures
+import contextlib
+import itertools
 import logging
 import numpy as np
+import os
+import threading
 
 from gunpowder.batch import Batch
 from gunpowder.coordinate import Coordinate
@@ -12,6 +19,138 @@ from .batch_provider import BatchProvider
 logger = logging.getLogger(__name__)
 
 
+class OpenFile(object):
+    '''A file kept open by a :class:`FileHandlePool`, with the datasets
+    accessed so far.'''
+
+    def __init__(self, context):
+
+        self.context = context
+        self.file = context.__enter__()
+        self.datasets = {}
+        self.users = 0
+        self.closing = False
+
+    def __getitem__(self, ds_name):
+
+        if ds_name not in self.datasets:
+            self.datasets[ds_name] = self.file[ds_name]
+        return self.datasets[ds_name]
+
+    def __contains__(self, ds_name):
+
+        return ds_name in self.file
+
+    def close(self):
+
+        self.datasets = {}
+        self.context.__exit__(None, None, None)
+
+
+class FileHandlePool(object):
+    '''Keeps files (and their datasets) open between requests, such that they
+    don't have to be opened and their metadata parsed for every request.
+
+    There is one pool per process. After a fork, the child process does not
+    use the handles inherited from the parent, but opens its own. Files that
+    are not in use are closed in least recently used order if more than
+    ``max_open`` are open.
+
+    Args:
+
+        max_open (``int``, optional):
+
+            How many files to keep open at most.
+    '''
+
+    def __init__(self, max_open=64):
+
+        self.max_open = max_open
+        self.lock = threading.Lock()
+        self.files = collections.OrderedDict()
+
+        # handles inherited from a parent process, never to be used or closed
+        # in this process
+        self.inherited = []
+
+    @contextlib.contextmanager
+    def open(self, key, open_file):
+        '''Get the open file for ``key``, opening it with ``open_file`` (a
+        function returning a context manager) if needed.'''
+
+        open_file_entry = self.__acquire(key, open_file)
+        try:
+            yield open_file_entry
+        finally:
+            self.__release(key, open_file_entry)
+
+    def close(self, key):
+        '''Close the file for ``key``, as soon as it is not in use anymore.'''
+
+        with self.lock:
+            entry = self.files.get(key)
+            if entry is None:
+                return
+            if entry.users == 0:
+                del self.files[key]
+                entry.close()
+            else:
+                entry.closing = True
+
+    def after_fork(self):
+
+        self.lock = threading.Lock()
+        self.inherited.append(self.files)
+        self.files = collections.OrderedDict()
+
+    def __acquire(self, key, open_file):
+
+        with self.lock:
+
+            entry = self.files.get(key)
+            if entry is None or entry.closing:
+                entry = OpenFile(open_file())
+                entry.users += 1
+                self.files[key] = entry
+                self.__evict()
+            else:
+                entry.users += 1
+                self.files.move_to_end(key)
+
+            return entry
+
+    def __release(self, key, entry):
+
+        with self.lock:
+
+            entry.users -= 1
+            if entry.users > 0:
+                return
+
+            if entry.closing or self.files.get(key) is not entry:
+                if self.files.get(key) is entry:
+                    del self.files[key]
+                entry.close()
+            else:
+                self.__evict()
+
+    def __evict(self):
+
+        if len(self.files) <= self.max_open:
+            return
+
+        for key, entry in list(self.files.items()):
+            if len(self.files) <= self.max_open:
+                break
+            if entry.users == 0:
+                del self.files[key]
+                entry.close()
+
+
+file_handle_pool = FileHandlePool()
+os.register_at_fork(after_in_child=file_handle_pool.after_fork)
+
+
 class Hdf5LikeSource(BatchProvider):
     '''An HDF5-like data source.
 
@@ -45,13 +184,29 @@ class Hdf5LikeSource(BatchProvider):
             to be (channels, spatial dimensions). This is recommended due to
             better performance. If channels_first is set to false, then the input
             data is read in channels_last manner and converted to channels_first.
+
+        keep_open (``bool``, optional):
+
+            Whether to keep the file and its datasets open between requests,
+            see :class:`FileHandlePool`. The file is closed on teardown.
+            Defaults to ``False``.
+
+        chunk_cache (:class:`ChunkCache` or :class:`SharedChunkCache`, optional):
+
+            A cache for decompressed chunks of chunked datasets. If given,
+            datasets are read chunk by chunk and chunks are taken from the
+            cache if possible. The number of hits and misses is reported as
+            counters ``chunk_cache_hits`` and ``chunk_cache_misses`` in the
+            profiling stats of each batch.
     '''
     def __init__(
             self,
             filename,
             datasets,
             array_specs=None,
-            channels_first=True):
+            channels_first=True,
+            keep_open=False,
+            chunk_cache=None):
 
         self.filename = filename
         self.datasets = datasets
@@ -62,6 +217,17 @@ class Hdf5LikeSource(BatchProvider):
             self.array_specs = array_specs
 
         self.channels_first = channels_first
+        self.keep_open = keep_open
+        self.chunk_cache = chunk_cache
+
+        # number of threads to read chunks with, see ZarrSource
+        self.num_threads = 1
+        self.__executor = None
+        self.__executor_pid = None
+
+        # whether to memory-map datasets, see Hdf5Source
+        self.mmap = False
+        self.__mmaps = {}
 
         # number of spatial dimensions
         self.ndims = None
@@ -69,6 +235,16 @@ class Hdf5LikeSource(BatchProvider):
     def _open_file(self, filename):
         raise NotImplementedError('Only implemented in subclasses')
 
+    def _read_into(self, dataset, selection, out):
+        '''Read ``selection`` of the given dataset into the C-contiguous
+        array ``out``. Subclasses should avoid intermediate copies.'''
+        out[...] = dataset[selection]
+
+    def _open_mmap(self, dataset):
+        '''Memory-map the given dataset. Return ``None`` if this is not
+        possible for this dataset.'''
+        return None
+
     def setup(self):
         with self._open_file(self.filename) as data_file:
             for (array_key, ds_name) in self.datasets.items():
@@ -80,41 +256,139 @@ class Hdf5LikeSource(BatchProvider):
 
                 self.provides(array_key, spec)
 
+    def teardown(self):
+
+        if self.keep_open:
+            file_handle_pool.close(self.__file_key())
+
+        if self.__executor is not None:
+            if self.__executor_pid == os.getpid():
+                self.__executor.shutdown()
+            self.__executor = None
+
+        self.__mmaps = {}
+
     def provide(self, request):
 
         timing = Timing(self)
         timing.start()
 
         batch = Batch()
+        cache_counts = [0, 0]
 
-        with self._open_file(self.filename) as data_file:
+        with self.__open_data_file() as data_file:
             for (array_key, request_spec) in request.array_specs.items():
-                logger.debug("Reading %s in %s...", array_key, request_spec.roi)
+                batch.arrays[array_key] = self.__read_array(
+                    data_file,
+                    array_key,
+                    request_spec,
+                    cache_counts)
 
-                voxel_size = self.spec[array_key].voxel_size
+        logger.debug("done")
+
+        timing.stop()
+        batch.profiling_stats.add(timing)
+        self.__add_cache_counts(batch, [cache_counts])
+
+        return batch
+
+    async def provide_async(self, request):
 
-                # scale request roi to voxel units
-                dataset_roi = request_spec.roi / voxel_size
+        loop = asyncio.get_running_loop()
 
-                # shift request roi into dataset
-                dataset_roi = dataset_roi - self.spec[array_key].roi.get_offset() / voxel_size
+        timing = Timing(self)
+        timing.start()
 
-                # create array spec
-                array_spec = self.spec[array_key].copy()
-                array_spec.roi = request_spec.roi
+        batch = Batch()
 
-                # add array to batch
-                batch.arrays[array_key] = Array(
-                    self.__read(data_file, self.datasets[array_key], dataset_roi),
-                    array_spec)
+        data_file_context = self.__open_data_file()
+        data_file = await loop.run_in_executor(
+            None, data_file_context.__enter__)
+
+        try:
+
+            # read all arrays concurrently, wait for all reads to finish
+            # before the file gets closed
+            array_keys = list(request.array_specs.keys())
+            cache_counts = [[0, 0] for _ in array_keys]
+            arrays = await asyncio.gather(
+                *[
+                    loop.run_in_executor(
+                        None,
+                        self.__read_array,
+                        data_file,
+                        array_key,
+                        request.array_specs[array_key],
+                        counts)
+                    for array_key, counts in zip(array_keys, cache_counts)
+                ],
+                return_exceptions=True)
+
+        finally:
+
+            await loop.run_in_executor(
+                None, data_file_context.__exit__, None, None, None)
+
+        for array_key, array in zip(array_keys, arrays):
+            if isinstance(array, Exception):
+                raise array
+            batch.arrays[array_key] = array
 
         logger.debug("done")
 
         timing.stop()
         batch.profiling_stats.add(timing)
+        self.__add_cache_counts(batch, cache_counts)
 
         return batch
 
+    def __read_array(self, data_file, array_key, request_spec, cache_counts):
+
+        logger.debug("Reading %s in %s...", array_key, request_spec.roi)
+
+        voxel_size = self.spec[array_key].voxel_size
+
+        # scale request roi to voxel units
+        dataset_roi = request_spec.roi / voxel_size
+
+        # shift request roi into dataset
+        dataset_roi = dataset_roi - self.spec[array_key].roi.get_offset() / voxel_size
+
+        # create array spec
+        array_spec = self.spec[array_key].copy()
+        array_spec.roi = request_spec.roi
+
+        return Array(
+            self.__read(
+                data_file,
+                self.datasets[array_key],
+                dataset_roi,
+                cache_counts),
+            array_spec)
+
+    def __add_cache_counts(self, batch, cache_counts):
+
+        if self.chunk_cache is None:
+            return
+
+        hits = sum(counts[0] for counts in cache_counts)
+        misses = sum(counts[1] for counts in cache_counts)
+        batch.profiling_stats.add_counter(self, "chunk_cache_hits", hits)
+        batch.profiling_stats.add_counter(self, "chunk_cache_misses", misses)
+
+    def __file_key(self):
+
+        return (type(self), self.filename)
+
+    def __open_data_file(self):
+
+        if self.keep_open:
+            return file_handle_pool.open(
+                self.__file_key(),
+                lambda: self._open_file(self.filename))
+
+        return self._open_file(self.filename)
+
     def _get_voxel_size(self, dataset):
         try:
             return Coordinate(dataset.attrs['resolution'])
@@ -184,19 +458,154 @@ class Hdf5LikeSource(BatchProvider):
 
         return spec
 
-    def __read(self, data_file, ds_name, roi):
+    def __read(self, data_file, ds_name, roi, cache_counts):
 
-        c = len(data_file[ds_name].shape) - self.ndims
+        dataset = data_file[ds_name]
+        c = len(dataset.shape) - self.ndims
 
         if self.channels_first:
-            array = np.asarray(data_file[ds_name][(slice(None),) * c + roi.to_slices()])
+            selection = (slice(None),) * c + roi.to_slices()
+        else:
+            selection = roi.to_slices() + (slice(None),) * c
+
+        mmap = self.__get_mmap(dataset, ds_name)
+        if mmap is not None:
+            # a view, data will be read once it is accessed
+            array = np.asarray(mmap[selection])
+            if not self.channels_first:
+                array = np.transpose(array,
+                                     axes=[i + self.ndims for i in range(c)] + list(range(self.ndims)))
+            return array
+
+        # allocate the result in channels first layout, all reads below write
+        # into it directly
+        if self.channels_first:
+            channel_shape = dataset.shape[:c]
+        else:
+            channel_shape = dataset.shape[self.ndims:]
+        array = np.empty(
+            tuple(channel_shape) + tuple(roi.get_shape()),
+            dtype=dataset.dtype)
+
+        if self.channels_first:
+            out = array
+        else:
+            # a view of array in the layout of the dataset
+            out = np.transpose(
+                array,
+                axes=list(range(c, c + self.ndims)) + list(range(c)))
+
+        read_chunks = self.chunk_cache is not None or self.num_threads > 1
+        if dataset.chunks is not None and (read_chunks or not self.channels_first):
+            # channels last chunks are transposed while being copied into array
+            self.__read_chunks(dataset, ds_name, selection, out, cache_counts)
+        elif self.channels_first:
+            self._read_into(dataset, selection, array)
         else:
-            array = np.asarray(data_file[ds_name][roi.to_slices() + (slice(None),) * c])
-            array = np.transpose(array,
-                                 axes=[i + self.ndims for i in range(c)] + list(range(self.ndims)))
+            # read channel by channel into contiguous parts of array
+            for channel in np.ndindex(*channel_shape):
+                self._read_into(dataset, roi.to_slices() + channel, array[channel])
 
         return array
 
+    def __read_chunks(self, dataset, ds_name, selection, array, cache_counts):
+        '''Read ``selection`` chunk by chunk into ``array``, using the chunk
+        cache (if given) and ``num_threads`` threads.'''
+
+        shape = dataset.shape
+        chunk_shape = dataset.chunks
+
+        begin = [
+            s.start if s.start is not None else 0
+            for s in selection
+        ]
+        end = [
+            s.stop if s.stop is not None else n
+            for s, n in zip(selection, shape)
+        ]
+
+        chunk_ranges = [
+            range(b // cs, (e - 1) // cs + 1)
+            for b, e, cs in zip(begin, end, chunk_shape)
+        ]
+
+        def read_chunk(chunk_index):
+            return self.__read_chunk(
+                dataset, ds_name, chunk_index, begin, end, array)
+
+        chunk_indices = itertools.product(*chunk_ranges)
+        if self.num_threads > 1:
+            hits = list(self.__get_executor().map(read_chunk, chunk_indices))
+        else:
+            hits = [read_chunk(chunk_index) for chunk_index in chunk_indices]
+
+        cache_counts[0] += sum(1 for hit in hits if hit)
+        cache_counts[1] += sum(1 for hit in hits if not hit)
+
+    def __read_chunk(self, dataset, ds_name, chunk_index, begin, end, array):
+        '''Copy the requested part of a chunk into ``array``. Returns whether
+        the chunk was found in the cache.'''
+
+        shape = dataset.shape
+        chunk_shape = dataset.chunks
+
+        chunk_begin = [i * cs for i, cs in zip(chunk_index, chunk_shape)]
+        chunk_end = [
+            min((i + 1) * cs, n)
+            for i, cs, n in zip(chunk_index, chunk_shape, shape)
+        ]
+
+        lower = [max(a, b) for a, b in zip(begin, chunk_begin)]
+        upper = [min(a, b) for a, b in zip(end, chunk_end)]
+        target = tuple(
+            slice(lo - b, hi - b)
+            for lo, hi, b in zip(lower, upper, begin))
+
+        if self.chunk_cache is None:
+            # chunks are disjoint, threads write to different parts of array
+            array[target] = dataset[tuple(
+                slice(lo, hi) for lo, hi in zip(lower, upper))]
+            return False
+
+        key = (self.filename, ds_name, chunk_index)
+        chunk = self.chunk_cache.get(
+            key,
+            tuple(e - b for b, e in zip(chunk_begin, chunk_end)),
+            dataset.dtype)
+
+        hit = chunk is not None
+        if not hit:
+            chunk = np.asarray(dataset[tuple(
+                slice(b, e) for b, e in zip(chunk_begin, chunk_end))])
+            self.chunk_cache.put(key, chunk)
+
+        array[target] = chunk[tuple(
+            slice(lo - b, hi - b)
+            for lo, hi, b in zip(lower, upper, chunk_begin))]
+
+        return hit
+
+    def __get_mmap(self, dataset, ds_name):
+
+        if not self.mmap:
+            return None
+
+        if ds_name not in self.__mmaps:
+            self.__mmaps[ds_name] = self._open_mmap(dataset)
+
+        return self.__mmaps[ds_name]
+
+    def __get_executor(self):
+
+        # the pool's threads do not survive a fork, create a new pool in
+        # worker processes
+        if self.__executor is None or self.__executor_pid != os.getpid():
+            self.__executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.num_threads)
+            self.__executor_pid = os.getpid()
+
+        return self.__executor
+
     def name(self):
 
         return super().name() + f"[{self.filename}]"
@@ -2,11 +2,35 @@ from .batch_filter import BatchFilter
 from gunpowder.batch_request import BatchRequest
 from gunpowder.coordinate import Coordinate
 from gunpowder.roi import Roi
+import collections
+import concurrent.futures
+import contextlib
+import fcntl
+import itertools
 import logging
+import numpy as np
 import os
+import threading
 
 logger = logging.getLogger(__name__)
 
+
+class ChunkBuffer(object):
+    '''The parts of a storage chunk that have been written so far, see
+    :class:`Hdf5LikeWrite`.'''
+
+    def __init__(self, dataset, slices, shape):
+
+        self.dataset = dataset
+        self.slices = slices
+        self.data = np.empty(shape, dtype=dataset.dtype)
+        self.covered = np.zeros(shape, dtype=bool)
+
+    def complete(self):
+
+        return self.covered.all()
+
+
 class Hdf5LikeWrite(BatchFilter):
     '''Assemble arrays of passing batches in one HDF5-like container. This is
     useful to store chunks produced by :class:`Scan` on disk without keeping
@@ -41,6 +65,31 @@ class Hdf5LikeWrite(BatchFilter):
             A dictionary from array keys to datatype (eg. ``np.int8``). If
             given, arrays are stored using this type. The original arrays
             within the pipeline remain unchanged.
+
+        write_behind (``bool``, optional):
+
+            If set, passing arrays are collected per storage chunk of the
+            dataset, and only complete chunks are written, by a pool of
+            background threads. Partially covered chunks are written on
+            teardown. This avoids reading, modifying, and compressing the same
+            chunk several times if the arrays are not aligned with the chunks,
+            and batches can move on while their data is being written.
+
+            Data of partially covered chunks is held in memory until teardown
+            and lost if the process dies before. For the same reason, this
+            can not be combined with the ``journal`` of :class:`Scan`.
+
+            Only supported in the process the pipeline was set up in, i.e.,
+            not in the worker processes of :class:`Scan` or
+            :class:`PreCache`, which are terminated without a teardown. An
+            error is raised if data passes this node in another process. Use
+            the ``"thread"`` backend of these nodes instead, or
+            ``multi_writer`` of :class:`ZarrWrite`.
+
+        num_write_threads (``int``, optional):
+
+            The number of background threads to write chunks with, if
+            ``write_behind`` is set.
         '''
 
     def __init__(
@@ -49,7 +98,9 @@ class Hdf5LikeWrite(BatchFilter):
             output_dir='.',
             output_filename='output.hdf',
             compression_type=None,
-            dataset_dtypes=None):
+            dataset_dtypes=None,
+            write_behind=False,
+            num_write_threads=1):
 
         self.dataset_names = dataset_names
         self.output_dir = output_dir
@@ -62,10 +113,63 @@ class Hdf5LikeWrite(BatchFilter):
 
         self.dataset_offsets = {}
 
+        self.write_behind = write_behind
+        self.num_write_threads = num_write_threads
+        self.__setup_pid = None
+        self.__write_file = None
+        self.__executor = None
+        self.__chunk_buffers = {}
+        self.__pending_writes = collections.deque()
+        self.__lock = threading.Lock()
+
+        # whether several processes write at the same time, see ZarrWrite
+        self.multi_writer = False
+        self.channel_shapes = {}
+
     def setup(self):
         for key in self.dataset_names.keys():
             self.updates(key, self.spec[key])
         self.enable_autoskip()
+        self.__setup_pid = os.getpid()
+
+        if self.multi_writer:
+            # create datasets before workers are started, such that they don't
+            # race to do so
+            for (array_key, dataset_name) in self.dataset_names.items():
+                spec = self.spec[array_key]
+                self.__init_dataset(
+                    array_key,
+                    dataset_name,
+                    self.channel_shapes.get(array_key, ()),
+                    spec.dtype,
+                    spec.voxel_size)
+
+    def teardown(self):
+
+        if self.__executor is None or os.getpid() != self.__setup_pid:
+            return
+
+        # write what is left of partially covered chunks
+        with self.__lock:
+            chunk_buffers = list(self.__chunk_buffers.values())
+            self.__chunk_buffers = {}
+        logger.debug("writing %d partial chunks", len(chunk_buffers))
+        for chunk_buffer in chunk_buffers:
+            self.__submit(
+                chunk_buffer.dataset,
+                chunk_buffer.slices,
+                chunk_buffer.data,
+                chunk_buffer.covered)
+
+        try:
+            while self.__pending_writes:
+                self.__pending_writes.popleft().result()
+        finally:
+            self.__executor.shutdown()
+            self.__executor = None
+            self.__pending_writes.clear()
+            self.__write_file[0].__exit__(None, None, None)
+            self.__write_file = None
 
     def prepare(self, request):
         deps = BatchRequest()
@@ -90,18 +194,8 @@ class Hdf5LikeWrite(BatchFilter):
 
     def init_datasets(self, batch):
 
-        filename = os.path.join(self.output_dir, self.output_filename)
-        logger.debug("Initializing container %s", filename)
-
-        try:
-            os.makedirs(self.output_dir)
-        except:
-            pass
-
         for (array_key, dataset_name) in self.dataset_names.items():
 
-            logger.debug("Initializing dataset for %s", array_key)
-
             assert array_key in self.spec, (
                 "Asked to store %s, but is not provided upstream."%array_key)
             assert array_key in batch.arrays, (
@@ -111,101 +205,338 @@ class Hdf5LikeWrite(BatchFilter):
             dims = array.spec.roi.dims()
             batch_shape = array.data.shape
 
-            with self._open_file(filename) as data_file:
+            self.__init_dataset(
+                array_key,
+                dataset_name,
+                batch_shape[:-dims],
+                array.data.dtype,
+                array.spec.voxel_size)
+
+    def __init_dataset(
+            self,
+            array_key,
+            dataset_name,
+            channel_shape,
+            dtype,
+            voxel_size):
+
+        filename = os.path.join(self.output_dir, self.output_filename)
+        logger.debug("Initializing dataset for %s in %s", array_key, filename)
 
-                # if a dataset already exists, read its meta-information (if
-                # present)
-                if dataset_name in data_file:
+        try:
+            os.makedirs(self.output_dir)
+        except Exception:
+            pass
 
-                    offset = self._get_offset(data_file[dataset_name]) or Coordinate((0,)*dims)
+        dims = voxel_size.dims()
 
-                else:
+        with self._open_file(filename) as data_file:
 
-                    provided_roi = self.spec[array_key].roi
+            # if a dataset already exists, read its meta-information (if
+            # present)
+            if dataset_name in data_file:
 
-                    if provided_roi is None:
-                        raise RuntimeError(
-                            "Dataset %s does not exist in %s, and no ROI is "
-                            "provided for %s. I don't know how to initialize "
-                            "the dataset."%(dataset_name, filename, array_key))
+                offset = self._get_offset(data_file[dataset_name]) or Coordinate((0,)*dims)
 
-                    offset = provided_roi.get_offset()
-                    voxel_size = array.spec.voxel_size
-                    data_shape = provided_roi.get_shape()//voxel_size
+            else:
 
-                    logger.debug("Shape in voxels: %s", data_shape)
-                    # add channel dimensions (if present)
-                    data_shape = batch_shape[:-dims] + data_shape
-                    logger.debug("Shape with channel dimensions: %s", data_shape)
+                provided_roi = self.spec[array_key].roi
 
-                    if array_key in self.dataset_dtypes:
-                        dtype = self.dataset_dtypes[array_key]
-                    else:
-                        dtype = batch.arrays[array_key].data.dtype
+                if provided_roi is None:
+                    raise RuntimeError(
+                        "Dataset %s does not exist in %s, and no ROI is "
+                        "provided for %s. I don't know how to initialize "
+                        "the dataset." % (dataset_name, filename, array_key))
 
-                    logger.debug(
-                        "create_dataset: %s, %s, %s, %s, offset=%s, resolution=%s",
-                        dataset_name, data_shape, self.compression_type, dtype,
-                        offset, voxel_size)
+                offset = provided_roi.get_offset()
+                data_shape = provided_roi.get_shape()//voxel_size
 
-                    dataset = data_file.create_dataset(
-                            name=dataset_name,
-                            shape=data_shape,
-                            compression=self.compression_type,
-                            dtype=dtype)
+                logger.debug("Shape in voxels: %s", data_shape)
+                # add channel dimensions (if present)
+                data_shape = tuple(channel_shape) + data_shape
+                logger.debug("Shape with channel dimensions: %s", data_shape)
 
-                    self._set_offset(dataset, offset)
-                    self._set_voxel_size(dataset, voxel_size)
+                if array_key in self.dataset_dtypes:
+                    dtype = self.dataset_dtypes[array_key]
 
                 logger.debug(
-                    "%s (%s in %s) has offset %s",
-                    array_key,
-                    dataset_name,
-                    filename,
-                    offset)
-                self.dataset_offsets[array_key] = offset
+                    "create_dataset: %s, %s, %s, %s, offset=%s, resolution=%s",
+                    dataset_name, data_shape, self.compression_type, dtype,
+                    offset, voxel_size)
+
+                dataset = data_file.create_dataset(
+                        name=dataset_name,
+                        shape=data_shape,
+                        compression=self.compression_type,
+                        dtype=dtype)
+
+                self._set_offset(dataset, offset)
+                self._set_voxel_size(dataset, voxel_size)
+
+            logger.debug(
+                "%s (%s in %s) has offset %s",
+                array_key,
+                dataset_name,
+                filename,
+                offset)
+            self.dataset_offsets[array_key] = offset
 
     def process(self, batch, request):
 
         filename = os.path.join(self.output_dir, self.output_filename)
 
-        if not self.dataset_offsets:
-            self.init_datasets(batch)
+        # several threads might process batches at the same time, the first
+        # one initializes the datasets
+        if not self.__datasets_initialized():
+            with self.__lock:
+                if not self.__datasets_initialized():
+                    self.init_datasets(batch)
 
-        with self._open_file(filename) as data_file:
+        if self.multi_writer:
+            with self._open_file(filename) as data_file:
+                self.__write(data_file, batch, self.__write_locked)
+        elif self.__writes_behind():
+            self.__check_pending_writes()
+            data_file = self.__open_write_file(filename)
+            self.__write(data_file, batch, self.__buffer)
+        else:
+            with self._open_file(filename) as data_file:
+                self.__write(data_file, batch, self.__write_now)
 
-            for (array_key, dataset_name) in self.dataset_names.items():
+    def __datasets_initialized(self):
 
-                dataset = data_file[dataset_name]
+        return all(key in self.dataset_offsets for key in self.dataset_names)
 
-                array_roi = batch.arrays[array_key].spec.roi
-                voxel_size = self.spec[array_key].voxel_size
-                dims = array_roi.dims()
-                channel_slices = (slice(None),)*max(0, len(dataset.shape) - dims)
+    def __write(self, data_file, batch, write):
 
-                dataset_roi = Roi(
-                    self.dataset_offsets[array_key],
-                    Coordinate(dataset.shape[-dims:])*voxel_size)
-                common_roi = array_roi.intersect(dataset_roi)
+        for (array_key, dataset_name) in self.dataset_names.items():
 
-                if common_roi.empty():
-                    logger.warn(
-                        "array %s with ROI %s lies outside of dataset ROI %s, "
-                        "skipping writing"%(
-                            array_key,
-                            array_roi,
-                            dataset_roi))
-                    continue
+            dataset = data_file[dataset_name]
 
-                dataset_voxel_roi = (common_roi - self.dataset_offsets[array_key])//voxel_size
-                dataset_voxel_slices = dataset_voxel_roi.to_slices()
-                array_voxel_roi = (common_roi - array_roi.get_offset())//voxel_size
-                array_voxel_slices = array_voxel_roi.to_slices()
+            array_roi = batch.arrays[array_key].spec.roi
+            voxel_size = self.spec[array_key].voxel_size
+            dims = array_roi.dims()
+            channel_slices = (slice(None),)*max(0, len(dataset.shape) - dims)
 
-                logger.debug(
-                    "writing %s to voxel coordinates %s"%(
+            dataset_roi = Roi(
+                self.dataset_offsets[array_key],
+                Coordinate(dataset.shape[-dims:])*voxel_size)
+            common_roi = array_roi.intersect(dataset_roi)
+
+            if common_roi.empty():
+                logger.warn(
+                    "array %s with ROI %s lies outside of dataset ROI %s, "
+                    "skipping writing" % (
                         array_key,
-                        dataset_voxel_roi))
+                        array_roi,
+                        dataset_roi))
+                continue
+
+            dataset_voxel_roi = (common_roi - self.dataset_offsets[array_key])//voxel_size
+            dataset_voxel_slices = dataset_voxel_roi.to_slices()
+            array_voxel_roi = (common_roi - array_roi.get_offset())//voxel_size
+            array_voxel_slices = array_voxel_roi.to_slices()
 
-                data = batch.arrays[array_key].data[channel_slices + array_voxel_slices]
-                dataset[channel_slices + dataset_voxel_slices] = data
+            logger.debug(
+                "writing %s to voxel coordinates %s" % (
+                    array_key,
+                    dataset_voxel_roi))
+
+            data = batch.arrays[array_key].data[channel_slices + array_voxel_slices]
+            write(dataset_name, dataset, channel_slices + dataset_voxel_slices, data)
+
+    def __write_now(self, dataset_name, dataset, slices, data):
+
+        dataset[slices] = data
+
+    def __write_locked(self, dataset_name, dataset, slices, data):
+        '''Write data chunk by chunk, holding a lock on each chunk while
+        writing to it. Blocks of :class:`Scan` can overlap (the last block
+        along each axis is snapped to the end of the ROI), so even chunks that
+        are completely covered by a block can be written by another block at
+        the same time.'''
+
+        if dataset.chunks is None:
+            dataset[slices] = data
+            return
+
+        shape = dataset.shape
+        chunk_shape = dataset.chunks
+
+        begin = [
+            s.start if s.start is not None else 0
+            for s in slices
+        ]
+        end = [
+            s.stop if s.stop is not None else n
+            for s, n in zip(slices, shape)
+        ]
+
+        chunk_ranges = [
+            range(b // cs, (e - 1) // cs + 1)
+            for b, e, cs in zip(begin, end, chunk_shape)
+        ]
+
+        for chunk_index in itertools.product(*chunk_ranges):
+
+            chunk_begin = [i * cs for i, cs in zip(chunk_index, chunk_shape)]
+            chunk_end = [
+                min((i + 1) * cs, n)
+                for i, cs, n in zip(chunk_index, chunk_shape, shape)
+            ]
+
+            lower = [max(a, b) for a, b in zip(begin, chunk_begin)]
+            upper = [min(a, b) for a, b in zip(end, chunk_end)]
+
+            with self.__lock_chunk(dataset_name, chunk_index):
+                dataset[tuple(
+                    slice(lo, up) for lo, up in zip(lower, upper))] = \
+                    data[tuple(
+                        slice(lo - b, up - b)
+                        for lo, up, b in zip(lower, upper, begin))]
+
+    @contextlib.contextmanager
+    def __lock_chunk(self, dataset_name, chunk_index):
+        '''Hold an advisory file lock on a chunk.'''
+
+        filename = os.path.join(self.output_dir, self.output_filename)
+        lock_dir = os.path.join(filename + '.locks', dataset_name)
+        os.makedirs(lock_dir, exist_ok=True)
+        lock_file = os.path.join(
+            lock_dir,
+            '.'.join(str(i) for i in chunk_index) + '.lock')
+
+        with open(lock_file, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def __buffer(self, dataset_name, dataset, slices, data):
+        '''Copy data into the buffers of the chunks it overlaps with, submit
+        complete chunks for writing.'''
+
+        if dataset.chunks is None:
+            # not chunked, nothing to collect
+            self.__submit(dataset, slices, np.array(data, dtype=dataset.dtype))
+            return
+
+        shape = dataset.shape
+        chunk_shape = dataset.chunks
+
+        begin = [
+            s.start if s.start is not None else 0
+            for s in slices
+        ]
+        end = [
+            s.stop if s.stop is not None else n
+            for s, n in zip(slices, shape)
+        ]
+
+        chunk_ranges = [
+            range(b // cs, (e - 1) // cs + 1)
+            for b, e, cs in zip(begin, end, chunk_shape)
+        ]
+
+        complete = []
+        with self.__lock:
+
+            for chunk_index in itertools.product(*chunk_ranges):
+
+                chunk_begin = [i * cs for i, cs in zip(chunk_index, chunk_shape)]
+                chunk_end = [
+                    min((i + 1) * cs, n)
+                    for i, cs, n in zip(chunk_index, chunk_shape, shape)
+                ]
+
+                key = (dataset_name, chunk_index)
+                chunk_buffer = self.__chunk_buffers.get(key)
+                if chunk_buffer is None:
+                    chunk_buffer = ChunkBuffer(
+                        dataset,
+                        tuple(
+                            slice(b, e)
+                            for b, e in zip(chunk_begin, chunk_end)),
+                        tuple(e - b for b, e in zip(chunk_begin, chunk_end)))
+                    self.__chunk_buffers[key] = chunk_buffer
+
+                lower = [max(a, b) for a, b in zip(begin, chunk_begin)]
+                upper = [min(a, b) for a, b in zip(end, chunk_end)]
+                in_chunk = tuple(
+                    slice(lo - b, hi - b)
+                    for lo, hi, b in zip(lower, upper, chunk_begin))
+                chunk_buffer.data[in_chunk] = data[tuple(
+                    slice(lo - b, hi - b)
+                    for lo, hi, b in zip(lower, upper, begin))]
+                chunk_buffer.covered[in_chunk] = True
+
+                if chunk_buffer.complete():
+                    del self.__chunk_buffers[key]
+                    complete.append(chunk_buffer)
+
+        for chunk_buffer in complete:
+            self.__submit(dataset, chunk_buffer.slices, chunk_buffer.data)
+
+    def __submit(self, dataset, slices, data, covered=None):
+
+        future = self.__executor.submit(
+            self.__write_chunk,
+            dataset,
+            slices,
+            data,
+            covered)
+
+        # don't let writes pile up if they are slower than the pipeline
+        waiting = []
+        with self.__lock:
+            self.__pending_writes.append(future)
+            while len(self.__pending_writes) > 2*self.num_write_threads:
+                waiting.append(self.__pending_writes.popleft())
+        for future in waiting:
+            future.result()
+
+    def __write_chunk(self, dataset, slices, data, covered):
+
+        if covered is not None:
+            # partially covered chunk, keep what is stored in the rest of it
+            stored = np.asarray(dataset[slices])
+            stored[covered] = data[covered]
+            data = stored
+
+        dataset[slices] = data
+
+    def __check_pending_writes(self):
+        '''Raise errors of finished background writes.'''
+
+        done = []
+        with self.__lock:
+            while self.__pending_writes and self.__pending_writes[0].done():
+                done.append(self.__pending_writes.popleft())
+        for future in done:
+            future.result()
+
+    def __writes_behind(self):
+
+        if not self.write_behind:
+            return False
+
+        if os.getpid() != self.__setup_pid:
+            raise RuntimeError(
+                "%s is not running in the process it was set up in, "
+                "write_behind is only supported there (use the thread "
+                "backend for workers upstream of this node instead)" %
+                self.name())
+
+        return True
+
+    def __open_write_file(self, filename):
+
+        with self.__lock:
+            if self.__write_file is None:
+                context = self._open_file(filename)
+                self.__write_file = (context, context.__enter__())
+                self.__executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.num_write_threads)
+
+        return self.__write_file[1]
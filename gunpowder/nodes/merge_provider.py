@@ -4,6 +4,7 @@ from gunpowder.batch_request import BatchRequest
 
 from .batch_provider import BatchProvider
 
+import asyncio
 import random
 
 
@@ -34,7 +35,30 @@ class MergeProvider(BatchProvider):
 
     def provide(self, request):
 
-        # create upstream requests
+        upstream_requests = self.__upstream_requests(request)
+
+        # execute requests, merge batches
+        batches = [
+            provider.request_batch(upstream_request)
+            for provider, upstream_request in upstream_requests.items()
+        ]
+
+        return self.__merge(batches)
+
+    async def provide_async(self, request):
+
+        upstream_requests = self.__upstream_requests(request)
+
+        # execute requests concurrently, merge batches
+        batches = await asyncio.gather(*[
+            provider.request_batch_async(upstream_request)
+            for provider, upstream_request in upstream_requests.items()
+        ])
+
+        return self.__merge(batches)
+
+    def __upstream_requests(self, request):
+
         upstream_requests = {}
         for key, spec in request.items():
 
@@ -48,11 +72,12 @@ class MergeProvider(BatchProvider):
 
             upstream_requests[provider][key] = spec
 
-        # execute requests, merge batches
-        merged_batch = Batch()
-        for provider, upstream_request in upstream_requests.items():
+        return upstream_requests
+
+    def __merge(self, batches):
 
-            batch = provider.request_batch(upstream_request)
+        merged_batch = Batch()
+        for batch in batches:
             for key, array in batch.arrays.items():
                 merged_batch.arrays[key] = array
             for key, graph in batch.graphs.items():
@@ -60,5 +85,3 @@ class MergeProvider(BatchProvider):
             merged_batch.profiling_stats.merge_with(batch.profiling_stats)
 
         return merged_batch
-
-
@@ -21,16 +21,24 @@ class PreCache(BatchFilter):
     equal batch request, a set of workers is spawned to pre-cache the batches
     in parallel processes. This way, subsequent requests can be served quickly.
 
+    The workers are persistent and can serve up to ``max_templates`` different
+    requests (templates) at the same time, each with its own bounded cache.
+    Workers pick the template to produce a batch for at random, proportional
+    to the template's share weight, among all templates whose cache is not
+    full.
+
     A note on changing the requests sent to `PreCache`.
     Given requests A and B, if requests are sent in the sequence:
     A, ..., A, B, A, ..., A, B, A, ...
     Precache will build a Queue of batches that satisfy A, and handle requests
-    B on demand. This prevents `PreCache` from discarding the queue on every
+    B on demand (unless there is a free template slot or B was passed in
+    ``templates``). This prevents `PreCache` from discarding the queue on every
     SnapshotRequest.
     However if B request replace A as the most common request, i.e.:
     A, A, A, ..., A, B, B, B, ...,
     `PreCache` will discard the A queue and build a B queue after it has seen
-    more B requests than A requests out of the last 5 requests.
+    more B requests than A requests out of the last 5 requests. The workers
+    are not restarted for that, they just start filling the B queue instead.
 
     This node only makes sense if:
 
@@ -41,27 +49,142 @@ class PreCache(BatchFilter):
 
         cache_size (``int``):
 
-            How many batches to hold at most in the cache.
+            How many batches to hold at most in the cache of each template.
 
         num_workers (``int``):
 
-            How many processes to spawn to fill the cache.
+            How many workers to spawn to fill the cache.
+
+        transport (``string``, optional):
+
+            How batches are sent from the workers to this node, see
+            :class:`ProducerPool`. Use ``"shared_memory"`` to avoid pickling
+            large arrays.
+
+        slot_size (``int``, optional):
+
+            The size of a shared memory slot in bytes, has to be large enough
+            to hold all arrays of a batch. Only used for
+            ``transport="shared_memory"``.
+
+        deterministic (``bool``, optional):
+
+            If set, the workers do not draw random seeds, but use consecutive
+            seeds starting at the random seed of the request that started
+            them. Batches are returned in the order of their seeds,
+            independent of the order in which the workers finish. Batches that
+            finished early are held in a reorder buffer, which together with
+            the cache never holds more than ``cache_size`` batches. If
+            upstream fails for a seed, the exception is raised in place of
+            its batch.
+
+            The sequence of batches is reproducible between runs of the same
+            pipeline with the same ``num_workers`` and the same requests (and
+            ``templates``) in the same order. It is not the sequence the
+            pipeline would produce without this node, since the seeds seen
+            upstream differ. Upstream nodes that keep state between requests
+            (in each worker) can make it depend on ``num_workers`` as well.
+
+        max_templates (``int``, optional):
+
+            How many different requests the workers serve at the same time.
+            Defaults to the number of ``templates``, or 1 if none are given.
+
+        templates (``list`` of ``tuple`` of (:class:`BatchRequest`,
+        ``float``), optional):
+
+            Requests to pre-cache from the start, together with their share
+            weights. These templates are never replaced by other requests.
+            Requests that get cached later on have a share weight of 1.
+
+        backend (``string``, optional):
+
+            Whether to fill the cache from worker processes (``"process"``,
+            the default) or threads (``"thread"``), see :class:`ProducerPool`.
+            Threads are cheaper and avoid pickling, but only help if upstream
+            nodes release the GIL (e.g., while reading and decompressing
+            data). Upstream random number generators are shared between
+            threads, the thread backend can therefore not be used with
+            ``deterministic=True``.
     '''
 
-    def __init__(self, cache_size=50, num_workers=20):
+    def __init__(
+            self,
+            cache_size=50,
+            num_workers=20,
+            transport="queue",
+            slot_size=2**28,
+            deterministic=False,
+            max_templates=None,
+            templates=None,
+            backend="process"):
+
+        if templates is None:
+            templates = []
+        if max_templates is None:
+            max_templates = max(1, len(templates))
+        assert max_templates >= len(templates), (
+            "max_templates has to be at least the number of given templates")
+        assert not (deterministic and backend == "thread"), (
+            "deterministic PreCache is not supported with the thread backend")
 
-        self.current_request = None
         self.workers = None
         self.cache_size = cache_size
         self.num_workers = num_workers
+        self.transport = transport
+        self.slot_size = slot_size
+        self.deterministic = deterministic
+        self.max_templates = max_templates
+        self.backend = backend
+        self.initial_templates = [
+            (copy.deepcopy(request), weight)
+            for request, weight in templates
+        ]
+
+        # the requests served by the workers, per template slot, and whether
+        # they can be replaced
+        self.templates = [None]*max_templates
+        self.pinned = [False]*max_templates
+
+        # batches received per template slot, by seed index
+        self.buffers = [{} for _ in range(max_templates)]
 
         # keep track of recent requests
         self.last_5 = deque([None,] * 5, maxlen=5)
 
+    def setup(self):
+
+        # state shared with the workers: per template slot the generation of
+        # the template (increased every time a slot gets a new template), and
+        # how many seed indices have been handed out to workers and returned
+        # downstream
+        self.lock = multiprocessing.Lock()
+        self.generations = multiprocessing.Array(
+            'L', self.max_templates, lock=False)
+        self.produced = multiprocessing.Array(
+            'L', self.max_templates, lock=False)
+        self.consumed = multiprocessing.Array(
+            'L', self.max_templates, lock=False)
+
+        # to announce new templates to each worker
+        self.commands = [
+            multiprocessing.Queue()
+            for _ in range(self.num_workers)
+        ]
+
+        # worker local state, set in each worker
+        self.worker_templates = [{} for _ in range(self.num_workers)]
+        self.worker_random = [None]*self.num_workers
+
     def teardown(self):
 
         if self.workers is not None:
             self.workers.stop()
+            self.workers = None
+
+        self.templates = [None]*self.max_templates
+        self.pinned = [False]*self.max_templates
+        self.buffers = [{} for _ in range(self.max_templates)]
 
     def provide(self, request):
 
@@ -72,59 +195,206 @@ class PreCache(BatchFilter):
         self.last_5.popleft()
         self.last_5.append(request)
 
-        if request != self.current_request:
+        if self.workers is None:
+            self.__start_workers()
 
-            current_count = sum(
-                [
-                    recent_request == self.current_request
-                    for recent_request in self.last_5
-                ]
-            )
-            new_count = sum(
-                [recent_request == request for recent_request in self.last_5]
-            )
-            if new_count > current_count or self.current_request is None:
+        slot = self.__find_template(request)
 
-                if self.workers is not None:
-                    logger.info("new request received, stopping current workers...")
-                    self.workers.stop()
+        if slot is None:
 
-                self.current_request = copy.deepcopy(request)
+            slot = self.__choose_slot(request)
 
-                logger.info("starting new set of workers (%s, cache size %s)...",
-                            self.num_workers, self.cache_size)
-                self.workers = ProducerPool(
-                    [lambda i=i: self.__run_worker(i) for i in range(self.num_workers)],
-                    queue_size=self.cache_size,
-                )
-                self.workers.start()
+            if slot is not None:
 
-                logger.debug("getting batch from queue...")
-                batch = self.workers.get()
+                if self.templates[slot] is not None:
+                    logger.info(
+                        "new request received, replacing cached request "
+                        "in slot %d...", slot)
+                self.__set_template(slot, request, 1.0)
 
-                timing.stop()
-                batch.profiling_stats.add(timing)
+        if slot is not None:
 
-            else:
-                logger.debug("Resolving new request sequentially")
-                batch = self.get_upstream_provider().request_batch(request)
-
-                timing.stop()
-                batch.profiling_stats.add(timing)
+            logger.debug("getting batch from queue...")
+            batch = self.__get_batch(slot)
 
         else:
-            logger.debug("getting batch from queue...")
-            batch = self.workers.get()
 
-            timing.stop()
-            batch.profiling_stats.add(timing)
+            logger.debug("Resolving new request sequentially")
+            batch = self.get_upstream_provider().request_batch(request)
+
+        timing.stop()
+        batch.profiling_stats.add(timing)
+
+        return batch
+
+    def __start_workers(self):
+
+        logger.info("starting new set of workers (%s, cache size %s)...",
+                    self.num_workers, self.cache_size)
+        self.workers = ProducerPool(
+            [lambda i=i: self.__run_worker(i) for i in range(self.num_workers)],
+            queue_size=self.cache_size*self.max_templates,
+            transport=self.transport,
+            slot_size=self.slot_size,
+            backend=self.backend,
+        )
+        self.workers.start()
+
+        for slot, (request, weight) in enumerate(self.initial_templates):
+            self.__set_template(slot, request, weight)
+            self.pinned[slot] = True
+
+    def __find_template(self, request):
+
+        for slot, template in enumerate(self.templates):
+            if template is not None and template == request:
+                return slot
+        return None
+
+    def __choose_slot(self, request):
+        '''Find a slot to cache ``request`` in, or return None if it should be
+        resolved sequentially.'''
+
+        for slot, template in enumerate(self.templates):
+            if template is None:
+                return slot
+
+        # replace the least common of the replaceable templates among the last
+        # 5 requests, if the new request is more common
+        new_count = sum(
+            [recent_request == request for recent_request in self.last_5])
+
+        least_slot = None
+        least_count = None
+        for slot, template in enumerate(self.templates):
+            if self.pinned[slot]:
+                continue
+            count = sum(
+                [recent_request == template for recent_request in self.last_5])
+            if least_count is None or count < least_count:
+                least_slot = slot
+                least_count = count
+
+        if least_slot is not None and new_count > least_count:
+            return least_slot
+
+        return None
+
+    def __set_template(self, slot, request, weight):
+
+        request = copy.deepcopy(request)
+        self.templates[slot] = request
+        self.buffers[slot] = {}
+
+        with self.lock:
+            self.generations[slot] += 1
+            self.produced[slot] = 0
+            self.consumed[slot] = 0
+            generation = self.generations[slot]
+
+        for commands in self.commands:
+            commands.put((slot, generation, request, weight))
+
+    def __get_batch(self, slot):
+
+        buffer = self.buffers[slot]
+
+        # in deterministic mode wait for the batch with the next seed index,
+        # buffer others
+        while True:
+
+            if self.deterministic:
+                next_index = self.consumed[slot]
+                if next_index in buffer:
+                    break
+            elif len(buffer) > 0:
+                next_index = min(buffer.keys())
+                break
+
+            batch_slot, generation, index, batch = self.workers.get()
+
+            if generation != self.generations[batch_slot]:
+                # produced for a template that has been replaced since
+                continue
+            self.buffers[batch_slot][index] = batch
+
+        # failed requests consume their seed index as well, such that the
+        # workers can move on to the next ones
+        batch = buffer.pop(next_index)
+        with self.lock:
+            self.consumed[slot] += 1
+
+        if isinstance(batch, Exception):
+            raise batch
 
         return batch
 
+    def __reserve(self, i):
+        '''Pick a template slot and seed index to produce a batch for (called
+        from the workers).'''
+
+        worker_templates = self.worker_templates[i]
+
+        while not self.workers.stopped():
+
+            commands = self.commands[i]
+            while not commands.empty():
+                slot, generation, request, weight = commands.get()
+                worker_templates[slot] = (generation, request, weight)
+
+            # don't run ahead of the consumer by more than the cache size,
+            # this bounds the number of batches in the queue and buffers
+            with self.lock:
+
+                slots = []
+                weights = []
+                for slot, (generation, _, weight) in worker_templates.items():
+                    if generation != self.generations[slot]:
+                        # we did not receive the current template yet
+                        continue
+                    if self.produced[slot] >= self.consumed[slot] + self.cache_size:
+                        continue
+                    slots.append(slot)
+                    weights.append(weight)
+
+                if len(slots) > 0:
+                    slot = self.worker_random[i].choices(slots, weights)[0]
+                    index = self.produced[slot]
+                    self.produced[slot] += 1
+                    generation, request, _ = worker_templates[slot]
+                    return slot, generation, index, request
+
+            time.sleep(0.01)
+
+        return None
+
     def __run_worker(self, i):
-        request = copy.deepcopy(self.current_request)
-        # Note that using a precache node breaks determinism in batches recieved since we do not
-        # keep a mapping of the order in which random seeds were used, and the order in which
-        # the corresponding batch gets returned.
-        request._random_seed = random.randint(0, 2**32)
-        return self.get_upstream_provider().request_batch(request)
+
+        if self.worker_random[i] is None:
+            self.worker_random[i] = random.Random()
+
+        reserved = self.__reserve(i)
+        if reserved is None:
+            # workers are shutting down
+            return None
+        slot, generation, index, template = reserved
+
+        request = copy.deepcopy(template)
+        if self.deterministic:
+            request._random_seed = template.random_seed + index
+        else:
+            # Note that using a precache node without deterministic=True
+            # breaks determinism in batches recieved since we do not keep a
+            # mapping of the order in which random seeds were used, and the
+            # order in which the corresponding batch gets returned.
+            request._random_seed = random.randint(0, 2**32)
+
+        try:
+            batch = self.get_upstream_provider().request_batch(request)
+        except Exception as e:
+            # pass the exception on in place of the batch, the consumer has
+            # to release the reserved seed index
+            logger.error(e, exc_info=True)
+            batch = e
+
+        return slot, generation, index, batch
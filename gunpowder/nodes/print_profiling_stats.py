@@ -89,6 +89,22 @@ class PrintProfilingStats(BatchFilter):
                 stats += ("%.2f"%summary.median())[:9].ljust(10)
                 stats += "\n"
 
+        counters = list(self.accumulated_stats.get_counters().items())
+        counters.sort()
+
+        if counters:
+            stats += "\n"
+            stats += "NODE".ljust(20)
+            stats += "COUNTER".ljust(30)
+            stats += "VALUE".ljust(10)
+            stats += "\n"
+
+        for (node_name, counter_name), value in counters:
+            stats += node_name[:19].ljust(20)
+            stats += counter_name[:29].ljust(30)
+            stats += ("%d" % value).ljust(10)
+            stats += "\n"
+
         stats += "\n"
         stats += "TOTAL"
         stats += "\n"
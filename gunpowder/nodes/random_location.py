@@ -1,6 +1,5 @@
 import math
 import logging
-from random import random, randint, choices, seed
 import itertools
 
 import numpy as np
@@ -91,9 +90,16 @@ class RandomLocation(BatchFilter):
         self.points = None
         self.p_nonempty = p_nonempty
         self.upstream_spec = None
-        self.random_shift = None
         self.ensure_centered = ensure_centered
         self.point_balance_radius = point_balance_radius
+        self._random_shift = None
+
+    @property
+    def random_shift(self):
+        """The shift chosen for the most recent request. With several requests
+        in flight, this is not necessarily the one of the batch at hand."""
+
+        return self._random_shift
 
     def setup(self):
 
@@ -157,8 +163,8 @@ class RandomLocation(BatchFilter):
                 spec.roi.set_shape(None)
                 self.updates(key, spec)
 
-    def prepare(self, request):
-        seed(request.random_seed)
+    def prepare(self, request, context=None):
+        context = self._get_context(context, request)
 
         logger.debug("request: %s", request.array_specs)
         logger.debug("my spec: %s", self.spec)
@@ -193,14 +199,18 @@ class RandomLocation(BatchFilter):
         random_shift = self.__select_random_shift(
             request,
             lcm_shift_roi,
-            lcm_voxel_size)
+            lcm_voxel_size,
+            context.random)
 
-        self.random_shift = random_shift
+        context.random_shift = random_shift
+        self._random_shift = random_shift
         self.__shift_request(request, random_shift)
 
         return request
 
-    def process(self, batch, request):
+    def process(self, batch, request, context=None):
+
+        context = self._get_context(context)
 
         # reset ROIs to request
         for (array_key, spec) in request.array_specs.items():
@@ -210,7 +220,7 @@ class RandomLocation(BatchFilter):
 
         # change shift point locations to lie within roi
         for graph_key in request.graph_specs.keys():
-            batch.graphs[graph_key].shift(-self.random_shift)
+            batch.graphs[graph_key].shift(-context.random_shift)
 
     def accepts(self, request):
         '''Should return True if the randomly chosen location is acceptable
@@ -249,12 +259,17 @@ class RandomLocation(BatchFilter):
 
         return total_shift_roi
 
-    def __select_random_shift(self, request, lcm_shift_roi, lcm_voxel_size):
+    def __select_random_shift(
+            self,
+            request,
+            lcm_shift_roi,
+            lcm_voxel_size,
+            rng):
 
         ensure_points = (
             self.ensure_nonempty is not None
             and
-            random() <= self.p_nonempty)
+            rng.random() <= self.p_nonempty)
 
         while True:
 
@@ -262,11 +277,13 @@ class RandomLocation(BatchFilter):
                 random_shift = self.__select_random_location_with_points(
                     request,
                     lcm_shift_roi,
-                    lcm_voxel_size)
+                    lcm_voxel_size,
+                    rng)
             else:
                 random_shift = self.__select_random_location(
                     lcm_shift_roi,
-                    lcm_voxel_size)
+                    lcm_voxel_size,
+                    rng)
 
             logger.debug("random shift: " + str(random_shift))
 
@@ -330,7 +347,8 @@ class RandomLocation(BatchFilter):
             self,
             request,
             lcm_shift_roi,
-            lcm_voxel_size):
+            lcm_voxel_size,
+            rng):
 
         request_points = request.graph_specs.get(self.ensure_nonempty)
         if request_points is None:
@@ -375,7 +393,8 @@ class RandomLocation(BatchFilter):
             #                   request.shape
 
             # pick a random point
-            point = choices(self.points.data, cum_weights=self.cumulative_weights)[0]
+            point = rng.choices(
+                self.points.data, cum_weights=self.cumulative_weights)[0]
 
             logger.debug("select random point at %s", point)
 
@@ -423,7 +442,8 @@ class RandomLocation(BatchFilter):
             # select a random shift from all possible shifts
             random_shift = self.__select_random_location(
                 lcm_point_shift_roi,
-                lcm_voxel_size)
+                lcm_voxel_size,
+                rng)
             logger.debug("random shift: %s", random_shift)
 
             # count all points inside the shifted ROI
@@ -436,11 +456,11 @@ class RandomLocation(BatchFilter):
 
             return random_shift
 
-    def __select_random_location(self, lcm_shift_roi, lcm_voxel_size):
+    def __select_random_location(self, lcm_shift_roi, lcm_voxel_size, rng):
 
         # select a random point inside ROI
         random_shift = Coordinate(
-            randint(begin, end - 1)
+            rng.randint(begin, end - 1)
             for begin, end in zip(lcm_shift_roi.get_begin(), lcm_shift_roi.get_end()))
 
         random_shift *= lcm_voxel_size
@@ -1,6 +1,10 @@
+import itertools
 import logging
 import multiprocessing
 import numpy as np
+import queue
+import sqlite3
+import time
 import tqdm
 from gunpowder.array import Array
 from gunpowder.batch import Batch
@@ -9,10 +13,218 @@ from gunpowder.graph import Graph
 from gunpowder.producer_pool import ProducerPool
 from gunpowder.roi import Roi
 from .batch_filter import BatchFilter
+from .hdf5like_write_base import Hdf5LikeWrite
 
 logger = logging.getLogger(__name__)
 
 
+class ScanJournal(object):
+    '''A journal of the chunks completed by a :class:`Scan`, stored in a
+    sqlite database.
+
+    Every completed chunk is recorded in table ``chunks`` with the columns
+    ``scan`` (identifying the reference request and scanned ROI), ``shift``
+    (the offset applied to the reference, as comma separated integers),
+    ``start`` (the UNIX time at which the chunk was requested), and
+    ``duration`` (the time in seconds it took to produce the chunk). The
+    latter two can be used to analyse the throughput of a scan.
+
+    Args:
+
+        filename (``string``):
+
+            The sqlite database file, created if it does not exist.
+    '''
+
+    def __init__(self, filename):
+
+        self.filename = filename
+        self.connection = None
+
+    def open(self):
+
+        self.connection = sqlite3.connect(self.filename)
+        # don't sync on every commit, but stay consistent on crashes
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS chunks ("
+            "scan TEXT, shift TEXT, start REAL, duration REAL, "
+            "PRIMARY KEY (scan, shift))")
+        self.connection.commit()
+
+    def close(self):
+
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def completed(self, scan):
+        '''Get the set of shifts that have been completed for ``scan``.'''
+
+        rows = self.connection.execute(
+            "SELECT shift FROM chunks WHERE scan = ?", (scan,))
+
+        return set(
+            Coordinate(int(x) for x in shift.split(','))
+            for (shift,) in rows)
+
+    def record(self, scan, shift, start, duration):
+        '''Record that the chunk at ``shift`` of ``scan`` has been completed.'''
+
+        self.connection.execute(
+            "INSERT OR REPLACE INTO chunks VALUES (?, ?, ?, ?)",
+            (scan, ','.join(str(x) for x in shift), start, duration))
+        self.connection.commit()
+
+
+class ShiftGrid(object):
+    '''The shifts of a :class:`Scan`, arranged on a regular grid and
+    enumerated lazily.
+
+    Only the shift values along each axis are stored. Iterating over the grid
+    yields the shifts as :class:`Coordinate`, in one of the following
+    orders:
+
+        ``"scanline"``: The first dimension varies fastest, the last one
+        slowest.
+
+        ``"zorder"``: Shifts are visited along a Z-order (Morton) curve over
+        the grid indices.
+
+        ``"hilbert"``: Shifts are visited along a Hilbert curve over the grid
+        indices.
+
+    The latter two keep consecutive shifts close to each other, such that
+    consecutive chunks tend to share cached data. They require to sort all
+    grid indices, i.e., eight bytes of memory per shift.
+
+    Args:
+
+        axes (``list`` of ``list`` of ``int``):
+
+            The shift values along each dimension.
+
+        order (``string``, optional):
+
+            The order in which to visit the shifts, see above.
+    '''
+
+    orders = ["scanline", "zorder", "hilbert"]
+
+    # how many shifts to convert to coordinates at once for curve orders
+    block_size = 4096
+
+    def __init__(self, axes, order="scanline"):
+
+        assert order in self.orders, (
+            "order has to be one of %s" % self.orders)
+
+        self.axes = [[int(x) for x in axis] for axis in axes]
+        self.shape = tuple(len(axis) for axis in self.axes)
+        self.order = order
+        self.__axis_sets = None
+
+    def __len__(self):
+
+        return int(np.prod(self.shape, dtype=np.int64))
+
+    def __contains__(self, shift):
+
+        if self.__axis_sets is None:
+            self.__axis_sets = [set(axis) for axis in self.axes]
+
+        return len(shift) == len(self.axes) and all(
+            x in axis for x, axis in zip(shift, self.__axis_sets))
+
+    def __iter__(self):
+
+        if self.order == "scanline":
+
+            # itertools.product varies the last element fastest
+            for shift in itertools.product(*self.axes[::-1]):
+                yield Coordinate(shift[::-1])
+
+        else:
+
+            axes = [np.array(axis, dtype=np.int64) for axis in self.axes]
+            order = self.__curve_order()
+
+            for begin in range(0, len(order), self.block_size):
+                indices = np.unravel_index(
+                    order[begin:begin + self.block_size],
+                    self.shape)
+                shifts = np.stack(
+                    [axis[index] for axis, index in zip(axes, indices)],
+                    axis=1)
+                for shift in shifts:
+                    yield Coordinate(shift)
+
+    def __curve_order(self):
+        '''Get the flat grid indices, sorted by their position on the
+        space-filling curve.'''
+
+        dims = len(self.shape)
+        bits = max(1, int(np.ceil(np.log2(max(self.shape)))))
+        assert bits*dims <= 64, (
+            "grid of shape %s is too large for order %s" % (
+                self.shape, self.order))
+
+        indices = [
+            index.astype(np.uint64)
+            for index in np.unravel_index(
+                np.arange(len(self), dtype=np.int64),
+                self.shape)
+        ]
+
+        if self.order == "hilbert":
+            indices = self.__hilbert_transpose(indices, bits)
+
+        # interleave the bits of all dimensions, most significant first
+        keys = np.zeros(len(self), dtype=np.uint64)
+        for b in range(bits - 1, -1, -1):
+            for index in indices:
+                keys = (keys << np.uint64(1)) | (
+                    (index >> np.uint64(b)) & np.uint64(1))
+
+        return np.argsort(keys, kind="stable")
+
+    def __hilbert_transpose(self, x, bits):
+        '''Convert grid indices into the "transposed" Hilbert index of
+        Skilling (2004, "Programming the Hilbert curve"), vectorized over all
+        indices. Interleaving the bits of the result gives the Hilbert index.'''
+
+        x = [index.copy() for index in x]
+        n = len(x)
+        m = np.uint64(1 << (bits - 1))
+
+        # inverse undo excess work
+        q = m
+        while q > 1:
+            p = q - np.uint64(1)
+            for i in range(n):
+                flip = (x[i] & q) != 0
+                t = (x[0] ^ x[i]) & p
+                t[flip] = 0
+                x[0] = np.where(flip, x[0] ^ p, x[0] ^ t)
+                if i > 0:
+                    x[i] = x[i] ^ t
+            q = q >> np.uint64(1)
+
+        # gray encode
+        for i in range(1, n):
+            x[i] = x[i] ^ x[i - 1]
+        t = np.zeros_like(x[0])
+        q = m
+        while q > 1:
+            t = np.where((x[n - 1] & q) != 0, t ^ (q - np.uint64(1)), t)
+            q = q >> np.uint64(1)
+        for i in range(n):
+            x[i] = x[i] ^ t
+
+        return x
+
+
 class Scan(BatchFilter):
     '''Iteratively requests batches of size ``reference`` from upstream
     providers in a scanning fashion, until all requested ROIs are covered. If
@@ -22,6 +234,16 @@ class Scan(BatchFilter):
     upstream requests will be contained in the downstream requested ROI or
     upstream ROIs.
 
+    To process volumes that do not fit into memory, place a writer like
+    :class:`ZarrWrite` upstream of this node and send an empty request. Chunks
+    are then discarded as soon as they have been written, and at most
+    ``cache_size`` plus ``num_workers`` chunks are in flight at any time.
+    Alternatively, pass a ``sink`` to receive every chunk as it is finished.
+
+    Long running scans of empty requests can be resumed by passing a
+    ``journal`` file. Chunks that are recorded in the journal as completed
+    will be skipped when the same scan is started again.
+
     See also :class:`Hdf5Write`.
 
     Args:
@@ -40,23 +262,80 @@ class Scan(BatchFilter):
         cache_size (``int``, optional):
 
             If multiple workers are used, how many batches to hold at most.
+
+        backend (``string``, optional):
+
+            If multiple workers are used, whether they are processes
+            (``"process"``, the default) or threads (``"thread"``), see
+            :class:`ProducerPool`.
+
+        sink (callable, optional):
+
+            A function to call with every chunk (a :class:`Batch`) as soon as
+            it is finished, in the order in which chunks finish. Chunks are
+            passed to the sink before they are discarded (for empty requests)
+            or copied into the returned batch.
+
+        journal (``string``, optional):
+
+            Path to a sqlite file to record completed chunks and their timing
+            in, see :class:`ScanJournal`. For empty requests, chunks already
+            recorded for the same reference and upstream ROIs are skipped.
+            Requests that are not empty are always scanned completely, since
+            the returned batch has to be assembled from all chunks. A chunk is
+            recorded as soon as it returns to this node, writers upstream
+            therefore must not hold back data (``write_behind`` is not
+            supported together with a journal).
+
+        order (``string``, optional):
+
+            The order in which to scan the chunks. ``"scanline"`` (the
+            default) varies the first dimension fastest, ``"zorder"`` and
+            ``"hilbert"`` follow a space-filling curve to keep consecutive
+            chunks close to each other. See :class:`ShiftGrid`.
     '''
 
-    def __init__(self, reference, num_workers=1, cache_size=50):
+    def __init__(
+            self,
+            reference,
+            num_workers=1,
+            cache_size=50,
+            backend="process",
+            sink=None,
+            journal=None,
+            order="scanline"):
+
+        assert order in ShiftGrid.orders, (
+            "order has to be one of %s" % ShiftGrid.orders)
 
         self.reference = reference.copy()
         self.num_workers = num_workers
         self.cache_size = cache_size
+        self.backend = backend
+        self.sink = sink
+        self.journal = ScanJournal(journal) if journal is not None else None
+        self.order = order
         self.workers = None
-        self.batch = None
 
     def setup(self):
 
+        if self.journal is not None:
+            for node in self.__upstream_nodes():
+                if isinstance(node, Hdf5LikeWrite) and node.write_behind:
+                    raise RuntimeError(
+                        "%s writes behind, chunks could be recorded as "
+                        "completed in the journal of %s before their data is "
+                        "stored" % (node.name(), self.name()))
+
         if self.num_workers > 1:
-            self.request_queue = multiprocessing.Queue(maxsize=0)
+            if self.backend == "thread":
+                self.request_queue = queue.Queue(maxsize=0)
+            else:
+                self.request_queue = multiprocessing.Queue(maxsize=0)
             self.workers = ProducerPool(
                 [self.__worker_get_chunk for _ in range(self.num_workers)],
-                queue_size=self.cache_size)
+                queue_size=self.cache_size,
+                backend=self.backend)
             self.workers.start()
 
     def teardown(self):
@@ -72,51 +351,118 @@ class Scan(BatchFilter):
         else:
             scan_spec = request
 
+        # whether the chunks' data is needed here, or can be dropped right
+        # after it has been produced
+        keep_chunks = not empty_request or self.sink is not None
+
         stride = self.__get_stride()
         shift_roi = self.__get_shift_roi(scan_spec)
 
         shifts = self.__enumerate_shifts(shift_roi, stride)
         num_chunks = len(shifts)
 
+        if self.journal is not None:
+            self.journal.open()
+            scan = self.__get_scan_id(shift_roi)
+            if empty_request:
+                completed = self.journal.completed(scan)
+                completed = set(s for s in completed if s in shifts)
+                if completed:
+                    logger.info(
+                        "skipping %d chunks completed earlier",
+                        len(completed))
+                    num_chunks -= len(completed)
+                    shifts = (s for s in shifts if s not in completed)
+
         logger.info("scanning over %d chunks", num_chunks)
 
         # the batch to return
-        self.batch = Batch()
+        batch = Batch()
 
-        if self.num_workers > 1:
+        try:
 
-            for shift in shifts:
-                shifted_reference = self.__shift_request(self.reference, shift)
-                self.request_queue.put(shifted_reference)
+            if self.num_workers > 1:
 
-            for i in tqdm.tqdm(range(num_chunks)):
+                # don't queue more requests than can be held by the workers
+                # and the cache, such that the number of chunks in memory is
+                # bounded
+                shifts = iter(shifts)
+                num_in_flight = self.cache_size + self.num_workers
+                for shift in itertools.islice(shifts, num_in_flight):
+                    self.__queue_request(shift, keep_chunks)
 
-                chunk = self.workers.get()
+                for i in tqdm.tqdm(range(num_chunks)):
 
-                if not empty_request:
-                    self.__add_to_batch(request, chunk)
+                    shift, start, duration, chunk = self.workers.get()
 
-                logger.debug("processed chunk %d/%d", i + 1, num_chunks)
+                    for next_shift in itertools.islice(shifts, 1):
+                        self.__queue_request(next_shift, keep_chunks)
 
-        else:
+                    batch = self.__handle_chunk(batch, request, chunk)
+                    if self.journal is not None:
+                        self.journal.record(scan, shift, start, duration)
 
-            for i, shift in tqdm.tqdm(enumerate(shifts)):
+                    logger.debug("processed chunk %d/%d", i + 1, num_chunks)
 
-                shifted_reference = self.__shift_request(self.reference, shift)
-                chunk = self.__get_chunk(shifted_reference)
+            else:
+
+                for i, shift in tqdm.tqdm(enumerate(shifts), total=num_chunks):
+
+                    shifted_reference = self.__shift_request(
+                        self.reference, shift)
+                    start = time.time()
+                    chunk = self.__get_chunk(shifted_reference)
+                    duration = time.time() - start
 
-                if not empty_request:
-                    self.__add_to_batch(request, chunk)
+                    batch = self.__handle_chunk(batch, request, chunk)
+                    if self.journal is not None:
+                        self.journal.record(scan, shift, start, duration)
 
-                logger.debug("processed chunk %d/%d", i + 1, num_chunks)
+                    logger.debug("processed chunk %d/%d", i + 1, num_chunks)
 
-        batch = self.batch
-        self.batch = None
+        finally:
+
+            if self.journal is not None:
+                self.journal.close()
 
         logger.debug("returning batch %s", batch)
 
         return batch
 
+    def __upstream_nodes(self):
+
+        nodes = list(self.get_upstream_providers())
+        while nodes:
+            node = nodes.pop()
+            yield node
+            nodes += node.get_upstream_providers()
+
+    def __get_scan_id(self, shift_roi):
+        '''Get a string identifying a scan over ``shift_roi`` with the
+        reference request, to tell apart scans in a journal.'''
+
+        reference = sorted(
+            "%s:%s" % (key, spec.roi)
+            for key, spec in self.reference.items())
+
+        return ";".join(reference + ["shifts:%s" % shift_roi])
+
+    def __handle_chunk(self, batch, request, chunk):
+
+        if self.sink is not None:
+            self.sink(chunk)
+
+        if len(request) == 0:
+            batch.profiling_stats.merge_with(chunk.profiling_stats)
+            return batch
+
+        return self.__add_to_batch(batch, request, chunk)
+
+    def __queue_request(self, shift, keep_chunk):
+
+        shifted_reference = self.__shift_request(self.reference, shift)
+        self.request_queue.put((shift, shifted_reference, keep_chunk))
+
     def __get_stride(self):
         '''Get the maximal amount by which ``reference`` can be moved, such
         that it tiles the space.'''
@@ -256,37 +602,17 @@ class Scan(BatchFilter):
         max_shift = max(min_shift,
                         Coordinate(m - 1 for m in shift_roi.get_end()))
 
-        shift = np.array(min_shift)
-        shifts = []
-
-        dims = len(min_shift)
-
         logger.debug(
             "enumerating possible shifts of %s in %s", stride, shift_roi)
 
-        while True:
-
-            logger.debug("adding %s", shift)
-            shifts.append(Coordinate(shift))
-
-            if (shift == max_shift).all():
-                break
-
-            # count up dimensions
-            for d in range(dims):
-
-                if shift[d] >= max_shift[d]:
-                    if d == dims - 1:
-                        break
-                    shift[d] = min_shift[d]
-                else:
-                    shift[d] += stride[d]
-                    # snap to last possible shift, don't overshoot
-                    if shift[d] > max_shift[d]:
-                        shift[d] = max_shift[d]
-                    break
+        # in each dimension, progress with stride and snap the last shift to
+        # the maximum, don't overshoot
+        axes = [
+            np.append(np.arange(begin, end, step), end)
+            for begin, end, step in zip(min_shift, max_shift, stride)
+        ]
 
-        return shifts
+        return ShiftGrid(axes, self.order)
 
     def __shift_request(self, request, shift):
 
@@ -298,32 +624,51 @@ class Scan(BatchFilter):
 
     def __worker_get_chunk(self):
 
-        request = self.request_queue.get()
-        return self.__get_chunk(request)
+        while True:
+            try:
+                shift, request, keep_chunk = self.request_queue.get(timeout=1)
+                break
+            except queue.Empty:
+                if self.workers.stopped():
+                    return None
+
+        start = time.time()
+        chunk = self.__get_chunk(request)
+        duration = time.time() - start
+
+        if not keep_chunk:
+            # don't send the data back, only the profiling stats
+            stats = Batch()
+            stats.profiling_stats = chunk.profiling_stats
+            chunk = stats
+
+        return shift, start, duration, chunk
 
     def __get_chunk(self, request):
 
         return self.get_upstream_provider().request_batch(request)
 
-    def __add_to_batch(self, spec, chunk):
+    def __add_to_batch(self, batch, spec, chunk):
 
-        if self.batch.get_total_roi() is None:
-            self.batch = self.__setup_batch(spec, chunk)
-        self.batch.profiling_stats.merge_with(chunk.profiling_stats)
+        if batch.get_total_roi() is None:
+            batch = self.__setup_batch(spec, chunk)
+        batch.profiling_stats.merge_with(chunk.profiling_stats)
 
         for (array_key, array) in chunk.arrays.items():
             if array_key not in spec:
                 continue
-            self.__fill(self.batch.arrays[array_key].data, array.data,
+            self.__fill(batch.arrays[array_key].data, array.data,
                         spec.array_specs[array_key].roi, array.spec.roi,
                         self.spec[array_key].voxel_size)
 
         for (graph_key, graphs) in chunk.graphs.items():
             if graph_key not in spec:
                 continue
-            self.__fill_points(self.batch.graphs[graph_key], graphs,
+            self.__fill_points(batch.graphs[graph_key], graphs,
                                spec.graph_specs[graph_key].roi, graphs.spec.roi)
 
+        return batch
+
     def __setup_batch(self, batch_spec, chunk):
         '''Allocate a batch matching the sizes of ``batch_spec``, using
         ``chunk`` as template.'''
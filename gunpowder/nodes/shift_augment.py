@@ -26,11 +26,9 @@ class ShiftAugment(BatchFilter):
 
         self.ndim = None
         self.shift_sigmas = None
-        self.shift_array = None
-        self.lcm_voxel_size = None
 
-    def prepare(self, request):
-        random.seed(request.random_seed)
+    def prepare(self, request, context=None):
+        context = self._get_context(context, request)
         
         self.ndim = request.get_total_roi().dims()
         assert self.shift_axis in range(self.ndim)
@@ -57,24 +55,26 @@ class ShiftAugment(BatchFilter):
                              "Check to make sure that Jitter node is not upstream of a RandomLocation node " +
                              "with an ensure_nonempty argument.")
 
-        self.lcm_voxel_size = self.spec.get_lcm_voxel_size(array_keys=request.array_specs.keys())
-        assert self.lcm_voxel_size
+        context.lcm_voxel_size = self.spec.get_lcm_voxel_size(array_keys=request.array_specs.keys())
+        assert context.lcm_voxel_size
 
         roi_shape = request.get_total_roi().get_shape()
-        assert roi_shape // self.lcm_voxel_size * self.lcm_voxel_size == roi_shape, \
-            "total roi shape {} must be divisible by least common voxel size {}".format(roi_shape, self.lcm_voxel_size)
-        roi_shape_adjusted = roi_shape // self.lcm_voxel_size
+        assert roi_shape // context.lcm_voxel_size * context.lcm_voxel_size == roi_shape, \
+            "total roi shape {} must be divisible by least common voxel size {}".format(roi_shape, context.lcm_voxel_size)
+        roi_shape_adjusted = roi_shape // context.lcm_voxel_size
         shift_axis_len = roi_shape_adjusted[self.shift_axis]
 
-        self.shift_array = self.construct_global_shift_array(shift_axis_len,
-                                                             self.shift_sigmas,
-                                                             self.prob_slip,
-                                                             self.prob_shift,
-                                                             self.lcm_voxel_size)
+        context.shift_array = self.construct_global_shift_array(shift_axis_len,
+                                                                self.shift_sigmas,
+                                                                self.prob_slip,
+                                                                self.prob_shift,
+                                                                context.lcm_voxel_size,
+                                                                context.random,
+                                                                context.np_random)
 
         for key, spec in request.items():
             sub_shift_array = self.get_sub_shift_array(request.get_total_roi(), spec.roi,
-                                                       self.shift_array, self.shift_axis, self.lcm_voxel_size)
+                                                       context.shift_array, self.shift_axis, context.lcm_voxel_size)
             updated_roi = self.compute_upstream_roi(spec.roi, sub_shift_array)
             spec.roi.set_offset(updated_roi.get_offset())
             spec.roi.set_shape(updated_roi.get_shape())
@@ -83,28 +83,29 @@ class ShiftAugment(BatchFilter):
         deps = request
         return deps
 
-    def process(self, batch, request):
+    def process(self, batch, request, context=None):
+        context = self._get_context(context)
         for array_key, array in batch.arrays.items():
             sub_shift_array = self.get_sub_shift_array(request.get_total_roi(), array.spec.roi,
-                                                       self.shift_array, self.shift_axis, self.lcm_voxel_size)
+                                                       context.shift_array, self.shift_axis, context.lcm_voxel_size)
             array.data = self.shift_and_crop(array.data,
                                              request[array_key].roi.get_shape(),
                                              sub_shift_array,
                                              array.spec.voxel_size)
             array.spec.roi = request[array_key].roi
-            assert request[array_key].roi.get_shape() == Coordinate(array.data.shape) * self.lcm_voxel_size, \
+            assert request[array_key].roi.get_shape() == Coordinate(array.data.shape) * context.lcm_voxel_size, \
                 'request roi shape {} is not the same as generated array shape {}'.format(
                     request[array_key].roi.get_shape(), array.data.shape)
             batch[array_key] = array
 
         for points_key, points in batch.graphs.items():
             sub_shift_array = self.get_sub_shift_array(request.get_total_roi(), points.spec.roi,
-                                                       self.shift_array, self.shift_axis, self.lcm_voxel_size)
+                                                       context.shift_array, self.shift_axis, context.lcm_voxel_size)
             points = self.shift_points(points,
                                        request[points_key].roi,
                                        sub_shift_array,
                                        self.shift_axis,
-                                       self.lcm_voxel_size)
+                                       context.lcm_voxel_size)
             batch[points_key] = points
 
     def shift_and_crop(self, arr, roi_shape, sub_shift_array, voxel_size):
@@ -190,7 +191,9 @@ class ShiftAugment(BatchFilter):
         return shift_array[offset_in_shift_axis: offset_in_shift_axis + len_in_shift_axis]
 
     @staticmethod
-    def construct_global_shift_array(shift_axis_len, shift_sigmas, prob_slip, prob_shift, lcm_voxel_size):
+    def construct_global_shift_array(shift_axis_len, shift_sigmas, prob_slip, prob_shift, lcm_voxel_size,
+                                     random=random,
+                                     np_random=np.random):
         """ Sets the attribute variable self.shift_array
 
         :param shift_axis_len: the length of the shift axis
@@ -198,6 +201,8 @@ class ShiftAugment(BatchFilter):
         :param prob_slip: the probability of the slice shifting independently of all other slices
         :param prob_shift: the probability of the slice and all following slices shifting
         :param lcm_voxel_size: the least common voxel size of all the arrays in the request
+        :param random: the generator to draw the kind of shift from (default: ``random``)
+        :param np_random: the generator to draw the shift amounts from (default: ``numpy.random``)
         :return: the shift_array for the total_roi
         """
         # each row is one slice along shift axis
@@ -207,7 +212,7 @@ class ShiftAugment(BatchFilter):
 
         for shift_axis_position in range(shift_axis_len):
             r = random.random()
-            slip = np.array([np.random.normal(scale=sigma / lcm_voxel_size[dimension])
+            slip = np.array([np_random.normal(scale=sigma / lcm_voxel_size[dimension])
                              for dimension, sigma in enumerate(shift_sigmas)])
             slip = np.rint(slip).astype(int)
             slip = slip * np.array(lcm_voxel_size, dtype=int)
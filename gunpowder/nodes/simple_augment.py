@@ -1,5 +1,4 @@
 import logging
-import random
 import itertools
 
 import numpy as np
@@ -107,44 +106,50 @@ class SimpleAugment(BatchFilter):
                 if valid:
                     self.permutation_dict[k] = v
 
-    def prepare(self, request):
-        random.seed(request.random_seed)
+    def prepare(self, request, context=None):
+        context = self._get_context(context, request)
 
-        self.mirror = [
-            random.random() < self.mirror_probs[d] if self.mirror_mask[d] else 0
+        context.mirror = [
+            context.random.random() < self.mirror_probs[d]
+            if self.mirror_mask[d]
+            else 0
             for d in range(self.dims)
         ]
 
         if self.permutation_dict is not None:
-            t = random.choices(
+            t = context.random.choices(
                 list(self.permutation_dict.keys()),
                 weights=list(self.permutation_dict.values()),
                 k=1,
             )[0]
         else:
-            t = random.sample(self.transpose_dims, k=len(self.transpose_dims))
+            t = context.random.sample(
+                self.transpose_dims, k=len(self.transpose_dims)
+            )
 
-        self.transpose = list(range(self.dims))
+        context.transpose = list(range(self.dims))
         for o, n in zip(self.transpose_dims, t):
-            self.transpose[o] = n
+            context.transpose[o] = n
 
-        logger.debug("mirror = %s", self.mirror)
-        logger.debug("transpose = %s", self.transpose)
+        logger.debug("mirror = %s", context.mirror)
+        logger.debug("transpose = %s", context.transpose)
 
         reverse_transpose = [0] * self.dims
         for d in range(self.dims):
-            reverse_transpose[self.transpose[d]] = d
+            reverse_transpose[context.transpose[d]] = d
 
         logger.debug("downstream request = %s", request)
 
         self.__transpose_request(request, reverse_transpose)
-        self.__mirror_request(request, self.mirror)
+        self.__mirror_request(request, context.mirror)
 
         logger.debug("upstream request = %s", request)
 
         return request
 
-    def process(self, batch, request):
+    def process(self, batch, request, context=None):
+
+        context = self._get_context(context)
 
         # mirror and transpose ROIs of arrays & points in batch
         total_roi = batch.get_total_roi().copy()
@@ -159,14 +164,14 @@ class SimpleAugment(BatchFilter):
                     continue
                 logger.debug("total ROI = %s", batch.get_total_roi())
                 logger.debug("upstream %s ROI = %s", key, collector.spec.roi)
-                self.__mirror_roi(collector.spec.roi, total_roi, self.mirror)
+                self.__mirror_roi(collector.spec.roi, total_roi, context.mirror)
                 logger.debug("mirrored %s ROI = %s", key, collector.spec.roi)
                 self.__transpose_roi(
-                    collector.spec.roi, total_roi, self.transpose, lcm_voxel_size
+                    collector.spec.roi, total_roi, context.transpose, lcm_voxel_size
                 )
                 logger.debug("transposed %s ROI = %s", key, collector.spec.roi)
 
-        mirror = tuple(slice(None, None, -1 if m else 1) for m in self.mirror)
+        mirror = tuple(slice(None, None, -1 if m else 1) for m in context.mirror)
         # arrays
         for (array_key, array) in batch.arrays.items():
 
@@ -181,7 +186,7 @@ class SimpleAugment(BatchFilter):
 
             array.data = array.data[channel_slices + mirror]
 
-            transpose = [t + num_channels for t in self.transpose]
+            transpose = [t + num_channels for t in context.transpose]
             array.data = array.data = array.data.transpose(
                 list(range(num_channels)) + transpose
             )
@@ -214,7 +219,7 @@ class SimpleAugment(BatchFilter):
                         total_roi_end[dim] - location_in_total_offset[dim]
                         if m
                         else node.location[dim]
-                        for dim, m in enumerate(self.mirror)
+                        for dim, m in enumerate(context.mirror)
                     ],
                     dtype=graph.spec.dtype,
                 )
@@ -224,10 +229,10 @@ class SimpleAugment(BatchFilter):
                 # transpose
                 location_in_total_center = np.asarray(node.location) - total_roi_center
 
-                if self.transpose != list(range(self.dims)):
+                if context.transpose != list(range(self.dims)):
                     for d in range(self.dims):
                         node.location[d] = (
-                            location_in_total_center[self.transpose[d]]
+                            location_in_total_center[context.transpose[d]]
                             + total_roi_center[d]
                         )
 
@@ -1,6 +1,7 @@
 import logging
-import numpy as np
 import os
+import queue
+import threading
 
 from .batch_filter import BatchFilter
 from gunpowder.batch_request import BatchRequest
@@ -60,6 +61,26 @@ class Snapshot(BatchFilter):
         store_value_range (``bool``):
 
             If set to ``True``, store range of values in data set attributes.
+
+        async_write (``bool``):
+
+            If set to ``True``, snapshots are written by a background thread.
+            The data to store is copied in :func:`process`, such that the batch
+            can move on (and be modified downstream) right away.
+
+        max_pending (``int``):
+
+            How many snapshots can wait to be written by the background thread.
+            If that many are pending, :func:`process` blocks until the oldest
+            one has been written (or drops the snapshot, see
+            ``drop_if_busy``).
+
+        drop_if_busy (``bool``):
+
+            If set to ``True`` (and ``async_write`` is set), snapshots are
+            skipped with a warning instead of waiting for the background
+            thread, if ``max_pending`` snapshots are already waiting to be
+            written.
         """
 
     def __init__(
@@ -72,6 +93,9 @@ class Snapshot(BatchFilter):
         compression_type=None,
         dataset_dtypes=None,
         store_value_range=False,
+        async_write=False,
+        max_pending=1,
+        drop_if_busy=False,
     ):
         self.dataset_names = dataset_names
         self.output_dir = output_dir
@@ -90,6 +114,25 @@ class Snapshot(BatchFilter):
 
         self.mode = "w"
 
+        self.async_write = async_write
+        self.max_pending = max_pending
+        self.drop_if_busy = drop_if_busy
+        self.write_queue = None
+        self.writer = None
+        self.writer_error = None
+
+    def teardown(self):
+
+        if self.writer is None:
+            return
+
+        # let the writer finish pending snapshots
+        self.write_queue.put(None)
+        self.writer.join()
+        self.writer = None
+        self.write_queue = None
+        self.__raise_writer_error()
+
     def setup(self):
 
         for key, _ in self.additional_request.items():
@@ -103,16 +146,18 @@ class Snapshot(BatchFilter):
             spec = self.spec[graph_key]
             self.updates(graph_key, spec)
 
-    def prepare(self, request):
+    def prepare(self, request, context=None):
+
+        context = self._get_context(context, request)
 
         deps = BatchRequest()
         for key, spec in request.items():
             if key in self.dataset_names:
                 deps[key] = spec
 
-        self.record_snapshot = self.n % self.every == 0
+        context.record_snapshot = self.n % self.every == 0
 
-        if self.record_snapshot:
+        if context.record_snapshot:
             # append additional array requests, don't overwrite existing ones
             for array_key, spec in self.additional_request.array_specs.items():
                 if array_key not in deps:
@@ -128,14 +173,11 @@ class Snapshot(BatchFilter):
 
         return deps
 
-    def process(self, batch, request):
+    def process(self, batch, request, context=None):
 
-        if self.record_snapshot:
+        context = self._get_context(context)
 
-            try:
-                os.makedirs(self.output_dir)
-            except:
-                pass
+        if context.record_snapshot:
 
             snapshot_name = os.path.join(
                 self.output_dir,
@@ -143,85 +185,140 @@ class Snapshot(BatchFilter):
                     id=str(batch.id).zfill(8), iteration=int(batch.iteration or 0)
                 ),
             )
-            logger.info("saving to %s" % snapshot_name)
-            if snapshot_name.endswith(".hdf"):
-                open_func = h5py.File
-            elif snapshot_name.endswith(".zarr"):
-                open_func = ZarrFile
+
+            datasets = self.__get_datasets(batch)
+            root_attrs = {}
+            if batch.loss is not None:
+                root_attrs["loss"] = float(batch.loss)
+
+            if self.async_write:
+                self.__write_async(snapshot_name, datasets, root_attrs)
             else:
-                logger.warning("ambiguous file type")
-                open_func = h5py.File
-
-            with open_func(snapshot_name, self.mode) as f:
-                for (array_key, array) in batch.arrays.items():
-
-                    if array_key not in self.dataset_names:
-                        continue
-
-                    ds_name = self.dataset_names[array_key]
-
-                    if array_key in self.dataset_dtypes:
-                        dtype = self.dataset_dtypes[array_key]
-                        dataset = f.create_dataset(
-                            name=ds_name,
-                            data=array.data.astype(dtype),
-                            compression=self.compression_type,
-                        )
-
-                    else:
-                        dataset = f.create_dataset(
-                            name=ds_name,
-                            data=array.data,
-                            compression=self.compression_type,
-                        )
-
-                    if not array.spec.nonspatial:
-                        if array.spec.roi is not None:
-                            dataset.attrs["offset"] = array.spec.roi.get_offset()
-                        dataset.attrs["resolution"] = self.spec[array_key].voxel_size
-
-                    if self.store_value_range:
-                        dataset.attrs["value_range"] = (
-                            np.asscalar(array.data.min()),
-                            np.asscalar(array.data.max()),
-                        )
-
-                    # if array has attributes, add them to the dataset
-                    for attribute_name, attribute in array.attrs.items():
-                        dataset.attrs[attribute_name] = attribute
-
-                for (graph_key, graph) in batch.graphs.items():
-                    if graph_key not in self.dataset_names:
-                        continue
-
-                    ds_name = self.dataset_names[graph_key]
-
-                    node_ids = []
-                    locations = []
-                    edges = []
-                    for node in graph.nodes:
-                        node_ids.append(node.id)
-                        locations.append(node.location)
-                    for edge in graph.edges:
-                        edges.append((edge.u, edge.v))
-
-                    f.create_dataset(
-                        name=f"{ds_name}-ids",
-                        data=np.array(node_ids, dtype=int),
-                        compression=self.compression_type,
-                    )
-                    f.create_dataset(
-                        name=f"{ds_name}-locations",
-                        data=np.array(locations),
-                        compression=self.compression_type,
-                    )
-                    f.create_dataset(
-                        name=f"{ds_name}-edges",
-                        data=np.array(edges),
-                        compression=self.compression_type,
-                    )
-
-                if batch.loss is not None:
-                    f["/"].attrs["loss"] = float(batch.loss)
+                self.__write(snapshot_name, datasets, root_attrs)
 
         self.n += 1
+
+    def __get_datasets(self, batch):
+        """Get a list of ``(name, data, attrs)`` to store for the given batch.
+        Data is copied if the snapshot is written asynchronously."""
+
+        datasets = []
+
+        for (array_key, array) in batch.arrays.items():
+
+            if array_key not in self.dataset_names:
+                continue
+
+            ds_name = self.dataset_names[array_key]
+
+            if array_key in self.dataset_dtypes:
+                data = array.data.astype(self.dataset_dtypes[array_key])
+            elif self.async_write:
+                data = array.data.copy()
+            else:
+                data = array.data
+
+            attrs = {}
+            if not array.spec.nonspatial:
+                if array.spec.roi is not None:
+                    attrs["offset"] = array.spec.roi.get_offset()
+                attrs["resolution"] = self.spec[array_key].voxel_size
+
+            if self.store_value_range:
+                attrs["value_range"] = (
+                    array.data.min().item(),
+                    array.data.max().item(),
+                )
+
+            # if array has attributes, add them to the dataset
+            for attribute_name, attribute in array.attrs.items():
+                attrs[attribute_name] = attribute
+
+            datasets.append((ds_name, data, attrs))
+
+        for (graph_key, graph) in batch.graphs.items():
+            if graph_key not in self.dataset_names:
+                continue
+
+            ds_name = self.dataset_names[graph_key]
+
+            datasets.append((f"{ds_name}-ids", graph.node_ids_array(), {}))
+            datasets.append((f"{ds_name}-locations", graph.locations_array(), {}))
+            datasets.append((f"{ds_name}-edges", graph.edges_array(), {}))
+
+        return datasets
+
+    def __write(self, snapshot_name, datasets, root_attrs):
+
+        try:
+            os.makedirs(self.output_dir, exist_ok=True)
+        except Exception:
+            logger.error(
+                "failed to create %s", self.output_dir, exc_info=True)
+
+        logger.info("saving to %s" % snapshot_name)
+        if snapshot_name.endswith(".hdf"):
+            open_func = h5py.File
+        elif snapshot_name.endswith(".zarr"):
+            open_func = ZarrFile
+        else:
+            logger.warning("ambiguous file type")
+            open_func = h5py.File
+
+        with open_func(snapshot_name, self.mode) as f:
+
+            for (ds_name, data, attrs) in datasets:
+
+                dataset = f.create_dataset(
+                    name=ds_name,
+                    data=data,
+                    compression=self.compression_type,
+                )
+                for attribute_name, attribute in attrs.items():
+                    dataset.attrs[attribute_name] = attribute
+
+            for attribute_name, attribute in root_attrs.items():
+                f["/"].attrs[attribute_name] = attribute
+
+    def __write_async(self, snapshot_name, datasets, root_attrs):
+
+        self.__raise_writer_error()
+
+        if self.writer is None:
+            self.write_queue = queue.Queue(maxsize=self.max_pending)
+            self.writer = threading.Thread(target=self.__run_writer, daemon=True)
+            self.writer.start()
+
+        item = (snapshot_name, datasets, root_attrs)
+
+        if self.drop_if_busy:
+            try:
+                self.write_queue.put_nowait(item)
+            except queue.Full:
+                logger.warning(
+                    "snapshot writer is busy, skipping snapshot %s", snapshot_name
+                )
+        else:
+            self.write_queue.put(item)
+
+    def __run_writer(self):
+
+        while True:
+
+            item = self.write_queue.get()
+            if item is None:
+                return
+
+            try:
+                self.__write(*item)
+            except Exception as e:
+                logger.error("failed to write snapshot %s", item[0], exc_info=True)
+                if self.writer_error is None:
+                    self.writer_error = e
+
+    def __raise_writer_error(self):
+
+        if self.writer_error is not None:
+            error = self.writer_error
+            self.writer_error = None
+            raise error
@@ -1,7 +1,5 @@
-from random import randrange
-from random import choice, seed
 import logging
-import numpy as np
+import threading
 
 from gunpowder.coordinate import Coordinate
 from gunpowder.batch_request import BatchRequest
@@ -55,7 +53,8 @@ class SpecifiedLocation(BatchFilter):
         self.jitter = jitter
         self.loc_i = -1
         self.upstream_spec = None
-        self.specified_shift = None
+        self._specified_shift = None
+        self.__loc_lock = threading.Lock()
 
         if extra_data is not None:
             assert len(extra_data) == len(locations),\
@@ -74,9 +73,15 @@ class SpecifiedLocation(BatchFilter):
             spec.roi.set_shape(None)
             self.updates(key, spec)
 
-    def prepare(self, request):
-        seed(request.random_seed)
-        np.random.seed(request.random_seed)
+    @property
+    def specified_shift(self):
+        """The shift chosen for the most recent request. With several requests
+        in flight, this is not necessarily the one of the batch at hand."""
+
+        return self._specified_shift
+
+    def prepare(self, request, context=None):
+        context = self._get_context(context, request)
         lcm_voxel_size = self.spec.get_lcm_voxel_size(
             request.array_specs.keys())
 
@@ -84,44 +89,54 @@ class SpecifiedLocation(BatchFilter):
         total_roi = request.get_total_roi()
         request_center = total_roi.get_shape()/2 + total_roi.get_offset()
 
-        self.specified_shift = self._get_next_shift(request_center, lcm_voxel_size)
-        while not self.__check_shift(request):
-            logger.warning("Location %s (shift %s) skipped"
-                           % (self.coordinates[self.loc_i], self.specified_shift))
-            self.specified_shift = self._get_next_shift(request_center, lcm_voxel_size)
+        # the next location depends on the ones chosen for earlier requests
+        with self.__loc_lock:
+            specified_shift = self._get_next_shift(
+                request_center, lcm_voxel_size, context)
+            while not self.__check_shift(request, specified_shift):
+                logger.warning(
+                    "Location %s (shift %s) skipped"
+                    % (self.coordinates[self.loc_i], specified_shift))
+                specified_shift = self._get_next_shift(
+                    request_center, lcm_voxel_size, context)
+            context.specified_shift = specified_shift
+            context.loc_i = self.loc_i
+            self._specified_shift = specified_shift
 
         # Set shift for all requests
         for specs_type in [request.array_specs, request.graph_specs]:
             for (key, spec) in specs_type.items():
-                roi = spec.roi.shift(self.specified_shift)
+                roi = spec.roi.shift(context.specified_shift)
                 specs_type[key].roi = roi
 
         logger.debug("{}'th ({}) shift selected: {}".format(
-            self.loc_i, self.coordinates[self.loc_i], self.specified_shift))
+            context.loc_i, self.coordinates[context.loc_i], context.specified_shift))
 
         deps = request
         return deps
 
-    def process(self, batch, request):
+    def process(self, batch, request, context=None):
+        context = self._get_context(context)
         # reset ROIs to request
         for (array_key, spec) in request.array_specs.items():
             batch.arrays[array_key].spec.roi = spec.roi
             if self.extra_data is not None:
                 batch.arrays[array_key].attrs['specified_location_extra_data'] =\
-                 self.extra_data[self.loc_i]
+                 self.extra_data[context.loc_i]
 
         for (graph_key, spec) in request.graph_specs.items():
             batch.points[graph_key].spec.roi = spec.roi
 
         # change shift point locations to lie within roi
         for graph_key in request.graph_specs.keys():
-            batch.points[graph_key].shift(-self.specified_shift)
+            batch.points[graph_key].shift(-context.specified_shift)
 
-    def _get_next_shift(self, center_shift, voxel_size):
+    def _get_next_shift(self, center_shift, voxel_size, context=None):
         # gets next coordinate from list
+        context = self._get_context(context)
 
         if self.choose_randomly:
-            self.loc_i = randrange(len(self.coordinates))
+            self.loc_i = context.random.randrange(len(self.coordinates))
         else:
             self.loc_i += 1
             if self.loc_i >= len(self.coordinates):
@@ -132,8 +147,8 @@ class SpecifiedLocation(BatchFilter):
         if self.jitter is not None:
             rnd = []
             for i in range(len(self.jitter)):
-                rnd.append(np.random.randint(-self.jitter[i],
-                                              self.jitter[i]+1))
+                rnd.append(context.np_random.randint(-self.jitter[i],
+                                                     self.jitter[i]+1))
             next_shift += Coordinate(rnd)
         logger.debug("Shift before rounding: %s" % str(next_shift))
         # make sure shift is a multiple of voxel size (round to nearest)
@@ -141,7 +156,7 @@ class SpecifiedLocation(BatchFilter):
         logger.debug("Shift after rounding: %s" % str(next_shift))
         return next_shift
 
-    def __check_shift(self, request):
+    def __check_shift(self, request, specified_shift):
         for key, spec in request.items():
             request_roi = spec.roi
             if key in self.upstream_spec:
@@ -149,7 +164,7 @@ class SpecifiedLocation(BatchFilter):
             else:
                 raise Exception(
                     "Requested %s, but upstream does not provide it."%key)
-            shifted_roi = request_roi.shift(self.specified_shift)
+            shifted_roi = request_roi.shift(specified_shift)
             if not provided_roi.contains(shifted_roi):
                 logger.warning("Provided roi %s for key %s does not contain shifted roi %s"
                              % (provided_roi, key, shifted_roi))
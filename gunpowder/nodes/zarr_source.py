@@ -36,8 +36,54 @@ class ZarrSource(Hdf5LikeSource):
             to be (channels, spatial dimensions). This is recommended because of
             better performance. If channels_first is set to false, then the input
             data is read in channels_last manner and converted to channels_first.
+
+        keep_open (``bool``, optional):
+
+            Whether to keep the file and its datasets open between requests,
+            instead of opening it for every request. The file is closed on
+            teardown. Open files do not see changes made to them by other
+            processes and (for HDF5) can keep writers out, therefore this is
+            off by default.
+
+        chunk_cache (:class:`ChunkCache` or :class:`SharedChunkCache`, optional):
+
+            A cache for decompressed chunks, to be shared between sources.
+            Hits and misses are counted in the profiling stats.
+
+        num_threads (``int``, optional):
+
+            If larger than 1, chunked datasets are read chunk by chunk with
+            this many threads, straight into the output array. Decompression
+            of chunks then happens in parallel.
     '''
 
+    def __init__(
+            self,
+            filename,
+            datasets,
+            array_specs=None,
+            channels_first=True,
+            keep_open=False,
+            chunk_cache=None,
+            num_threads=1):
+
+        super().__init__(
+            filename,
+            datasets,
+            array_specs,
+            channels_first,
+            keep_open,
+            chunk_cache)
+
+        self.num_threads = num_threads
+
+    def _read_into(self, dataset, selection, out):
+        try:
+            dataset.get_basic_selection(selection, out=out)
+        except TypeError:
+            # zarr>=3 does not accept numpy arrays as out
+            out[...] = dataset[selection]
+
     def _get_voxel_size(self, dataset):
 
         if 'resolution' not in dataset.attrs:
@@ -42,8 +42,60 @@ class ZarrWrite(Hdf5LikeWrite):
             A dictionary from array keys to datatype (eg. ``np.int8``). If
             given, arrays are stored using this type. The original arrays
             within the pipeline remain unchanged.
+
+        write_behind (``bool``, optional):
+
+            If set, arrays are collected per storage chunk and complete
+            chunks are written by background threads. Partially covered
+            chunks are written on teardown. Only supported in the process the
+            pipeline was set up in, see :class:`Hdf5LikeWrite`.
+
+        num_write_threads (``int``, optional):
+
+            The number of background threads, if ``write_behind`` is set.
+
+        multi_writer (``bool``, optional):
+
+            Set this if several processes write at the same time, e.g., the
+            workers of :class:`Scan` or :class:`DaisyRequestBlocks`. Datasets
+            are then created in :func:`setup` (before workers are started),
+            using the upstream ROI, voxel size, and dtype. Each chunk is
+            written while holding an advisory file lock (in a
+            ``<output_filename>.locks`` directory), since blocks can share
+            chunks or overlap. ``write_behind`` is ignored in this mode.
+
+        channel_shapes (``dict``, :class:`ArrayKey` -> ``tuple``, optional):
+
+            The shape of the channel dimensions of each array, needed to create
+            datasets in ``multi_writer`` mode. Arrays without an entry have no
+            channel dimensions.
     '''
 
+    def __init__(
+            self,
+            dataset_names,
+            output_dir='.',
+            output_filename='output.hdf',
+            compression_type=None,
+            dataset_dtypes=None,
+            write_behind=False,
+            num_write_threads=1,
+            multi_writer=False,
+            channel_shapes=None):
+
+        super().__init__(
+            dataset_names,
+            output_dir,
+            output_filename,
+            compression_type,
+            dataset_dtypes,
+            write_behind,
+            num_write_threads)
+
+        self.multi_writer = multi_writer
+        if channel_shapes is not None:
+            self.channel_shapes = channel_shapes
+
     def _get_voxel_size(self, dataset):
 
         if 'resolution' not in dataset.attrs:
@@ -1,4 +1,6 @@
 import logging
+import queue
+import threading
 from gunpowder.nodes import BatchProvider
 
 logger = logging.getLogger(__name__)
@@ -54,6 +56,9 @@ class Pipeline:
         self.children = []
         self.initialized = False
 
+        # stop events and threads of running iterate() calls
+        self.iterations = []
+
     def traverse(self, callback, reverse=False):
         '''Visit every node in the pipeline recursively (either from root to
         leaves of from leaves to the root if ``reverse`` is true). ``callback``
@@ -111,6 +116,8 @@ class Pipeline:
         '''Call teardown on each batch provider in the pipeline and disconnect
         all nodes.'''
 
+        self.__stop_iterations()
+
         try:
 
             def node_teardown(node):
@@ -141,6 +148,99 @@ class Pipeline:
         except Exception as e:
             raise PipelineRequestError(self, request) from e
 
+    async def request_batch_async(self, request):
+        '''Request a batch from the pipeline, without blocking the event loop.
+
+        Nodes that do not implement :func:`BatchProvider.provide_async` are
+        run in the default executor of the running event loop. Several
+        requests can be in flight at the same time, for example by gathering
+        the coroutines of several calls. Nodes that keep per-request state on
+        ``self`` instead of the :class:`RequestContext` are not safe to use
+        this way.
+        '''
+
+        try:
+            return await self.output.request_batch_async(request)
+        except Exception as e:
+            raise PipelineRequestError(self, request) from e
+
+    def iterate(self, request, prefetch=1):
+        '''Repeatedly request batches from the pipeline, as a generator.
+
+        Batches are requested in a background thread, such that the next
+        batches are produced while the current one is being used. Like calling
+        :func:`request_batch` in a loop, every batch is requested with
+        ``request`` and a new random seed derived from the previous one.
+
+        The generator stops when the pipeline is torn down (e.g., when leaving
+        the surrounding ``build`` block). Closing the generator (e.g., by
+        leaving a ``for`` loop over it) stops the background thread as well.
+        In both cases, a request that is currently being processed is waited
+        for, but not returned.
+
+        Args:
+
+            request (:class:`BatchRequest`):
+
+                The request to use for every batch.
+
+            prefetch (``int``, optional):
+
+                How many batches to produce ahead of time. At most
+                ``prefetch`` finished batches are held, while the next one is
+                being produced.
+        '''
+
+        assert prefetch >= 1, "prefetch has to be at least 1"
+
+        stop = threading.Event()
+        batches = queue.Queue(maxsize=prefetch)
+
+        def produce():
+
+            while not stop.is_set():
+
+                try:
+                    item = self.request_batch(request)
+                except Exception as e:
+                    item = e
+
+                while not stop.is_set():
+                    try:
+                        batches.put(item, timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+
+                if isinstance(item, Exception):
+                    break
+
+        thread = threading.Thread(target=produce, daemon=True)
+        iteration = (stop, thread)
+        self.iterations.append(iteration)
+        thread.start()
+
+        try:
+
+            while not stop.is_set():
+
+                try:
+                    item = batches.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+
+                if isinstance(item, Exception):
+                    raise item
+
+                yield item
+
+        finally:
+
+            stop.set()
+            thread.join()
+            if iteration in self.iterations:
+                self.iterations.remove(iteration)
+
     @property
     def spec(self):
         return self.output.spec
@@ -196,6 +296,14 @@ class Pipeline:
 
         return result
 
+    def __stop_iterations(self):
+
+        for stop, _ in self.iterations:
+            stop.set()
+        for _, thread in self.iterations:
+            thread.join()
+        self.iterations = []
+
     def __repr__(self):
 
         def to_string(node):
@@ -5,12 +5,19 @@ except:
 import logging
 import multiprocessing
 import os
+import pickle
 import sys
+import threading
 import time
 import traceback
+import weakref
+from multiprocessing import shared_memory
 
 import numpy as np
 
+from .array import Array
+from .batch import Batch
+
 logger = logging.getLogger(__name__)
 
 class NoResult(Exception):
@@ -22,12 +29,247 @@ class ParentDied(Exception):
 class WorkersDied(Exception):
     pass
 
-class ProducerPool(object):
 
-    def __init__(self, callables, queue_size=10):
-        self.__watch_dog = multiprocessing.Process(target=self.__run_watch_dog, args=(callables,))
-        self.__stop = multiprocessing.Event()
-        self.__result_queue = multiprocessing.Queue(queue_size)
+class SharedBatch(object):
+    '''A batch whose array data has been moved into a slot of a
+    :class:`SharedMemoryRing`. Only the batch without arrays and the
+    metadata needed to recreate the arrays are pickled.'''
+
+    def __init__(self, slot, batch, arrays):
+        self.slot = slot
+        self.batch = batch
+        self.arrays = arrays
+
+
+class SharedMemoryRing(object):
+    '''A fixed set of shared memory slots to hand array data of batches from
+    worker processes to the consumer without pickling.
+
+    Slots are handed out to workers through a queue of free slot indices. The
+    consumer wraps the arrays of a received batch as views into the slot and
+    returns the slot to the free queue once all of these views have been
+    garbage collected.
+
+    Args:
+
+        num_slots (``int``):
+
+            How many slots to allocate, i.e., how many batches can be in
+            flight or held by the consumer at the same time.
+
+        slot_size (``int``):
+
+            The size of each slot in bytes. Batches with arrays that do not fit
+            into a slot are transported through the result queue instead.
+    '''
+
+    alignment = 64
+
+    def __init__(self, num_slots, slot_size):
+
+        self.num_slots = num_slots
+        self.slot_size = slot_size
+        self.slots = [
+            shared_memory.SharedMemory(create=True, size=slot_size)
+            for _ in range(num_slots)
+        ]
+        self.free_slots = multiprocessing.Queue()
+        for i in range(num_slots):
+            self.free_slots.put(i)
+        self.closed = False
+
+    def pack(self, batch, stop_event):
+        '''Copy the arrays of ``batch`` into a free slot (called from the
+        workers). Returns a :class:`SharedBatch`, or ``batch`` itself if it
+        can not be shared.'''
+
+        if not isinstance(batch, Batch):
+            return batch
+
+        nbytes = 0
+        for array in batch.arrays.values():
+            if array.data.dtype.hasobject:
+                return batch
+            nbytes += self.__aligned(array.data.nbytes)
+
+        if nbytes > self.slot_size:
+            logger.warning(
+                "batch of %d bytes does not fit into shared memory slot of "
+                "%d bytes, sending it through the result queue",
+                nbytes, self.slot_size)
+            return batch
+
+        slot = None
+        while slot is None:
+            if stop_event.is_set():
+                # the pool is shutting down, this batch won't be delivered
+                return batch
+            try:
+                slot = self.free_slots.get(timeout=1)
+            except Queue.Empty:
+                logger.debug(
+                    "worker %d: no free shared memory slot, waiting",
+                    os.getpid())
+
+        buf = self.slots[slot].buf
+        offset = 0
+        arrays = {}
+        for key, array in batch.arrays.items():
+            data = array.data
+            view = np.ndarray(
+                data.shape,
+                dtype=data.dtype,
+                buffer=buf,
+                offset=offset)
+            view[...] = data
+            arrays[key] = (array.spec, array.attrs, data.shape, data.dtype, offset)
+            offset += self.__aligned(data.nbytes)
+
+        batch.arrays = {}
+
+        return SharedBatch(slot, batch, arrays)
+
+    def unpack(self, shared_batch):
+        '''Recreate the batch from a :class:`SharedBatch` with arrays being
+        views into the slot (called from the consumer). The slot is released
+        when the last of these views is dropped.'''
+
+        slot = shared_batch.slot
+        slot_data = np.ndarray(
+            (self.slot_size,),
+            dtype=np.uint8,
+            buffer=self.slots[slot].buf)
+        release = weakref.finalize(slot_data, self.__release, slot)
+        release.atexit = False
+
+        batch = shared_batch.batch
+        for key, (spec, attrs, shape, dtype, offset) in shared_batch.arrays.items():
+            dtype = np.dtype(dtype)
+            nbytes = int(np.prod(shape, dtype=np.int64))*dtype.itemsize
+            data = slot_data[offset:offset + nbytes].view(dtype).reshape(shape)
+            batch.arrays[key] = Array(data, spec, attrs)
+
+        return batch
+
+    def close(self):
+        '''Unlink all slots. Slots that are still referenced by arrays stay
+        mapped until these arrays are dropped.'''
+
+        if self.closed:
+            return
+        self.closed = True
+
+        for slot in self.slots:
+            try:
+                slot.close()
+            except BufferError:
+                # arrays still point into this slot, keep it mapped
+                pass
+            try:
+                slot.unlink()
+            except FileNotFoundError:
+                pass
+
+    def __release(self, slot):
+
+        if not self.closed:
+            self.free_slots.put(slot)
+
+    def __aligned(self, nbytes):
+
+        return -(-nbytes//self.alignment)*self.alignment
+
+
+class ProducerPool(object):
+    '''A pool of workers that repeatedly call a callable and place the
+    results in a queue, to be retrieved with :func:`get`.
+
+    Args:
+
+        callables (``list`` of callables):
+
+            One callable per worker process to call repeatedly.
+
+        queue_size (``int``, optional):
+
+            How many results to hold at most.
+
+        transport (``string``, optional):
+
+            How results are sent to the consumer. ``"queue"`` (the default)
+            pickles results through a ``multiprocessing.Queue``.
+            ``"shared_memory"`` places the array data of :class:`Batch`
+            results in a ring of shared memory slots and sends only metadata
+            through the queue. The consumer receives arrays as views into
+            these slots, which are released when the arrays are dropped.
+            Batches contained in tuple results are shared as well.
+
+        slot_size (``int``, optional):
+
+            The size of each shared memory slot in bytes. Only used for
+            ``transport="shared_memory"``.
+
+        num_slots (``int``, optional):
+
+            The number of shared memory slots. Defaults to ``queue_size`` plus
+            the number of workers plus two, such that workers are not blocked
+            while the queue is filling up and the consumer holds on to a
+            couple of batches. Only used for ``transport="shared_memory"``.
+
+        backend (``string``, optional):
+
+            ``"process"`` (the default) runs each callable in its own process,
+            supervised by a watchdog process. ``"thread"`` runs them in
+            threads of the current process instead, which avoids forking and
+            pickling, and is preferable if the callables spend most of their
+            time in code that releases the GIL (like reading and decompressing
+            data). With threads, the callables have to be thread-safe and
+            results are passed on as they are (``transport`` has to be
+            ``"queue"``). Threads can not be terminated, :func:`stop` waits
+            for callables that are currently running to return.
+    '''
+
+    def __init__(
+            self,
+            callables,
+            queue_size=10,
+            transport="queue",
+            slot_size=2**28,
+            num_slots=None,
+            backend="process"):
+
+        assert transport in ["queue", "shared_memory"], (
+            "transport has to be 'queue' or 'shared_memory'")
+        assert backend in ["process", "thread"], (
+            "backend has to be 'process' or 'thread'")
+        assert backend == "process" or transport == "queue", (
+            "shared memory transport is only supported for the process "
+            "backend")
+
+        self.__backend = backend
+
+        if backend == "process":
+            self.__watch_dog = multiprocessing.Process(target=self.__run_watch_dog, args=(callables,))
+            self.__threads = None
+            self.__stop = multiprocessing.Event()
+            self.__result_queue = multiprocessing.Queue(queue_size)
+        else:
+            self.__watch_dog = None
+            self.__threads = [
+                threading.Thread(
+                    target=self.__run_thread_worker,
+                    args=(c,),
+                    daemon=True)
+                for c in callables
+            ]
+            self.__stop = threading.Event()
+            self.__result_queue = Queue.Queue(queue_size)
+
+        self.__ring = None
+        if transport == "shared_memory":
+            if num_slots is None:
+                num_slots = queue_size + len(callables) + 2
+            self.__ring = SharedMemoryRing(num_slots, slot_size)
 
     def __del__(self):
         self.stop()
@@ -35,6 +277,20 @@ class ProducerPool(object):
     def start(self):
         '''Start the pool of producers.'''
 
+        if self.__backend == "thread":
+
+            if self.__threads is None:
+                raise RuntimeError("can't start a ProducerPool a second time")
+
+            if any(thread.is_alive() for thread in self.__threads):
+                logger.warning("trying to start workers, but they are already running")
+                return
+
+            self.__stop.clear()
+            for thread in self.__threads:
+                thread.start()
+            return
+
         if self.__watch_dog is None:
             raise RuntimeError("can't start a ProducerPool a second time")
 
@@ -68,13 +324,31 @@ class ProducerPool(object):
 
         if isinstance(item, Exception):
             raise item
-        return item
+        return self.__unpack(item)
+
+    def stopped(self):
+        '''Check whether :func:`stop` has been called. Long running callables
+        can use this to return early.'''
+
+        return self.__stop.is_set()
 
     def stop(self):
         '''Stop the pool of producers.
 
         Items currently being produced will not be waited for and be discarded.'''
 
+        if self.__backend == "thread":
+
+            if self.__threads is None:
+                return
+
+            self.__stop.set()
+            for thread in self.__threads:
+                if thread.is_alive():
+                    thread.join()
+            self.__threads = None
+            return
+
         if self.__watch_dog is None:
             return
 
@@ -82,6 +356,9 @@ class ProducerPool(object):
         self.__watch_dog.join()
         self.__watch_dog = None
 
+        if self.__ring is not None:
+            self.__ring.close()
+
     def __run_watch_dog(self, callables):
 
         parent_pid = os.getppid()
@@ -151,6 +428,10 @@ class ProducerPool(object):
                     # this is most likely a keyboard interrupt, stop process
                     break
 
+                result = self.__sendable(result)
+                if self.__ring is not None:
+                    result = self.__pack(result)
+
             try:
                 self.__result_queue.put(result, timeout=1)
                 result = None
@@ -160,5 +441,67 @@ class ProducerPool(object):
         logger.debug("worker with PID " + str(os.getpid()) + " exiting")
         os._exit(1)
 
+    def __run_thread_worker(self, target):
+
+        logger.debug("worker thread %d started", threading.get_ident())
+
+        result = None
+        while not self.__stop.is_set():
+
+            if result is None:
+
+                try:
+                    result = target()
+                except Exception as e:
+                    logger.error(e, exc_info=True)
+                    result = e
+                    # don't stop on normal exceptions -- place them in result
+                    # queue and let them be handled by caller
+
+                if result is None:
+                    continue
+
+            try:
+                self.__result_queue.put(result, timeout=1)
+                result = None
+            except Queue.Full:
+                logger.debug(
+                    "worker thread %d: result queue is full, waiting to "
+                    "place my result", threading.get_ident())
+
+        logger.debug("worker thread %d exiting", threading.get_ident())
+
+    def __sendable(self, result):
+        '''Replace exceptions that can not be pickled (e.g., because they
+        refer to a node holding a lock) with a :class:`RuntimeError`, such
+        that they reach the consumer instead of being dropped by the result
+        queue.'''
+
+        if isinstance(result, tuple):
+            return tuple(self.__sendable(r) for r in result)
+        if not isinstance(result, Exception):
+            return result
+
+        try:
+            pickle.dumps(result)
+            return result
+        except Exception:
+            return RuntimeError(''.join(traceback.format_exception(
+                type(result), result, result.__traceback__)))
+
+    def __pack(self, result):
+
+        if isinstance(result, tuple):
+            return tuple(self.__pack(r) for r in result)
+        return self.__ring.pack(result, self.__stop)
+
+    def __unpack(self, item):
+
+        if isinstance(item, tuple):
+            return tuple(self.__unpack(i) for i in item)
+        if isinstance(item, SharedBatch):
+            return self.__ring.unpack(item)
+        return item
+
     def __all_workers_alive(self, workers):
         return all([ worker.is_alive() for worker in workers ])
@@ -83,6 +83,7 @@ class ProfilingStats(Freezable):
 
     def __init__(self):
         self.__summaries = {}
+        self.__counters = {}
         self.freeze()
 
     def add(self, timing):
@@ -96,6 +97,13 @@ class ProfilingStats(Freezable):
             self.__summaries[id] = TimingSummary()
         self.__summaries[id].add(copy.deepcopy(timing))
 
+    def add_counter(self, node, counter_name, value=1):
+        '''Increase a counter (like the number of cache hits) of the given
+        node by ``value``. Counters are summed up when merging stats.'''
+
+        id = (type(node).__name__, counter_name)
+        self.__counters[id] = self.__counters.get(id, 0) + value
+
     def merge_with(self, other):
         '''Combine statitics of two ProfilingStats.'''
 
@@ -105,6 +113,9 @@ class ProfilingStats(Freezable):
             else:
                 self.__summaries[id] = copy.deepcopy(summary)
 
+        for id, value in other.__counters.items():
+            self.__counters[id] = self.__counters.get(id, 0) + value
+
     def get_timing_summaries(self):
         '''Get a dictionary (node_name,method_name) -> TimingSummary.'''
         return self.__summaries
@@ -117,6 +128,15 @@ class ProfilingStats(Freezable):
 
         return self.__summaries[(node_name,method_name)]
 
+    def get_counters(self):
+        '''Get a dictionary (node_name,counter_name) -> value.'''
+        return self.__counters
+
+    def get_counter(self, node_name, counter_name):
+        '''Get the value of a counter for the given node, 0 if it was never
+        increased.'''
+        return self.__counters.get((node_name, counter_name), 0)
+
     def span(self):
         '''Timestamps of the first call to start() and last call to stop() over 
         all Timings added.'''
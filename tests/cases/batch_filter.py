@@ -0,0 +1,169 @@
+import asyncio
+import threading
+import time
+
+import numpy as np
+
+from gunpowder import (
+    BatchFilter,
+    Array,
+    ArraySpec,
+    ArrayKey,
+    BatchRequest,
+    Roi,
+    build,
+)
+
+from .helper_sources import ArraySource
+
+
+class ContextTestFilter(BatchFilter):
+    def __init__(self, key):
+        self.key = key
+
+    def prepare(self, request, context):
+        context.offset = request[self.key].roi.get_offset()
+        # give other threads the chance to prepare their requests
+        time.sleep(0.05)
+
+    def process(self, batch, request, context):
+        assert batch[self.key].spec.roi.get_offset() == context.offset
+        batch[self.key].attrs["offset"] = context.offset
+
+
+class NoContextTestFilter(BatchFilter):
+    def __init__(self, key):
+        self.key = key
+
+    def prepare(self, request):
+        self.offset = request[self.key].roi.get_offset()
+
+    def process(self, batch, request):
+        batch[self.key].attrs["no_context_offset"] = self.offset
+
+
+class OptionalContextTestFilter(BatchFilter):
+    def __init__(self, key):
+        self.key = key
+
+    def prepare(self, request, context=None):
+        context = self._get_context(context, request)
+        context.offset = request[self.key].roi.get_offset()
+        context.value = context.random.random()
+
+    def process(self, batch, request, context=None):
+        context = self._get_context(context)
+        batch[self.key].attrs["offset"] = context.offset
+        batch[self.key].attrs["value"] = context.value
+
+
+class SubclassTestFilter(OptionalContextTestFilter):
+    def process(self, batch, request):
+        super().process(batch, request)
+        batch[self.key].attrs["subclass"] = True
+
+
+def test_request_context():
+
+    key = ArrayKey("RAW")
+    array = Array(
+        np.zeros((100, 100), dtype=np.uint8),
+        ArraySpec(roi=Roi((0, 0), (100, 100)), voxel_size=(1, 1)),
+    )
+
+    pipeline = ArraySource(key, array) + ContextTestFilter(key)
+
+    offsets = [(i * 10, i * 5) for i in range(8)]
+    results = {}
+
+    def request_batch(offset):
+        request = BatchRequest()
+        request[key] = ArraySpec(roi=Roi(offset, (10, 10)))
+        results[offset] = pipeline.request_batch(request)
+
+    with build(pipeline):
+        threads = [
+            threading.Thread(target=request_batch, args=(offset,))
+            for offset in offsets
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    assert len(results) == len(offsets)
+    for offset, batch in results.items():
+        assert batch[key].attrs["offset"] == offset
+
+
+def test_no_context():
+
+    key = ArrayKey("RAW")
+    array = Array(
+        np.zeros((100, 100), dtype=np.uint8),
+        ArraySpec(roi=Roi((0, 0), (100, 100)), voxel_size=(1, 1)),
+    )
+
+    pipeline = ArraySource(key, array) + NoContextTestFilter(key)
+
+    request = BatchRequest()
+    request[key] = ArraySpec(roi=Roi((20, 30), (10, 10)))
+
+    with build(pipeline):
+        batch = pipeline.request_batch(request)
+
+    assert batch[key].attrs["no_context_offset"] == (20, 30)
+
+
+def test_subclass_without_context():
+
+    key = ArrayKey("RAW")
+    array = Array(
+        np.zeros((100, 100), dtype=np.uint8),
+        ArraySpec(roi=Roi((0, 0), (100, 100)), voxel_size=(1, 1)),
+    )
+
+    pipeline = ArraySource(key, array) + SubclassTestFilter(key)
+
+    with build(pipeline):
+        values = []
+        for seed in [1, 2, 1]:
+            request = BatchRequest(random_seed=seed)
+            request[key] = ArraySpec(roi=Roi((20, 30), (10, 10)))
+            batch = pipeline.request_batch(request)
+            assert batch[key].attrs["offset"] == (20, 30)
+            assert batch[key].attrs["subclass"]
+            values.append(batch[key].attrs["value"])
+
+    # random numbers are drawn from generators seeded for each request
+    assert values[0] == values[2]
+    assert values[0] != values[1]
+
+
+def test_request_context_async():
+
+    key = ArrayKey("RAW")
+    array = Array(
+        np.zeros((100, 100), dtype=np.uint8),
+        ArraySpec(roi=Roi((0, 0), (100, 100)), voxel_size=(1, 1)),
+    )
+
+    pipeline = ArraySource(key, array) + OptionalContextTestFilter(key)
+
+    def make_request(seed):
+        request = BatchRequest(random_seed=seed)
+        request[key] = ArraySpec(roi=Roi((seed, seed), (10, 10)))
+        return request
+
+    async def request_batches():
+        return await asyncio.gather(
+            *[pipeline.request_batch_async(make_request(s)) for s in range(8)]
+        )
+
+    with build(pipeline):
+        expected = [pipeline.request_batch(make_request(s)) for s in range(8)]
+        batches = asyncio.run(request_batches())
+
+    for seed, (batch, expected_batch) in enumerate(zip(batches, expected)):
+        assert batch[key].attrs["offset"] == (seed, seed)
+        assert batch[key].attrs["value"] == expected_batch[key].attrs["value"]
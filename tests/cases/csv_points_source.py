@@ -0,0 +1,71 @@
+import os
+
+import numpy as np
+
+from gunpowder import (
+    BatchRequest,
+    CsvPointsSource,
+    GraphKey,
+    GraphSpec,
+    Roi,
+    build,
+)
+
+
+def test_query(tmp_path):
+
+    rng = np.random.default_rng(42)
+    locations = rng.uniform(0, 100, size=(5000, 3)).astype(np.float32)
+    # a few points on the boundaries of the requested ROI
+    locations[:3] = [[10, 10, 10], [40, 40, 40], [10, 39.5, 40]]
+
+    filename = str(tmp_path / "points.csv")
+    np.savetxt(filename, locations, fmt="%f")
+
+    points = GraphKey("POINTS")
+    roi = Roi((10, 10, 10), (30, 30, 30))
+
+    for run in range(2):
+
+        source = CsvPointsSource(filename, points, binary_cache=True)
+
+        with build(source):
+            batch = source.request_batch(BatchRequest({points: GraphSpec(roi=roi)}))
+
+        # the second run reads the cache
+        assert os.path.exists(filename + ".npy")
+        if run == 1:
+            assert isinstance(source.data, np.memmap)
+
+        parsed = np.loadtxt(filename, dtype=np.float32)
+        expected = [
+            i
+            for i, location in enumerate(parsed)
+            if roi.contains(location)
+        ]
+        ids = [node.id for node in batch[points].nodes]
+        assert ids == expected
+        for node in batch[points].nodes:
+            assert all(node.location == parsed[node.id])
+
+
+def test_flat(tmp_path):
+
+    # all points in one plane
+    locations = np.zeros((1000, 3), dtype=np.float32)
+    locations[:, 1:] = np.random.uniform(0, 1000, size=(1000, 2))
+
+    filename = str(tmp_path / "points.csv")
+    np.savetxt(filename, locations, fmt="%f")
+
+    points = GraphKey("POINTS")
+    roi = Roi((0, 100, 100), (1, 300, 500))
+
+    source = CsvPointsSource(filename, points)
+    with build(source):
+        batch = source.request_batch(BatchRequest({points: GraphSpec(roi=roi)}))
+
+    parsed = np.loadtxt(filename, dtype=np.float32)
+    expected = [i for i, location in enumerate(parsed) if roi.contains(location)]
+    assert [node.id for node in batch[points].nodes] == expected
+    assert np.prod(source.grid_shape) <= 2 * 1000
@@ -14,13 +14,19 @@ from gunpowder import (
     RasterizeGraph,
     Snapshot,
     ElasticAugment,
+    MergeProvider,
     build,
 )
 from gunpowder.graph import GraphKeys, Graph, Node
+from gunpowder.nodes.elastic_augment import DeformationFieldPool
+from .helper_sources import ArraySource, GraphSource
 from .provider_test import ProviderTest
 
 import numpy as np
 import math
+from scipy import ndimage
+from scipy.spatial import cKDTree
+import threading
 
 
 class GraphTestSource3D(BatchProvider):
@@ -155,3 +161,219 @@ class TestElasticAugment(ProviderTest):
                     loc = Coordinate(int(round(x)) for x in loc)
                     if labels_data_roi.contains(loc):
                         self.assertEqual(labels.data[loc], node.id)
+
+    def test_deformation_pool(self):
+
+        test_labels = ArrayKey("TEST_LABELS")
+        test_graph = GraphKey("TEST_GRAPH")
+
+        elastic = ElasticAugment(
+            [10, 10, 10],
+            [0.1, 0.1, 0.1],
+            [0, 2.0 * math.pi],
+            deformation_pool_size=2,
+            deformation_pool_reuse=2,
+        )
+        pipeline = GraphTestSource3D() + elastic
+
+        num_threads = threading.active_count()
+
+        with build(pipeline):
+
+            request_roi = Roi((-20, -20, -20), (40, 40, 40))
+
+            for _ in range(5):
+
+                request = BatchRequest()
+                request[test_labels] = ArraySpec(roi=request_roi)
+                request[test_graph] = GraphSpec(roi=request_roi)
+
+                batch = pipeline.request_batch(request)
+                labels = batch[test_labels]
+                graph = batch[test_graph]
+
+                self.assertEqual(labels.spec.roi, request_roi)
+                self.assertEqual(labels.data.shape, (10, 40, 40))
+
+                labels_data_roi = (
+                    labels.spec.roi - labels.spec.roi.get_begin()
+                ) / labels.spec.voxel_size
+
+                # graph should have moved together with the voxels
+                for node in graph.nodes:
+                    loc = node.location - labels.spec.roi.get_begin()
+                    loc = loc / labels.spec.voxel_size
+                    loc = Coordinate(int(round(x)) for x in loc)
+                    if labels_data_roi.contains(loc):
+                        self.assertEqual(labels.data[loc], node.id)
+
+            self.assertEqual(len(elastic.deformation_pool.fields), 1)
+
+        # teardown stopped the background threads
+        self.assertEqual(threading.active_count(), num_threads)
+
+    def test_deformation_pool_threads(self):
+
+        pool = DeformationFieldPool(
+            [10, 10, 10], [0.1, 0.1, 0.1], 1, size=2, num_workers=2
+        )
+
+        num_threads = threading.active_count()
+
+        # concurrent first requests start the workers only once
+        threads = [
+            threading.Thread(target=pool.get, args=((10, 40, 40),))
+            for _ in range(8)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(pool.workers), 2)
+        self.assertEqual(threading.active_count(), num_threads + 2)
+
+        pool.stop()
+        self.assertEqual(threading.active_count(), num_threads)
+
+    def test_num_threads(self):
+
+        raw_key = ArrayKey("RAW")
+        labels_key = ArrayKey("GT_LABELS")
+
+        labels = np.arange(40 * 40 * 40, dtype=np.uint64).reshape((40, 40, 40))
+        raw = np.stack([labels, 2 * labels]).astype(np.float32)
+        spec = ArraySpec(roi=Roi((0, 0, 0), (40, 40, 40)), voxel_size=(1, 1, 1))
+        spec.interpolatable = True
+        raw_source = ArraySource(raw_key, Array(raw, spec.copy()))
+        spec.interpolatable = False
+        labels_source = ArraySource(labels_key, Array(labels, spec.copy()))
+
+        results = []
+        for num_threads in [1, 3]:
+
+            pipeline = (raw_source, labels_source) + MergeProvider() + ElasticAugment(
+                [5, 5, 5],
+                [1.0, 1.0, 1.0],
+                [0, math.pi / 2.0],
+                num_threads=num_threads,
+            )
+
+            request = BatchRequest(random_seed=42)
+            request[raw_key] = ArraySpec(roi=Roi((10, 10, 10), (20, 20, 20)))
+            request[labels_key] = ArraySpec(roi=Roi((10, 10, 10), (20, 20, 20)))
+
+            with build(pipeline):
+                batch = pipeline.request_batch(request)
+
+            self.assertEqual(batch[raw_key].data.shape, (2, 20, 20, 20))
+            self.assertEqual(batch[raw_key].data.dtype, np.float32)
+            self.assertEqual(batch[labels_key].data.shape, (20, 20, 20))
+            self.assertEqual(batch[labels_key].data.dtype, np.uint64)
+
+            # both channels were resampled with the same transformation
+            self.assertTrue(
+                np.allclose(2 * batch[raw_key].data[0], batch[raw_key].data[1])
+            )
+
+            results.append(batch)
+
+        for key in [raw_key, labels_key]:
+            self.assertTrue((results[0][key].data == results[1][key].data).all())
+
+    def test_sparse_transform(self):
+
+        coordinates_key = ArrayKey("COORDINATES")
+        graph_key = GraphKey("TEST_GRAPH")
+
+        # an array that contains the coordinates of each voxel
+        roi = Roi((0, 0, 0), (60, 60, 60))
+        coordinates = np.stack(
+            np.meshgrid(*[np.arange(60)] * 3, indexing="ij")
+        ).astype(np.float32)
+        spec = ArraySpec(roi=roi, voxel_size=(1, 1, 1), interpolatable=True)
+
+        random_state = np.random.RandomState(42)
+        nodes = [
+            Node(id=i, location=location)
+            for i, location in enumerate(random_state.uniform(0, 60, size=(500, 3)))
+        ]
+        graph = Graph(nodes, [], GraphSpec(roi=roi))
+
+        def pipeline(use_sparse_transform):
+            return (
+                ArraySource(coordinates_key, Array(coordinates, spec)),
+                GraphSource(graph_key, graph),
+            ) + MergeProvider() + ElasticAugment(
+                [10, 10, 10],
+                [2.0, 2.0, 2.0],
+                [0, 2.0 * math.pi],
+                scale_interval=(0.9, 1.1),
+                use_sparse_transform=use_sparse_transform,
+            )
+
+        request_roi = Roi((15, 15, 15), (30, 30, 30))
+
+        def request(seed):
+            request = BatchRequest(random_seed=seed)
+            request[coordinates_key] = ArraySpec(roi=request_roi)
+            request[graph_key] = GraphSpec(roi=request_roi)
+            return request
+
+        for seed in range(3):
+
+            with build(pipeline(True)) as p:
+                batch = p.request_batch(request(seed))
+            with build(pipeline(False)) as p:
+                dense_batch = p.request_batch(request(seed))
+
+            # the same transformation as the dense one
+            self.assertTrue(
+                np.allclose(
+                    batch[coordinates_key].data,
+                    dense_batch[coordinates_key].data,
+                    atol=1e-3,
+                )
+            )
+
+            # the dense transformation projects nodes onto the voxel grid
+            for b, tolerance in [(batch, 0.1), (dense_batch, 1.0)]:
+
+                # nodes moved together with the voxels
+                projected = b[graph_key]
+                projected_ids = set(node.id for node in projected.nodes)
+                for node in projected.nodes:
+                    self.assertTrue(request_roi.contains(node.location))
+                    location = node.location - request_roi.get_begin()
+                    # can't interpolate after the last voxel
+                    if (location > 29).any():
+                        continue
+                    source = [
+                        ndimage.map_coordinates(
+                            b[coordinates_key].data[d],
+                            location[:, np.newaxis],
+                            order=1,
+                        )[0]
+                        for d in range(3)
+                    ]
+                    self.assertTrue(
+                        np.allclose(
+                            source, graph.node(node.id).location, atol=tolerance
+                        )
+                    )
+
+                # no nodes got lost: all nodes close to the source location of
+                # a voxel (away from the boundary) are still there
+                sources = b[coordinates_key].data[:, 1:-1, 1:-1, 1:-1]
+                tree = cKDTree(sources.reshape((3, -1)).T)
+                distances, _ = tree.query([node.location for node in nodes])
+                for node, distance in zip(nodes, distances):
+                    if distance < 0.5:
+                        self.assertIn(node.id, projected_ids)
+
+        # graphs only
+        graph_request = BatchRequest(random_seed=0)
+        graph_request[graph_key] = GraphSpec(roi=request_roi)
+        with build(pipeline(True)) as p:
+            batch = p.request_batch(graph_request)
+        self.assertGreater(len(list(batch[graph_key].nodes)), 0)
@@ -296,14 +296,16 @@ class TestElasticAugment(ProviderTest):
         test_labels = ArrayKey("TEST_LABELS")
         test_points = GraphKey("TEST_POINTS")
         test_raster = ArrayKey("TEST_RASTER")
-        fast_pipeline = (
-            DensePointTestSource3D()
-            + ElasticAugment(
+        with self.assertWarns(DeprecationWarning):
+            fast_augment = ElasticAugment(
                 [10, 10, 10],
                 [0.1, 0.1, 0.1],
                 [0, 2.0 * math.pi],
                 use_fast_points_transform=True,
             )
+        fast_pipeline = (
+            DensePointTestSource3D()
+            + fast_augment
             + RasterizeGraph(
                 test_points,
                 test_raster,
@@ -373,10 +375,23 @@ class TestElasticAugment(ProviderTest):
                     ),
                 )
 
-            t_fast, t_ref = [np.mean(x) for x in zip(*timings)]
-            self.assertLess(t_fast, t_ref)
             self.assertEqual(missing, 0)
 
+            # nodes only the fast transform keeps are rounded into the ROI
+            for point_id in set(points_fast) - set(points_reference):
+                location = points_fast[point_id].location
+                self.assertLessEqual(
+                    min(
+                        np.min(location - np.array(request_roi.get_begin())),
+                        np.min(np.array(request_roi.get_end()) - location),
+                    ),
+                    1,
+                )
+
+        # the exact projection is not slower than the deprecated fast one
+        t_fast, t_ref = [np.mean(x) for x in zip(*timings)]
+        self.assertLess(t_ref, 1.5 * t_fast)
+
 
     def test_fast_transform_no_recompute(self):
         test_labels = ArrayKey("TEST_LABELS")
@@ -408,7 +423,6 @@ class TestElasticAugment(ProviderTest):
             )
         )
 
-        timings = []
         for i in range(5):
             points_fast = {}
             points_reference = {}
@@ -423,9 +437,7 @@ class TestElasticAugment(ProviderTest):
                 request[test_points] = GraphSpec(roi=request_roi)
                 request[test_raster] = ArraySpec(roi=request_roi)
 
-                t1_fast = time.time()
                 batch = fast_pipeline.request_batch(request)
-                t2_fast = time.time()
                 points_fast = {node.id: node for node in batch[test_points].nodes}
 
             with build(reference_pipeline):
@@ -437,12 +449,9 @@ class TestElasticAugment(ProviderTest):
                 request[test_points] = GraphSpec(roi=request_roi)
                 request[test_raster] = ArraySpec(roi=request_roi)
 
-                t1_ref = time.time()
                 batch = reference_pipeline.request_batch(request)
-                t2_ref = time.time()
                 points_reference = {node.id: node for node in batch[test_points].nodes}
 
-            timings.append((t2_fast - t1_fast, t2_ref - t1_ref))
             diffs = []
             missing = 0
             for point_id, point in points_reference.items():
@@ -460,6 +469,4 @@ class TestElasticAugment(ProviderTest):
                     ),
                 )
 
-            t_fast, t_ref = [np.mean(x) for x in zip(*timings)]
-            self.assertLess(t_fast, t_ref)
             self.assertGreater(missing, 0)
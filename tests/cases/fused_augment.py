@@ -0,0 +1,205 @@
+import math
+
+import numpy as np
+from scipy import ndimage
+
+from gunpowder import (
+    Array,
+    ArrayKey,
+    ArraySpec,
+    BatchRequest,
+    FusedAugment,
+    Graph,
+    GraphKey,
+    GraphSpec,
+    MergeProvider,
+    Node,
+    Roi,
+    build,
+)
+
+from .helper_sources import ArraySource, GraphSource
+
+voxel_size = (2, 1, 1)
+source_roi = Roi((0, 0, 0), (120, 60, 60))
+request_roi = Roi((30, 15, 15), (60, 30, 30))
+
+coordinates_key = ArrayKey("COORDINATES")
+graph_key = GraphKey("TEST_GRAPH")
+
+
+def coordinates_source():
+
+    # an array that contains the world coordinates of each voxel (plus one,
+    # to tell them apart from padding)
+    shape = source_roi.get_shape() / voxel_size
+    coordinates = np.stack(
+        np.meshgrid(
+            *[np.arange(s) * v + 1 for s, v in zip(shape, voxel_size)],
+            indexing="ij",
+        )
+    ).astype(np.float32)
+
+    return ArraySource(
+        coordinates_key,
+        Array(
+            coordinates,
+            ArraySpec(roi=source_roi, voxel_size=voxel_size, interpolatable=True),
+        ),
+    )
+
+
+def graph_source():
+
+    random_state = np.random.RandomState(42)
+    nodes = [
+        Node(id=i, location=location)
+        for i, location in enumerate(
+            random_state.uniform(0, 1, size=(300, 3)) * source_roi.get_shape()
+        )
+    ]
+
+    return GraphSource(graph_key, Graph(nodes, [], GraphSpec(roi=source_roi)))
+
+
+def request_batch(augment, seed, graph=False):
+
+    sources = (coordinates_source(), graph_source()) + MergeProvider()
+    pipeline = sources + augment
+
+    request = BatchRequest(random_seed=seed)
+    request[coordinates_key] = ArraySpec(roi=request_roi)
+    if graph:
+        request[graph_key] = GraphSpec(roi=request_roi)
+
+    with build(pipeline):
+        return pipeline.request_batch(request)
+
+
+def expected_coordinates():
+
+    shape = request_roi.get_shape() / voxel_size
+    return np.stack(
+        np.meshgrid(
+            *[
+                np.arange(s) * v + b + 1
+                for s, v, b in zip(shape, voxel_size, request_roi.get_begin())
+            ],
+            indexing="ij",
+        )
+    ).astype(np.float32)
+
+
+def test_mirror():
+
+    augment = FusedAugment(
+        [10, 10, 10],
+        [0, 0, 0],
+        [0, 0],
+        mirror_probs=[1, 0, 1],
+        transpose_only=[],
+    )
+
+    batch = request_batch(augment, seed=0)
+
+    expected = np.flip(expected_coordinates(), axis=(1, 3))
+    assert batch[coordinates_key].spec.roi == request_roi
+    assert np.allclose(batch[coordinates_key].data, expected)
+
+
+def test_transpose():
+
+    augment = FusedAugment(
+        [10, 10, 10],
+        [0, 0, 0],
+        [0, 0],
+        mirror_probs=[0, 0, 0],
+        transpose_only=[1, 2],
+    )
+
+    transposed = 0
+    for seed in range(10):
+        data = request_batch(augment, seed=seed)[coordinates_key].data
+        expected = expected_coordinates()
+        if np.allclose(data, expected):
+            continue
+        # swapped y and x
+        assert np.allclose(data, np.swapaxes(expected, 2, 3))
+        transposed += 1
+
+    assert 0 < transposed < 10
+
+
+def test_shift():
+
+    augment = FusedAugment(
+        [10, 10, 10],
+        [0, 0, 0],
+        [0, 0],
+        mirror_probs=[0, 0, 0],
+        transpose_only=[],
+        prob_slip=0.5,
+        prob_shift=0.5,
+        shift_sigma=3,
+    )
+
+    batch = request_batch(augment, seed=1, graph=True)
+    data = batch[coordinates_key].data
+    offsets = data - expected_coordinates()
+
+    # the whole request could be served, without padding
+    assert (data > 0).all()
+
+    # each section is shifted as a whole, in y and x only
+    assert (offsets[0] == 0).all()
+    for section in np.moveaxis(offsets, 1, 0):
+        assert (section == section[:, :1, :1]).all()
+    assert offsets.std() > 0
+
+    # nodes moved with their section (or, between sections, with a mix of
+    # the neighboring ones)
+    shifts = -offsets[:, :, 0, 0].T
+    original = graph_source().graph
+    for node in batch[graph_key].nodes:
+        moved = node.location - original.node(node.id).location
+        section = int(round((node.location[0] - request_roi.get_begin()[0]) / 2))
+        neighbors = shifts[max(0, section - 1) : section + 2]
+        assert (moved[1:] >= neighbors.min(axis=0)[1:] - 1).all()
+        assert (moved[1:] <= neighbors.max(axis=0)[1:] + 1).all()
+
+
+def test_graph():
+
+    augment = FusedAugment(
+        [10, 10, 10],
+        [1.0, 1.0, 1.0],
+        [0, 2.0 * math.pi],
+        scale_interval=(0.9, 1.1),
+        transpose_only=[1, 2],
+    )
+
+    for seed in range(3):
+
+        batch = request_batch(augment, seed=seed, graph=True)
+        coordinates = batch[coordinates_key].data
+        graph = batch[graph_key]
+
+        assert len(list(graph.nodes)) > 0
+
+        # nodes moved together with the voxels
+        for node in graph.nodes:
+            assert request_roi.contains(node.location)
+            location = (node.location - request_roi.get_begin()) / voxel_size
+            if (location > np.array(coordinates.shape[1:]) - 1).any():
+                continue
+            source = np.array(
+                [
+                    ndimage.map_coordinates(
+                        coordinates[d], location[:, np.newaxis], order=1
+                    )[0]
+                    for d in range(3)
+                ]
+            ) - 1
+            original = graph_source().graph.node(node.id).location
+            # projections are snapped to the voxel grid
+            assert np.all(np.abs(source - original) <= 1.5 * np.array(voxel_size))
@@ -211,3 +211,36 @@ def test_nodes():
 
     for node in graph.nodes:
         assert all(np.isclose(node.location, replacement_locations[node.id]))
+
+
+def test_bulk_arrays():
+
+    nodes = [
+        Node(id=i, location=np.array([i, 2 * i, 3 * i]), attrs={"radius": i / 2})
+        for i in range(1, 6)
+    ]
+    nodes[4].attrs.pop("radius")
+    edges = [Edge(1, 2, attrs={"weight": 0.5}), Edge(2, 3), Edge(4, 5)]
+    spec = GraphSpec(roi=Roi((0, 0, 0), (20, 20, 20)))
+    graph = Graph(nodes, edges, spec)
+
+    node_ids = graph.node_ids_array()
+    locations = graph.locations_array()
+    edges_array = graph.edges_array()
+
+    assert list(node_ids) == [node.id for node in graph.nodes]
+    assert locations.shape == (5, 3)
+    assert locations.dtype == spec.dtype
+    for node, location in zip(graph.nodes, locations):
+        assert all(node.location == location)
+    assert edges_array.tolist() == [[e.u, e.v] for e in graph.edges]
+
+    radii = graph.node_attrs_array("radius", default=-1)
+    assert radii.tolist() == [0.5, 1.0, 1.5, 2.0, -1]
+    weights = graph.edge_attrs_array("weight", default=1.0)
+    assert weights.tolist() == [0.5, 1.0, 1.0]
+
+    empty = Graph([], [], spec)
+    assert empty.node_ids_array().shape == (0,)
+    assert empty.locations_array().shape == (0, 3)
+    assert empty.edges_array().shape == (0, 2)
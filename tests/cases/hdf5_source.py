@@ -1,9 +1,12 @@
 from unittest import skipIf
+import asyncio
+import multiprocessing
 
 from .provider_test import ProviderTest
 from gunpowder import *
 import numpy as np
 from gunpowder.ext import h5py, zarr, ZarrFile, NoSuchModule
+from gunpowder.nodes.hdf5like_source_base import FileHandlePool, file_handle_pool
 
 
 class Hdf5LikeSourceTestMixin(object):
@@ -96,6 +99,239 @@ class Hdf5LikeSourceTestMixin(object):
             self.assertTrue(batch.arrays[raw_low].spec.interpolatable)
             self.assertFalse(batch.arrays[seg].spec.interpolatable)
 
+    def test_output_async(self):
+        path = self.path_to('test_{0}_source.{0}'.format(self.extension))
+
+        raw_data = np.arange(100*100, dtype=np.float32).reshape(100, 100)
+        seg_data = np.arange(100*100, dtype=np.uint64).reshape(100, 100)
+
+        with self._open_writable_file(path) as f:
+            self._create_dataset(f, 'raw', raw_data, chunks=(10, 10))
+            self._create_dataset(f, 'seg', seg_data, chunks=(10, 10))
+
+        raw = ArrayKey('RAW')
+        seg = ArrayKey('SEG')
+        pipeline = (
+            self.SourceUnderTest(
+                path,
+                {
+                    raw: 'raw',
+                    seg: 'seg'
+                }
+            ) +
+            IntensityScaleShift(raw, 2, 1)
+        )
+
+        requests = [
+            BatchRequest({
+                raw: ArraySpec(roi=Roi((i*10, 0), (20, 30))),
+                seg: ArraySpec(roi=Roi((0, i*10), (30, 20))),
+            })
+            for i in range(8)
+        ]
+
+        async def request_batches():
+            return await asyncio.gather(*[
+                pipeline.request_batch_async(request)
+                for request in requests
+            ])
+
+        with build(pipeline):
+            batches = asyncio.run(request_batches())
+
+        for i, batch in enumerate(batches):
+            self.assertTrue(
+                (batch[raw].data == raw_data[i*10:i*10+20, 0:30]*2 + 1).all())
+            self.assertTrue(
+                (batch[seg].data == seg_data[0:30, i*10:i*10+20]).all())
+            self.assertEqual(batch[raw].spec.roi, Roi((i*10, 0), (20, 30)))
+
+    def test_keep_open(self):
+        path = self.path_to('test_{0}_source.{0}'.format(self.extension))
+
+        with self._open_writable_file(path) as f:
+            self._create_dataset(f, 'raw', np.ones((100, 100), dtype=np.float32))
+
+        opened = []
+
+        class CountingSource(self.SourceUnderTest):
+            def _open_file(self, filename):
+                opened.append(filename)
+                return super()._open_file(filename)
+
+        raw = ArrayKey('RAW')
+        source = CountingSource(path, {raw: 'raw'}, keep_open=True)
+
+        with build(source):
+            # setup opens the file once
+            num_setup_opened = len(opened)
+            for i in range(10):
+                batch = source.request_batch(
+                    BatchRequest({
+                        raw: ArraySpec(roi=Roi((i, i), (10, 10))),
+                    })
+                )
+                self.assertTrue((batch[raw].data == 1).all())
+            self.assertEqual(len(opened), num_setup_opened + 1)
+
+        # closed on teardown
+        self.assertFalse(
+            any(key[1] == path for key in file_handle_pool.files.keys()))
+
+        # by default, the file is opened for every request
+        opened = []
+        source = CountingSource(path, {raw: 'raw'})
+
+        with build(source):
+            num_setup_opened = len(opened)
+            for i in range(10):
+                source.request_batch(
+                    BatchRequest({
+                        raw: ArraySpec(roi=Roi((i, i), (10, 10))),
+                    })
+                )
+            self.assertEqual(len(opened), num_setup_opened + 10)
+
+    def test_channels_last(self):
+        path = self.path_to('test_{0}_source.{0}'.format(self.extension))
+
+        raw_data = np.arange(3*20*20, dtype=np.uint8).reshape(3, 20, 20)
+        with self._open_writable_file(path) as f:
+            self._create_dataset(
+                f, 'raw_last', np.moveaxis(raw_data, 0, -1).copy(),
+                chunks=(7, 7, 2), resolution=(1, 1))
+
+        raw = ArrayKey('RAW')
+        source = self.SourceUnderTest(
+            path, {raw: 'raw_last'}, channels_first=False)
+
+        roi = Roi((3, 5), (10, 12))
+        with build(source):
+            batch = source.request_batch(
+                BatchRequest({raw: ArraySpec(roi=roi)}))
+
+        # channels were reordered while reading, no transposed view
+        expected = raw_data[(slice(None),) + roi.to_slices()]
+        self.assertTrue((batch[raw].data == expected).all())
+        self.assertTrue(batch[raw].data.flags.c_contiguous)
+
+    def test_chunk_cache(self):
+        path = self.path_to('test_{0}_source.{0}'.format(self.extension))
+
+        raw_data = np.arange(2*30*30*30, dtype=np.float32).reshape(2, 30, 30, 30)
+        with self._open_writable_file(path) as f:
+            self._create_dataset(
+                f, 'raw', raw_data, chunks=(2, 10, 10, 10),
+                resolution=(1, 1, 1))
+            self._create_dataset(
+                f, 'raw_last', np.moveaxis(raw_data, 0, -1).copy(),
+                chunks=(10, 10, 10, 2), resolution=(1, 1, 1))
+
+        raw = ArrayKey('RAW')
+        raw_last = ArrayKey('RAW_LAST')
+
+        # enough sets in the shared cache to make conflicts unlikely
+        for cache in [ChunkCache(2**20), SharedChunkCache(2**24, 2**14)]:
+
+            sources = (
+                self.SourceUnderTest(path, {raw: 'raw'}, chunk_cache=cache),
+                self.SourceUnderTest(
+                    path, {raw_last: 'raw_last'},
+                    channels_first=False,
+                    chunk_cache=cache)
+            )
+            pipeline = sources + MergeProvider()
+
+            with build(pipeline):
+                for offset in [(5, 5, 5), (3, 4, 5)]:
+                    roi = Roi(offset, (20, 20, 20))
+                    batch = pipeline.request_batch(
+                        BatchRequest({
+                            raw: ArraySpec(roi=roi),
+                            raw_last: ArraySpec(roi=roi),
+                        })
+                    )
+                    expected = raw_data[(slice(None),) + roi.to_slices()]
+                    self.assertTrue((batch[raw].data == expected).all())
+                    self.assertTrue((batch[raw_last].data == expected).all())
+
+            stats = batch.profiling_stats
+            source_name = self.SourceUnderTest.__name__
+            # second request reads the same 3x3x3 chunks per dataset
+            self.assertEqual(
+                stats.get_counter(source_name, 'chunk_cache_hits'), 2*27)
+            self.assertEqual(
+                stats.get_counter(source_name, 'chunk_cache_misses'), 0)
+
+
+class TestSharedChunkCache(ProviderTest):
+
+    def test_fork(self):
+
+        cache = SharedChunkCache(2**16, 2**10)
+        chunk = np.arange(64, dtype=np.float64).reshape(8, 8)
+
+        def put():
+            cache.put(('file', 'ds', (0, 1)), chunk)
+
+        process = multiprocessing.Process(target=put)
+        process.start()
+        process.join()
+
+        cached = cache.get(('file', 'ds', (0, 1)), (8, 8), np.float64)
+        self.assertTrue((cached == chunk).all())
+        self.assertIsNone(cache.get(('file', 'ds', (0, 0)), (8, 8), np.float64))
+        # too large to cache
+        cache.put(('file', 'ds', (1, 1)), np.zeros((32, 32)))
+        self.assertIsNone(cache.get(('file', 'ds', (1, 1)), (32, 32), np.float64))
+
+        cache.close()
+
+
+class TestFileHandlePool(ProviderTest):
+
+    def test_eviction(self):
+
+        opened = []
+        closed = []
+
+        class Handle(object):
+            def __init__(self, name):
+                self.name = name
+
+            def __enter__(self):
+                opened.append(self.name)
+                return {}
+
+            def __exit__(self, *args):
+                closed.append(self.name)
+
+        pool = FileHandlePool(max_open=2)
+
+        with pool.open('a', lambda: Handle('a')):
+            with pool.open('b', lambda: Handle('b')):
+                with pool.open('c', lambda: Handle('c')):
+                    # all in use, none can be closed
+                    self.assertEqual(closed, [])
+        # closed as soon as it was not used anymore
+        self.assertEqual(closed, ['c'])
+
+        with pool.open('b', lambda: Handle('b')):
+            pass
+        with pool.open('a', lambda: Handle('a')):
+            pass
+        self.assertEqual(opened, ['a', 'b', 'c'])
+
+        # least recently used one gets closed
+        with pool.open('c', lambda: Handle('c')):
+            pass
+        self.assertEqual(opened, ['a', 'b', 'c', 'c'])
+        self.assertEqual(closed, ['c', 'b'])
+
+        pool.close('a')
+        pool.close('c')
+        self.assertEqual(len(pool.files), 0)
+
 
 class TestHdf5Source(ProviderTest, Hdf5LikeSourceTestMixin):
     extension = 'hdf'
@@ -104,6 +340,68 @@ class TestHdf5Source(ProviderTest, Hdf5LikeSourceTestMixin):
     def _open_writable_file(self, path):
         return h5py.File(path, 'w')
 
+    def test_channels_last_contiguous(self):
+        path = self.path_to('test_hdf_source.hdf')
+
+        raw_data = np.arange(3*20*20, dtype=np.uint8).reshape(3, 20, 20)
+        with h5py.File(path, 'w') as f:
+            f.create_dataset('raw_last', data=np.moveaxis(raw_data, 0, -1))
+            f['raw_last'].attrs['resolution'] = (1, 1)
+
+        raw = ArrayKey('RAW')
+        source = Hdf5Source(path, {raw: 'raw_last'}, channels_first=False)
+
+        roi = Roi((3, 5), (10, 12))
+        with build(source):
+            batch = source.request_batch(
+                BatchRequest({raw: ArraySpec(roi=roi)}))
+
+        expected = raw_data[(slice(None),) + roi.to_slices()]
+        self.assertTrue((batch[raw].data == expected).all())
+        self.assertTrue(batch[raw].data.flags.c_contiguous)
+
+    def test_mmap(self):
+        path = self.path_to('test_hdf_source.hdf')
+
+        raw_data = np.arange(2*40*40, dtype=np.float32).reshape(2, 40, 40)
+        with h5py.File(path, 'w') as f:
+            f.create_dataset('contiguous', data=raw_data)
+            f.create_dataset(
+                'compressed', data=raw_data, chunks=(1, 10, 10),
+                compression='gzip')
+            for ds in f.values():
+                ds.attrs['resolution'] = (1, 1)
+
+        contiguous = ArrayKey('CONTIGUOUS')
+        compressed = ArrayKey('COMPRESSED')
+
+        source = Hdf5Source(
+            path,
+            {contiguous: 'contiguous', compressed: 'compressed'},
+            mmap=True)
+
+        roi = Roi((5, 10), (20, 20))
+        with build(source):
+            batch = source.request_batch(
+                BatchRequest({
+                    contiguous: ArraySpec(roi=roi),
+                    compressed: ArraySpec(roi=roi),
+                })
+            )
+
+        expected = raw_data[(slice(None),) + roi.to_slices()]
+        for key in [contiguous, compressed]:
+            self.assertTrue((batch[key].data == expected).all())
+
+        # a view into the mapped file, compressed data is read as usual
+        self.assertIsInstance(batch[contiguous].data.base, np.memmap)
+        self.assertTrue(batch[compressed].data.flags.owndata)
+
+        # changes are not written back
+        batch[contiguous].data[:] = 0
+        with h5py.File(path, 'r') as f:
+            self.assertTrue((f['contiguous'][:] == raw_data).all())
+
 
 @skipIf(isinstance(zarr, NoSuchModule), 'zarr is not installed')
 class TestZarrSource(ProviderTest, Hdf5LikeSourceTestMixin):
@@ -112,3 +410,45 @@ class TestZarrSource(ProviderTest, Hdf5LikeSourceTestMixin):
 
     def _open_writable_file(self, path):
         return ZarrFile(path, mode='w')
+
+    def test_num_threads(self):
+        path = self.path_to('test_zarr_source.zarr')
+
+        raw_data = np.arange(3*50*50, dtype=np.uint16).reshape(3, 50, 50)
+        with self._open_writable_file(path) as f:
+            self._create_dataset(
+                f, 'raw', raw_data, chunks=(2, 7, 9), resolution=(1, 1))
+            self._create_dataset(
+                f, 'raw_last', np.moveaxis(raw_data, 0, -1).copy(),
+                chunks=(7, 9, 2), resolution=(1, 1))
+
+        raw = ArrayKey('RAW')
+        raw_last = ArrayKey('RAW_LAST')
+
+        for chunk_cache in [None, ChunkCache(2**20)]:
+
+            sources = (
+                ZarrSource(
+                    path, {raw: 'raw'},
+                    chunk_cache=chunk_cache,
+                    num_threads=4),
+                ZarrSource(
+                    path, {raw_last: 'raw_last'},
+                    channels_first=False,
+                    chunk_cache=chunk_cache,
+                    num_threads=4)
+            )
+            pipeline = sources + MergeProvider()
+
+            with build(pipeline):
+                for offset in [(0, 0), (3, 11), (31, 40)]:
+                    roi = Roi(offset, (10, 10)).intersect(Roi((0, 0), (50, 50)))
+                    batch = pipeline.request_batch(
+                        BatchRequest({
+                            raw: ArraySpec(roi=roi),
+                            raw_last: ArraySpec(roi=roi),
+                        })
+                    )
+                    expected = raw_data[(slice(None),) + roi.to_slices()]
+                    self.assertTrue((batch[raw].data == expected).all())
+                    self.assertTrue((batch[raw_last].data == expected).all())
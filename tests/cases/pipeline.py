@@ -0,0 +1,117 @@
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from gunpowder import (
+    BatchProvider,
+    BatchFilter,
+    Batch,
+    Array,
+    ArrayKey,
+    ArraySpec,
+    BatchRequest,
+    Roi,
+    PipelineRequestError,
+    build,
+)
+
+
+class IterateTestSource(BatchProvider):
+    def __init__(self, key):
+        self.key = key
+        self.num_requests = 0
+
+    def setup(self):
+        self.provides(
+            self.key,
+            ArraySpec(roi=Roi((0,), (100,)), voxel_size=(1,), dtype=np.uint64),
+        )
+
+    def provide(self, request):
+        time.sleep(0.01)
+        self.num_requests += 1
+        batch = Batch()
+        spec = self.spec[self.key].copy()
+        spec.roi = request[self.key].roi
+        batch[self.key] = Array(
+            np.full(spec.roi.get_shape(), request.random_seed, dtype=np.uint64),
+            spec,
+        )
+        return batch
+
+
+class NoOpFilter(BatchFilter):
+    def process(self, batch, request):
+        pass
+
+
+class FailingFilter(BatchFilter):
+    def process(self, batch, request):
+        raise RuntimeError("failing on purpose")
+
+
+def test_iterate():
+
+    key = ArrayKey("TEST")
+    source = IterateTestSource(key)
+    pipeline = source + NoOpFilter()
+
+    request = BatchRequest(random_seed=42)
+    request[key] = ArraySpec(roi=Roi((0,), (10,)))
+
+    num_threads = threading.active_count()
+
+    with build(pipeline):
+
+        seeds = []
+        for i, batch in enumerate(pipeline.iterate(request, prefetch=3)):
+            seeds.append(batch[key].data[0])
+            if i == 9:
+                break
+
+        # leaving the loop closed the generator and stopped the thread
+        assert threading.active_count() == num_threads
+        assert len(pipeline.iterations) == 0
+        # at most prefetch batches plus the one being produced were requested
+        # ahead of time
+        assert source.num_requests <= 10 + 3 + 1
+
+    # the same seeds as requesting the batches one by one
+    request = BatchRequest(random_seed=42)
+    request[key] = ArraySpec(roi=Roi((0,), (10,)))
+    with build(pipeline):
+        expected = [pipeline.request_batch(request)[key].data[0] for _ in range(10)]
+    assert seeds == expected
+
+
+def test_iterate_teardown():
+
+    key = ArrayKey("TEST")
+    pipeline = IterateTestSource(key) + NoOpFilter()
+
+    request = BatchRequest()
+    request[key] = ArraySpec(roi=Roi((0,), (10,)))
+
+    with build(pipeline):
+        batches = pipeline.iterate(request, prefetch=2)
+        next(batches)
+
+    # the teardown stopped the background thread, the generator ends
+    assert len(pipeline.iterations) == 0
+    assert len(list(batches)) == 0
+
+
+def test_iterate_error():
+
+    key = ArrayKey("TEST")
+    pipeline = IterateTestSource(key) + FailingFilter()
+
+    request = BatchRequest()
+    request[key] = ArraySpec(roi=Roi((0,), (10,)))
+
+    with build(pipeline):
+        with pytest.raises(PipelineRequestError):
+            for batch in pipeline.iterate(request):
+                pass
@@ -1,7 +1,54 @@
+import random
 import time
+import numpy as np
 from gunpowder import *
 from .provider_test import ProviderTest
 
+
+class RandomSource(BatchProvider):
+
+    def setup(self):
+
+        self.provides(
+            ArrayKeys.RAW,
+            ArraySpec(
+                roi=Roi((0, 0, 0), (100, 100, 100)),
+                voxel_size=(1, 1, 1)))
+
+    def provide(self, request):
+
+        spec = self.spec[ArrayKeys.RAW].copy()
+        spec.roi = request[ArrayKeys.RAW].roi
+
+        batch = Batch()
+        batch[ArrayKeys.RAW] = Array(
+            np.random.random(spec.roi.get_shape()).astype(np.float32),
+            spec)
+        return batch
+
+
+class SeedSource(BatchProvider):
+
+    def setup(self):
+
+        self.provides(
+            ArrayKeys.RAW,
+            ArraySpec(
+                roi=Roi((0, 0, 0), (100, 100, 100)),
+                voxel_size=(1, 1, 1)))
+
+    def provide(self, request):
+
+        spec = self.spec[ArrayKeys.RAW].copy()
+        spec.roi = request[ArrayKeys.RAW].roi
+
+        # fill each batch with its seed, to tell batches apart
+        batch = Batch()
+        batch[ArrayKeys.RAW] = Array(
+            np.full(spec.roi.get_shape(), request.random_seed, dtype=np.int64),
+            spec)
+        return batch
+
 class Delay(BatchFilter):
 
     def prepare(self, request):
@@ -11,6 +58,27 @@ class Delay(BatchFilter):
     def process(self, batch, request):
         pass
 
+
+class RandomDelay(BatchFilter):
+
+    def prepare(self, request):
+        # depends on the seed, such that workers finish out of order
+        time.sleep(random.random()*0.1)
+
+    def process(self, batch, request):
+        pass
+
+
+class RandomFailure(BatchFilter):
+
+    def prepare(self, request):
+        # depends on the seed, such that failures are reproducible
+        if random.random() < 0.3:
+            raise RuntimeError("random failure")
+
+    def process(self, batch, request):
+        pass
+
 class TestPreCache(ProviderTest):
 
     def test_output(self):
@@ -45,3 +113,172 @@ class TestPreCache(ProviderTest):
 
             # should be done in a bit more than 1 seconds
             self.assertTrue(time.time() - start < 50)
+
+    def test_shared_memory(self):
+
+        pipeline = (
+            SeedSource() +
+            PreCache(
+                num_workers=4,
+                cache_size=4,
+                transport="shared_memory",
+                slot_size=2**16))
+
+        request = BatchRequest()
+        request[ArrayKeys.RAW] = ArraySpec(roi=Roi((0, 0, 0), (10, 10, 10)))
+
+        with build(pipeline):
+
+            # keep a few batches, the other slots have to be recycled
+            kept = []
+            for i in range(50):
+                batch = pipeline.request_batch(request)
+                raw = batch.arrays[ArrayKeys.RAW]
+                self.assertTrue(raw.spec.roi == request[ArrayKeys.RAW].roi)
+                self.assertEqual(raw.data.shape, (10, 10, 10))
+                value = raw.data.flat[0]
+                self.assertTrue((raw.data == value).all())
+                if i % 20 == 0:
+                    kept.append((raw.data, value))
+
+            # views stay valid after many more batches than slots went through
+            for _ in range(30):
+                pipeline.request_batch(request)
+
+            values = [value for _, value in kept]
+            self.assertEqual(len(set(values)), len(values))
+            for data, value in kept:
+                self.assertTrue((data == value).all())
+
+    def test_deterministic(self):
+
+        def get_batches(num_workers):
+
+            pipeline = (
+                RandomSource() +
+                RandomDelay() +
+                PreCache(
+                    num_workers=num_workers,
+                    cache_size=5,
+                    deterministic=True))
+
+            request = BatchRequest(random_seed=42)
+            request[ArrayKeys.RAW] = ArraySpec(roi=Roi((0, 0, 0), (5, 5, 5)))
+
+            with build(pipeline):
+                return [
+                    pipeline.request_batch(request.copy())[ArrayKeys.RAW].data
+                    for _ in range(10)
+                ]
+
+        # two runs with several workers finishing in random order
+        first = get_batches(5)
+        second = get_batches(5)
+
+        for a, b in zip(first, second):
+            self.assertTrue((a == b).all())
+        self.assertFalse((first[0] == first[1]).all())
+
+        # upstream nodes are stateless, the number of workers doesn't matter
+        serial = get_batches(1)
+
+        for a, b in zip(serial, first):
+            self.assertTrue((a == b).all())
+
+    def test_upstream_failures(self):
+
+        def get_batches(num_workers, deterministic):
+
+            pipeline = (
+                RandomSource() +
+                RandomFailure() +
+                PreCache(
+                    num_workers=num_workers,
+                    cache_size=3,
+                    deterministic=deterministic))
+
+            request = BatchRequest(random_seed=42)
+            request[ArrayKeys.RAW] = ArraySpec(roi=Roi((0, 0, 0), (5, 5, 5)))
+
+            batches = []
+            with build(pipeline):
+                # many more failures than the cache size
+                for _ in range(40):
+                    try:
+                        batch = pipeline.request_batch(request.copy())
+                        batches.append(batch[ArrayKeys.RAW].data)
+                    except Exception:
+                        batches.append(None)
+            return batches
+
+        serial = get_batches(1, True)
+        parallel = get_batches(4, True)
+
+        failed = [batch is None for batch in serial]
+        self.assertTrue(any(failed))
+        self.assertFalse(all(failed[-10:]))
+        for a, b in zip(serial, parallel):
+            if a is None:
+                self.assertTrue(b is None)
+            else:
+                self.assertTrue((a == b).all())
+
+        # the pipeline keeps serving batches without determinism as well
+        batches = get_batches(4, False)
+        self.assertTrue(any(batch is None for batch in batches))
+        self.assertFalse(all(batch is None for batch in batches[-10:]))
+
+    def test_templates(self):
+
+        train_request = self.test_request
+        eval_request = self.test_request.copy()
+        eval_request[ArrayKeys.RAW].roi = Roi((0, 0, 0), (20, 20, 20))
+        other_request = self.test_request.copy()
+        other_request[ArrayKeys.RAW].roi = Roi((50, 50, 50), (5, 5, 5))
+
+        precache = PreCache(
+            num_workers=4,
+            cache_size=5,
+            max_templates=3,
+            templates=[(train_request, 0.8), (eval_request, 0.2)])
+        pipeline = self.test_source + precache
+
+        with build(pipeline):
+
+            workers = None
+            for i in range(30):
+                if i % 5 == 4:
+                    request = eval_request
+                elif i % 7 == 6:
+                    request = other_request
+                else:
+                    request = train_request
+                batch = pipeline.request_batch(request)
+                self.assertTrue(
+                    batch.arrays[ArrayKeys.RAW].spec.roi ==
+                    request[ArrayKeys.RAW].roi)
+
+                # workers are never restarted
+                if workers is None:
+                    workers = precache.workers
+                self.assertTrue(precache.workers is workers)
+
+    def test_thread_backend(self):
+
+        pipeline = (
+            self.test_source +
+            Delay() +
+            PreCache(num_workers=20, cache_size=20, backend="thread"))
+
+        with build(pipeline):
+
+            start = time.time()
+
+            for _ in range(20):
+                batch = pipeline.request_batch(self.test_request)
+                self.assertTrue(
+                    batch.arrays[ArrayKeys.RAW].spec.roi ==
+                    self.test_request[ArrayKeys.RAW].roi)
+
+            # the delay releases the GIL, threads should overlap
+            self.assertTrue(time.time() - start < 10)
@@ -12,10 +12,13 @@ from gunpowder import (
     Node,
     Roi,
     Scan,
+    ZarrWrite,
     build,
 )
+from gunpowder.pipeline import PipelineRequestError, PipelineSetupError
 import numpy as np
 import itertools
+import sqlite3
 
 
 def coordinate_to_id(i, j, k):
@@ -146,3 +149,175 @@ class TestScan(ProviderTest):
         pipeline = ScanTestSource() + Scan(chunk_request, num_workers=1)
         with build(pipeline):
             batch = pipeline.request_batch(BatchRequest())
+
+    def test_thread_backend(self):
+
+        chunk_request = BatchRequest()
+        chunk_request.add(ArrayKeys.RAW, (400, 30, 34))
+        chunk_request.add(ArrayKeys.GT_LABELS, (200, 10, 14))
+
+        pipeline = ScanTestSource() + Scan(
+            chunk_request,
+            num_workers=4,
+            backend="thread")
+
+        with build(pipeline):
+
+            full_request = BatchRequest({
+                    ArrayKeys.RAW: pipeline.spec[ArrayKeys.RAW],
+                    ArrayKeys.GT_LABELS: pipeline.spec[ArrayKeys.GT_LABELS],
+                }
+            )
+
+            batch = pipeline.request_batch(full_request)
+            voxel_size = pipeline.spec[ArrayKeys.RAW].voxel_size
+
+        for (array_key, array) in batch.arrays.items():
+
+            roi = array.spec.roi // voxel_size
+            meshgrids = np.meshgrid(
+                    range(roi.get_begin()[0], roi.get_end()[0]),
+                    range(roi.get_begin()[1], roi.get_end()[1]),
+                    range(roi.get_begin()[2], roi.get_end()[2]), indexing='ij')
+            data = meshgrids[0] + meshgrids[1] + meshgrids[2]
+
+            self.assertTrue((array.data == data).all())
+
+    def test_sink(self):
+
+        chunk_request = BatchRequest()
+        chunk_request.add(ArrayKeys.RAW, (400, 40, 40))
+
+        for num_workers in [1, 4]:
+
+            chunk_rois = []
+
+            def sink(chunk):
+                array = chunk[ArrayKeys.RAW]
+                roi = array.spec.roi // array.spec.voxel_size
+                meshgrids = np.meshgrid(
+                        range(roi.get_begin()[0], roi.get_end()[0]),
+                        range(roi.get_begin()[1], roi.get_end()[1]),
+                        range(roi.get_begin()[2], roi.get_end()[2]), indexing='ij')
+                data = meshgrids[0] + meshgrids[1] + meshgrids[2]
+                self.assertTrue((array.data == data).all())
+                chunk_rois.append(array.spec.roi)
+
+            pipeline = ScanTestSource() + Scan(
+                chunk_request,
+                num_workers=num_workers,
+                cache_size=2,
+                sink=sink)
+
+            with build(pipeline):
+                batch = pipeline.request_batch(BatchRequest())
+
+            self.assertEqual(len(batch.arrays), 0)
+            self.assertEqual(len(chunk_rois), 5*5*5)
+            self.assertEqual(
+                len(set(roi.get_offset() for roi in chunk_rois)),
+                5*5*5)
+
+    def test_journal(self):
+
+        chunk_request = BatchRequest()
+        chunk_request.add(ArrayKeys.RAW, (400, 40, 40))
+        journal = self.path_to('scan_journal.db')
+
+        chunk_rois = []
+
+        def failing_sink(chunk):
+            if len(chunk_rois) == 50:
+                raise RuntimeError("simulated crash")
+            chunk_rois.append(chunk[ArrayKeys.RAW].spec.roi)
+
+        def sink(chunk):
+            chunk_rois.append(chunk[ArrayKeys.RAW].spec.roi)
+
+        pipeline = ScanTestSource() + Scan(
+            chunk_request,
+            sink=failing_sink,
+            journal=journal)
+
+        with build(pipeline):
+            with self.assertRaises(PipelineRequestError):
+                pipeline.request_batch(BatchRequest())
+
+        self.assertEqual(len(chunk_rois), 50)
+
+        # resume, only the remaining chunks should be processed
+        pipeline = ScanTestSource() + Scan(
+            chunk_request,
+            num_workers=2,
+            sink=sink,
+            journal=journal)
+
+        with build(pipeline):
+            pipeline.request_batch(BatchRequest())
+
+        self.assertEqual(len(chunk_rois), 5*5*5)
+        self.assertEqual(
+            len(set(roi.get_offset() for roi in chunk_rois)),
+            5*5*5)
+
+        with sqlite3.connect(journal) as connection:
+            durations = [
+                duration
+                for (duration,) in connection.execute(
+                    "SELECT duration FROM chunks")
+            ]
+        self.assertEqual(len(durations), 5*5*5)
+        self.assertTrue(all(d >= 0 for d in durations))
+
+    def test_journal_write_behind(self):
+
+        chunk_request = BatchRequest()
+        chunk_request.add(ArrayKeys.RAW, (400, 40, 40))
+
+        # chunks would be recorded before they are written
+        pipeline = (
+            ScanTestSource() +
+            ZarrWrite(
+                {ArrayKeys.RAW: 'raw'},
+                output_filename=self.path_to('scan_test.zarr'),
+                write_behind=True) +
+            Scan(chunk_request, journal=self.path_to('scan_journal.db')))
+
+        with self.assertRaises(PipelineSetupError):
+            with build(pipeline):
+                pass
+
+    def test_order(self):
+
+        chunk_request = BatchRequest()
+        chunk_request.add(ArrayKeys.RAW, (400, 30, 34))
+
+        for order in ["zorder", "hilbert"]:
+
+            chunk_offsets = []
+
+            pipeline = ScanTestSource() + Scan(
+                chunk_request,
+                order=order,
+                sink=lambda chunk: chunk_offsets.append(
+                    chunk[ArrayKeys.RAW].spec.roi.get_offset()))
+
+            with build(pipeline):
+
+                full_request = BatchRequest({
+                    ArrayKeys.RAW: pipeline.spec[ArrayKeys.RAW]
+                })
+                batch = pipeline.request_batch(full_request)
+                voxel_size = pipeline.spec[ArrayKeys.RAW].voxel_size
+
+            roi = batch[ArrayKeys.RAW].spec.roi // voxel_size
+            meshgrids = np.meshgrid(
+                    range(roi.get_begin()[0], roi.get_end()[0]),
+                    range(roi.get_begin()[1], roi.get_end()[1]),
+                    range(roi.get_begin()[2], roi.get_end()[2]), indexing='ij')
+            data = meshgrids[0] + meshgrids[1] + meshgrids[2]
+
+            self.assertTrue((batch[ArrayKeys.RAW].data == data).all())
+            # 5 x 7 x 6 chunks, the last ones snapped to the end of the ROI
+            self.assertEqual(len(chunk_offsets), 5*7*6)
+            self.assertEqual(len(set(chunk_offsets)), 5*7*6)
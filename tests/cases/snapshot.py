@@ -9,6 +9,7 @@ from gunpowder import (
     Array,
     RasterizeGraph,
     Snapshot,
+    BatchFilter,
     BatchProvider,
     BatchRequest,
     Batch,
@@ -24,6 +25,8 @@ import shutil
 from pathlib import Path
 import h5py
 
+from .helper_sources import ArraySource
+
 
 class ExampleSource(BatchProvider):
     def __init__(self, keys, specs, every=2):
@@ -114,3 +117,45 @@ class TestSnapshot(unittest.TestCase):
 
             assert not snapshot_file_path.exists()
 
+    def test_async_write(self):
+
+        test_array = ArrayKey("TEST_ARRAY")
+        array_spec = ArraySpec(
+            roi=Roi((0, 0, 0), (5, 5, 5)), voxel_size=Coordinate((1, 1, 1))
+        )
+
+        class ModifyInPlace(BatchFilter):
+            def process(self, batch, request):
+                batch[test_array].data[:] = 1
+
+        pipeline = (
+            ArraySource(
+                test_array,
+                Array(np.zeros((5, 5, 5), dtype=np.float32), array_spec),
+            )
+            + Snapshot(
+                {test_array: "volumes/array"},
+                output_dir=str(self.test_dir),
+                output_filename="{id}.hdf",
+                async_write=True,
+                max_pending=2,
+            )
+            + ModifyInPlace()
+        )
+
+        with build(pipeline):
+
+            request = BatchRequest()
+            request[test_array] = ArraySpec(roi=Roi((0, 0, 0), (5, 5, 5)))
+
+            for _ in range(5):
+                pipeline.request_batch(request)
+
+        # teardown waited for all pending snapshots
+        snapshot_file_paths = list(Path(self.test_dir).glob("*.hdf"))
+        assert len(snapshot_file_paths) == 5
+        for snapshot_file_path in snapshot_file_paths:
+            with h5py.File(snapshot_file_path, "r") as f:
+                # stored before it was modified downstream
+                assert (f["volumes/array"][:] == 0).all()
+                assert tuple(f["volumes/array"].attrs["offset"]) == (0, 0, 0)
@@ -3,6 +3,7 @@ from gunpowder import *
 from gunpowder.ext import zarr, ZarrFile, NoSuchModule
 from unittest import skipIf
 import numpy as np
+import os
 
 class ZarrWriteTestSource(BatchProvider):
 
@@ -97,3 +98,140 @@ class TestZarrWrite(ProviderTest):
             self.assertEqual(tuple(ds.attrs['resolution']), batch_raw.spec.voxel_size)
             self.assertTrue((stored_raw == batch.arrays[ArrayKeys.RAW].data).all())
 
+    def test_write_behind(self):
+        path = self.path_to('zarr_write_test.zarr')
+
+        chunk_request = BatchRequest()
+        chunk_request.add(ArrayKeys.RAW, (400, 30, 34))
+
+        pipeline = (
+            ZarrWriteTestSource() +
+            ZarrWrite(
+                {ArrayKeys.RAW: 'arrays/raw'},
+                output_filename=path,
+                write_behind=True,
+                num_write_threads=2) +
+            Scan(chunk_request))
+
+        with build(pipeline):
+
+            raw_spec = pipeline.spec[ArrayKeys.RAW].copy()
+            # not aligned with the storage chunks, some are written partially
+            raw_spec.roi = raw_spec.roi.grow((-100, -6, -8), (-300, -10, -4))
+
+            batch = pipeline.request_batch(
+                BatchRequest({ArrayKeys.RAW: raw_spec}))
+
+        with ZarrFile(path, mode='r') as f:
+
+            ds = f['arrays/raw']
+            stored_raw = ds[:]
+
+            self.assertNotEqual(ds.chunks[1:], (20, 15, 17))
+            roi = (raw_spec.roi - Coordinate(ds.attrs['offset']))/(20, 2, 2)
+            written = (slice(None),) + roi.to_slices()
+            self.assertTrue(
+                (stored_raw[written] == batch.arrays[ArrayKeys.RAW].data).all())
+
+            stored_raw[written] = 0
+            self.assertTrue((stored_raw == 0).all())
+
+    def test_write_behind_workers(self):
+        path = self.path_to('zarr_write_test.zarr')
+
+        chunk_request = BatchRequest()
+        chunk_request.add(ArrayKeys.RAW, (400, 30, 34))
+
+        # worker processes are not torn down, partial chunks would be lost
+        pipeline = (
+            ZarrWriteTestSource() +
+            ZarrWrite(
+                {ArrayKeys.RAW: 'arrays/raw'},
+                output_filename=path,
+                write_behind=True) +
+            Scan(chunk_request, num_workers=2))
+
+        with build(pipeline):
+            with self.assertRaises(PipelineRequestError):
+                pipeline.request_batch(BatchRequest())
+
+    def test_multi_writer(self):
+        path = self.path_to('zarr_write_test.zarr')
+
+        chunk_request = BatchRequest()
+        chunk_request.add(ArrayKeys.RAW, (400, 30, 34))
+
+        pipeline = (
+            ZarrWriteTestSource() +
+            ZarrWrite(
+                {ArrayKeys.RAW: 'arrays/raw'},
+                output_filename=path,
+                multi_writer=True,
+                channel_shapes={ArrayKeys.RAW: (3,)}) +
+            Scan(chunk_request, num_workers=4))
+
+        with build(pipeline):
+
+            # created before any worker wrote to it
+            with ZarrFile(path, mode='r') as f:
+                self.assertEqual(f['arrays/raw'].shape, (3, 100, 100, 100))
+
+            raw_spec = pipeline.spec[ArrayKeys.RAW]
+            batch = pipeline.request_batch(
+                BatchRequest({ArrayKeys.RAW: raw_spec}))
+
+        with ZarrFile(path, mode='r') as f:
+
+            ds = f['arrays/raw']
+            self.assertNotEqual(ds.chunks[1:], (20, 15, 17))
+            self.assertTrue((ds[:] == batch.arrays[ArrayKeys.RAW].data).all())
+
+        # chunks shared between blocks were locked
+        self.assertTrue(os.listdir(os.path.join(path + '.locks', 'arrays/raw')))
+
+    def test_multi_writer_overlap(self):
+        path = self.path_to('zarr_write_test.zarr')
+
+        # small chunks, such that blocks completely cover some of them
+        with ZarrFile(path, mode='a') as f:
+            ds = f.create_dataset(
+                'arrays/raw',
+                shape=(3, 100, 100, 100),
+                chunks=(3, 10, 10, 10),
+                dtype=np.int64)
+            ds.attrs['offset'] = (20000, 2000, 2000)
+            ds.attrs['resolution'] = (20, 2, 2)
+
+        # blocks of 30 voxels over 95 voxels, the last block is snapped back
+        # and overlaps chunks completely covered by the previous one
+        chunk_request = BatchRequest()
+        chunk_request.add(ArrayKeys.RAW, (600, 60, 60))
+
+        pipeline = (
+            ZarrWriteTestSource() +
+            ZarrWrite(
+                {ArrayKeys.RAW: 'arrays/raw'},
+                output_filename=path,
+                multi_writer=True,
+                channel_shapes={ArrayKeys.RAW: (3,)}) +
+            Scan(chunk_request, num_workers=4))
+
+        with build(pipeline):
+
+            raw_spec = pipeline.spec[ArrayKeys.RAW].copy()
+            raw_spec.roi = Roi((20000, 2000, 2000), (1900, 190, 190))
+            batch = pipeline.request_batch(
+                BatchRequest({ArrayKeys.RAW: raw_spec}))
+
+        with ZarrFile(path, mode='r') as f:
+
+            stored_raw = f['arrays/raw'][:]
+            self.assertTrue(
+                (stored_raw[:, :95, :95, :95] ==
+                 batch.arrays[ArrayKeys.RAW].data).all())
+            self.assertTrue((stored_raw[:, 95:] == 0).all())
+
+        # every chunk was written while holding its lock
+        self.assertEqual(
+            len(os.listdir(os.path.join(path + '.locks', 'arrays/raw'))),
+            10*10*10)